@@ -0,0 +1,46 @@
+"""Process pools that work both in PythonSlicer and inside the Slicer application.
+
+Workers are never forked from the application, they are spawned as fresh interpreters.
+Inside Slicer sys.executable is the application itself, so spawned workers would start
+another Slicer; they run the PythonSlicer interpreter next to it instead. If it cannot be
+found the work runs on a thread pool.
+"""
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+
+def workerExecutable():
+  """Interpreter that spawned workers run, None if it is this process' own, "" if it cannot be found."""
+  if not os.path.basename(sys.executable).lower().startswith("slicer"):
+    return None
+  name = "PythonSlicer.exe" if os.name == 'nt' else "PythonSlicer"
+  directory = os.path.dirname(sys.executable)
+  # Next to the application (Linux, Windows) or in the bin directory of the bundle (macOS)
+  for path in [os.path.join(directory, name), os.path.join(directory, os.pardir, "bin", name), shutil.which(name)]:
+    if path is not None and os.path.isfile(path):
+      return os.path.abspath(path)
+  return ""
+
+def starmap(function, arguments, maxWorkers=None):
+  """Returns [function(*args) for args in arguments], computed on up to maxWorkers processes.
+
+  function has to be importable by the workers (defined at the top level of a module, not
+  in the main script). maxWorkers defaults to one per CPU, with one worker or a single
+  call everything runs in this process.
+  """
+  arguments = list(arguments)
+  if maxWorkers == 1 or len(arguments) <= 1:
+    return [function(*args) for args in arguments]
+  executable = workerExecutable()
+  if executable == "":
+    logging.warning("PythonSlicer was not found, running " + function.__name__ + " on threads instead of processes")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+      return list(executor.map(lambda args: function(*args), arguments))
+  context = multiprocessing.get_context('spawn')
+  if executable is not None:
+    context.set_executable(executable)
+  with context.Pool(maxWorkers) as pool:
+    return pool.starmap(function, arguments)
@@ -0,0 +1,57 @@
+"""Conversion between vtkMatrix4x4 and NumPy arrays, and extraction of transform sequences.
+
+VTK does not expose the element storage of a vtkMatrix4x4 to Python, so the conversions
+copy all 16 elements with a single DeepCopy call into (or from) the memory of the NumPy
+array instead of calling GetElement/SetElement per element.
+"""
+import numpy as np
+import vtk
+
+def arrayFromMatrix(matrix, out=None):
+  """4 x 4 array with the elements of a vtkMatrix4x4, written into out (C contiguous 4 x 4 float64) if given."""
+  if out is None:
+    out = np.empty((4, 4))
+  # ravel() of a contiguous array is a view, DeepCopy fills the array in place
+  matrix.DeepCopy(out.ravel(), matrix)
+  return out
+
+def updateMatrixFromArray(matrix, array):
+  """Sets the elements of a vtkMatrix4x4 from a 4 x 4 array."""
+  matrix.DeepCopy(np.ascontiguousarray(array, dtype=np.float64).ravel())
+  return matrix
+
+def updateMatrixFromTranslation(matrix, translation, array=None):
+  """Sets a vtkMatrix4x4 to a translation (3) with a single DeepCopy.
+
+  array is a C contiguous 4 x 4 float64 array that can be reused for every call to avoid an
+  allocation, only its translation is overwritten, the rest (usually identity) is copied as is.
+  """
+  if array is None:
+    array = np.eye(4)
+  array[0:3, 3] = translation
+  matrix.DeepCopy(array.ravel())
+  return matrix
+
+def matrixFromArray(array):
+  return updateMatrixFromArray(vtk.vtkMatrix4x4(), array)
+
+def positionFromMatrix(matrix):
+  """Translation (3) of a vtkMatrix4x4."""
+  return arrayFromMatrix(matrix)[0:3, 3]
+
+def sequenceTimes(sequenceNode):
+  """Index values of a sequence as numbers, for recordings these are the timestamps in seconds."""
+  return np.array([float(sequenceNode.GetNthIndexValue(i)) for i in range(0, sequenceNode.GetNumberOfDataNodes())])
+
+def matricesFromSequence(sequenceNode):
+  """Transform to parent of every item of a sequence of linear transforms, as one N x 4 x 4 array.
+
+  This is still one GetNthDataNode and GetMatrixTransformToParent call per item, the sequence
+  node has no bulk access to its data nodes. Only the per element copies are avoided.
+  """
+  matrices = np.empty((sequenceNode.GetNumberOfDataNodes(), 4, 4))
+  matrix = vtk.vtkMatrix4x4()
+  for i in range(0, len(matrices)):
+    sequenceNode.GetNthDataNode(i).GetMatrixTransformToParent(matrix)
+    matrix.DeepCopy(matrices[i].ravel(), matrix)
+  return matrices
@@ -2,11 +2,16 @@ import os
 import unittest
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
+import collections
 import logging
 import re
+import time
 import SimpleITK as sitk
 import numpy as np 
 import sitkUtils 
+from GuidedUSCalLib import CalibrationHistory, DetectionScheduler, FrameGate, NeedleDetector, NeedleTracker, SceneNodeIndex, SharedImageBuffer, VolumeReconstructor
+from GuidedUSCalLib import DetectorEvaluation, TemporalCalibration, TrainingShards
+from VASSTCommon.TransformUtils import arrayFromMatrix, matricesFromSequence, matrixFromArray, sequenceTimes, updateMatrixFromArray, updateMatrixFromTranslation
 
 if '4.11' in slicer.__path__[0]: 
   try: 
@@ -40,27 +45,124 @@ class GuidedUSCal(ScriptedLoadableModule):
     self.parent.helpText="""This is a scripted loadable module that performs ultrasound calibration."""
     self.parent.helpText = self.getDefaultModuleDocumentationLink()
   
+# One probe being calibrated: its image and tip to probe transform, solver, history and frame gate
+class CalibrationSession(object):
+  def __init__(self, name, imageName='Image_Probe'):
+    self.name = name
+    self.imageName = imageName
+    self.imageNode = None
+    self.transformNode = None
+    self.logic = GuidedUSCalLogic()
+    self.frameGate = FrameGate()
+    self.imageToProbe = vtk.vtkMatrix4x4()
+    self.outputRegistrationTransformNode = slicer.vtkMRMLLinearTransformNode()
+    slicer.mrmlScene.AddNode(self.outputRegistrationTransformNode)
+    self.outputRegistrationTransformNode.SetName(slicer.mrmlScene.GetUniqueNameByString('ImageToProbe'))
+    # Temporal calibration: delay of the image stream (s), and the lag corrected pose of every frame of imageSequence
+    self.timeOffset = 0.0
+    self.timeCorrelation = None
+    self.imageSequence = None
+    self.framePoses = None
+    self.reconstructionNode = None
+    # Follows the needle tip between keyframe detections when tracking continuously, created by the widget
+    self.tracker = None
+
+  def calibrateTime(self, transformSequence, imageSequence):
+    self.timeOffset, self.timeCorrelation, self.framePoses = self.logic.EstimateTimeOffset(transformSequence, imageSequence)
+    self.imageSequence = imageSequence
+
+  def currentImageItem(self):
+    # Item shown in the image node and the sequence it is played back from, (-1, None) for a live image
+    if self.imageNode is None:
+      return -1, None
+    browser = slicer.modules.sequencebrowser.logic().GetFirstBrowserNodeForProxyNode(self.imageNode)
+    if browser is None:
+      return -1, None
+    sequenceNode = browser.GetSequenceNode(self.imageNode)
+    if sequenceNode is None:
+      return -1, None
+    item = browser.GetSelectedItemNumber()
+    masterSequence = browser.GetMasterSequenceNode()
+    if masterSequence.GetID() != sequenceNode.GetID():
+      item = sequenceNode.GetItemNumberFromIndexValue(masterSequence.GetNthIndexValue(item), False)
+    return item, sequenceNode
+
+  def currentFrameIndex(self):
+    # Item of the temporally calibrated image sequence that is shown in the image node, -1 if there is none
+    if self.framePoses is None:
+      return -1
+    item, sequenceNode = self.currentImageItem()
+    if sequenceNode is None or sequenceNode.GetID() != self.imageSequence.GetID():
+      return -1
+    return item if 0 <= item < len(self.framePoses) else -1
+
+  def getTipToProbe(self, tipToProbeTransform):
+    # Pose to pair with the shown frame, lag corrected when the frame is from the calibrated recording
+    item = self.currentFrameIndex()
+    if item < 0:
+      self.transformNode.GetMatrixTransformToWorld(tipToProbeTransform)
+      return
+    # Recorded poses are relative to the parent of the transform, the live pose is to world
+    framePose = self.framePoses[item]
+    parentNode = self.transformNode.GetParentTransformNode()
+    if parentNode is not None:
+      parentToWorld = vtk.vtkMatrix4x4()
+      parentNode.GetMatrixTransformToWorld(parentToWorld)
+      framePose = arrayFromMatrix(parentToWorld).dot(framePose)
+    updateMatrixFromArray(tipToProbeTransform, framePose)
+
+  def addCorrespondence(self, point, tipToProbeTransform, frame=-1, manual=False):
+    # Pair an image point with the needle line of the given tip to probe matrix, frame is the recorded image item it was placed on
+    tipToProbe = arrayFromMatrix(tipToProbeTransform)
+    origin = tipToProbe[0:3, 3].tolist()
+    direction = tipToProbe[0:3, 2].tolist()
+    self.imageToProbe = self.logic.AddCorrespondence([point[0], point[1], 0], origin, direction, frame, manual)
+    if manual and frame < 0 and self.imageNode is not None:
+      self.logic.AddLiveSample(self.imageNode, [point[0], point[1], 0], tipToProbe)
+
+  def sequenceFramePoses(self, imageSequence):
+    # Lag corrected frame poses if they belong to imageSequence
+    if self.framePoses is None or imageSequence is None or self.imageSequence.GetID() != imageSequence.GetID():
+      return None
+    return self.framePoses
+
+def sessionProperty(name):
+  # Widget attribute that is stored on the active calibration session
+  return property(lambda self: getattr(self.activeSession, name), lambda self, value: setattr(self.activeSession, name, value))
+
 # This class contains the widget (GUI) portion of the code
 class GuidedUSCalWidget(ScriptedLoadableModuleWidget):
   """Uses ScriptedLoadableModuleWidget base class, available at:
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
+  imageNode = sessionProperty('imageNode')
+  transformNode = sessionProperty('transformNode')
+  logic = sessionProperty('logic')
+  frameGate = sessionProperty('frameGate')
+  imageToProbe = sessionProperty('imageToProbe')
+  outputRegistrationTransformNode = sessionProperty('outputRegistrationTransformNode')
+
   def __init__(self, parent=None):
     ScriptedLoadableModuleWidget.__init__(self, parent)
 
+    # Each probe has its own calibration session, all fed by the same connector
+    self.sessions = [CalibrationSession('Probe 1')]
+    self.activeSession = self.sessions[0]
     # Set member variables equal to None
     self.tempNode = None 
     self.connectorNode = None
+    self.trackedImageNode = None
+    self.trackedImageObserverTag = None
     self.sceneObserverTag = None
-    self.logic = GuidedUSCalLogic()
+    self.sceneRemovedObserverTag = None
+    self.sceneClosedObserverTag = None
+    # Sequence nodes in the scene mean a recording is played back instead of a live connection
+    self.sceneIndex = SceneNodeIndex(["vtkMRMLSequenceNode", "vtkMRMLSequenceBrowserNode"])
     self.resliceLogic = slicer.modules.volumereslicedriver.logic()
-    self.imageNode = None
     self.probeNode = None
     self.sequenceNode = None
     self.sequenceNode2 = None 
     self.sequenceBrowserNode = None
-    self.transformNode = None 
-    self.dataStack = None 
     self.numFid = 0
     self.sequenceLogic = slicer.modules.sequencebrowser.logic()
     self.counter = 0 
@@ -70,6 +172,9 @@ class GuidedUSCalWidget(ScriptedLoadableModuleWidget):
     slicer.mymod = self
     self.connectCheck = 0 
     self.node = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode')
+    self.node.SetName(slicer.mrmlScene.GetUniqueNameByString('NeedleDetectorInput'))
+    # Preallocated image shared with self.node, created on the first detection
+    self.detectorView = None
     self.path = os.path.dirname(os.path.abspath(__file__))
     self.model = load_model(os.path.join(self.path,'Resources\Models\cnn_model_best.keras.h5'))
     self.fiducialNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode')
@@ -89,16 +194,20 @@ class GuidedUSCalWidget(ScriptedLoadableModuleWidget):
     self.wResized = self.model.layers[0].output_shape[0][1]
     self.hResized = self.model.layers[0].output_shape[0][2]
     self.tipToProbeTransform = vtk.vtkMatrix4x4()
-    self.outputRegistrationTransformNode = slicer.vtkMRMLLinearTransformNode()
-    slicer.mrmlScene.AddNode(self.outputRegistrationTransformNode)
-    self.outputRegistrationTransformNode.SetName('ImageToProbe')
     self.needleModel = slicer.modules.createmodels.logic().CreateNeedle(150, 0.4, 0, False)
-    self.imageToProbe = vtk.vtkMatrix4x4()
-    self.redoStack = None 
+    self.isRestoringHistory = False
+    self.detector = NeedleDetector(self.model, self.wResized, self.hResized)
+    self.detection = None
+    # Width and height of the cropped frame of the model input shown by self.node
+    self.detectorViewFrameSize = None
+    self.detectionScheduler = DetectionScheduler(self.detector)
+    self.detectionTimer = qt.QTimer()
+    self.detectionTimer.setInterval(20)
     # This sets the color
   def setup(self):
     # this is the function that implements all GUI 
     ScriptedLoadableModuleWidget.setup(self)
+    self.sceneIndex.rebuild(slicer.mrmlScene)
     # This sets the view being used to the red view only 
     slicer.app.layoutManager().setLayout(slicer.vtkMRMLLayoutNode.SlicerLayoutOneUpRedSliceView)
     #This code block creates a collapsible button 
@@ -111,6 +220,19 @@ class GuidedUSCalWidget(ScriptedLoadableModuleWidget):
     #This creates a variable that describes layout within this collapsible button 
     self.usLayout = qt.QFormLayout(self.usContainer)
 
+    # Probe sessions sharing the connection
+    self.sessionComboBox = qt.QComboBox()
+    self.sessionComboBox.toolTip = "Probe currently being calibrated"
+    self.sessionComboBox.addItem(self.activeSession.name)
+    self.addSessionButton = qt.QPushButton("Add Probe")
+    self.addSessionButton.toolTip = "Calibrate another probe streamed over the same connection"
+    sessionWidget = qt.QWidget()
+    sessionLayout = qt.QHBoxLayout(sessionWidget)
+    sessionLayout.setContentsMargins(0, 0, 0, 0)
+    sessionLayout.addWidget(self.sessionComboBox)
+    sessionLayout.addWidget(self.addSessionButton)
+    self.usLayout.addRow("Probe: ", sessionWidget)
+
     #This descirbes the type of widget 
     self.inputIPLineEdit = qt.QLineEdit()
     #This sets a placehoder example of what should be inputted to the line edit 
@@ -119,7 +241,7 @@ class GuidedUSCalWidget(ScriptedLoadableModuleWidget):
     self.inputIPLineEdit.toolTip = "Put the IP address of your ultrasound device here"
     #This is the text that is input inot the line 
     self.IPLabel = qt.QLabel("Server IP:")
-    if slicer.mrmlScene.GetNodesByClass("vtkMRMLSequenceNode").GetNumberOfItems() == 0:
+    if self.sceneIndex.count("vtkMRMLSequenceNode") == 0:
       self.usLayout.addRow(self.IPLabel, self.inputIPLineEdit)
     #This code block is the exact same as the one above only it asks for the server port 
     self.layout.addWidget(self.usContainer)
@@ -128,7 +250,7 @@ class GuidedUSCalWidget(ScriptedLoadableModuleWidget):
     self.inputPortLineEdit.setValidator(qt.QIntValidator())
     self.inputPortLineEdit.toolTip = "Put the Port of your ultrasound device here"
     self.portLabel = qt.QLabel("Sever Port:")
-    if slicer.mrmlScene.GetNodesByClass("vtkMRMLSequenceNode").GetNumberOfItems() == 0:
+    if self.sceneIndex.count("vtkMRMLSequenceNode") == 0:
       self.usLayout.addRow(self.portLabel, self.inputPortLineEdit)
     #This is a push button 
     self.connectButton = qt.QPushButton()
@@ -138,7 +260,7 @@ class GuidedUSCalWidget(ScriptedLoadableModuleWidget):
     #help tooltip that explains the funciton 
     self.connectButton.toolTip = "Connects to Ultrasound"
     #adds the widget to the layout 
-    if slicer.mrmlScene.GetNodesByClass("vtkMRMLSequenceNode").GetNumberOfItems() == 0:
+    if self.sceneIndex.count("vtkMRMLSequenceNode") == 0:
       self.usLayout.addWidget(self.connectButton)
     # Combobox for image selection
     self.imageSelector = slicer.qMRMLNodeComboBox()
@@ -185,6 +307,68 @@ class GuidedUSCalWidget(ScriptedLoadableModuleWidget):
     self.auto.text = "Check for automatic segmentation for ultrasonix L14-5 38"
     self.calibrationLayout.addWidget(self.auto)
     
+    self.gateCheckBox = qt.QCheckBox()
+    self.gateCheckBox.text = "Skip frames without a visible needle"
+    self.gateCheckBox.toolTip = "Reject blurred frames and frames without a bright needle echo before detecting the needle for all probes, a frame placed with 'f' is always segmented"
+    self.gateCheckBox.setChecked(False)
+    self.calibrationLayout.addWidget(self.gateCheckBox)
+    
+    self.gateBrightSpinBox = qt.QSpinBox()
+    self.gateBrightSpinBox.setRange(0, 255)
+    self.gateBrightSpinBox.setValue(self.frameGate.brightThreshold)
+    self.gateBrightSpinBox.toolTip = "Intensity above which a pixel can be part of the needle echo"
+    self.calibrationLayout.addRow(qt.QLabel("Needle echo intensity:"), self.gateBrightSpinBox)
+    
+    self.gateSharpnessSpinBox = qt.QDoubleSpinBox()
+    self.gateSharpnessSpinBox.setRange(0.0, 10000.0)
+    self.gateSharpnessSpinBox.setDecimals(1)
+    self.gateSharpnessSpinBox.setValue(self.frameGate.minSharpness)
+    self.gateSharpnessSpinBox.toolTip = "Minimum variance of the Laplacian, frames below it are rejected as blurred"
+    self.calibrationLayout.addRow(qt.QLabel("Minimum sharpness:"), self.gateSharpnessSpinBox)
+    
+    self.gateLabel = qt.QLabel(self.frameGate.summary())
+    self.calibrationLayout.addRow(qt.QLabel("Frames rejected:"), self.gateLabel)
+    
+    self.augmentCheckBox = qt.QCheckBox()
+    self.augmentCheckBox.text = "Estimate detection confidence (test-time augmentation)"
+    self.augmentCheckBox.toolTip = "Predict shifted and mirrored copies of each frame in one batch and use their agreement as the detection confidence"
+    self.calibrationLayout.addWidget(self.augmentCheckBox)
+    
+    self.detectionLabel = qt.QLabel()
+    self.calibrationLayout.addRow(qt.QLabel("Last detection:"), self.detectionLabel)
+    
+    self.overlayCheckBox = qt.QCheckBox()
+    self.overlayCheckBox.text = "Show detector input overlay"
+    self.overlayCheckBox.toolTip = "Overlay the resized image seen by the model, with the detected tip marked, on the ultrasound image"
+    self.calibrationLayout.addWidget(self.overlayCheckBox)
+    
+    self.trackingCheckBox = qt.QCheckBox()
+    self.trackingCheckBox.text = "Track needle continuously"
+    self.trackingCheckBox.toolTip = "Run the model on keyframes only and follow the tip by template matching on the frames in between, the model runs again when the match gets poor"
+    self.calibrationLayout.addWidget(self.trackingCheckBox)
+    
+    self.trackingLabel = qt.QLabel()
+    self.calibrationLayout.addRow(qt.QLabel("Keyframes:"), self.trackingLabel)
+    
+    self.detectAllButton = qt.QPushButton("Detect Needle For All Probes")
+    self.detectAllButton.toolTip = "Run automatic segmentation on the current frame of every probe and add the correspondences"
+    self.calibrationLayout.addRow(self.detectAllButton)
+    
+    self.timeOffsetButton = qt.QPushButton("Estimate Image To Tracker Lag")
+    self.timeOffsetButton.toolTip = "Estimate the time offset between the image and tracker streams from a recorded sweep, and pair every recorded frame with the pose at its corrected time"
+    self.calibrationLayout.addRow(self.timeOffsetButton)
+    
+    self.timeOffsetLabel = qt.QLabel()
+    self.calibrationLayout.addRow(qt.QLabel("Image lag:"), self.timeOffsetLabel)
+    
+    self.exportLabelsButton = qt.QPushButton("Export Labeled Frames")
+    self.exportLabelsButton.toolTip = "Save the recorded and live frames with a manually placed fiducial and their probe poses, to evaluate needle detection models on them or train new ones"
+    self.calibrationLayout.addRow(self.exportLabelsButton)
+    
+    self.trainingShardsButton = qt.QPushButton("Write Training Shards")
+    self.trainingShardsButton.toolTip = "Shuffle the labeled frames exported from many sessions into compressed shards for training needle detection models"
+    self.calibrationLayout.addRow(self.trainingShardsButton)
+    
     self.recordContainer = ctk.ctkCollapsibleButton()
     #This is what the button will say 
     self.recordContainer.text = "Recording Options"
@@ -217,7 +401,7 @@ class GuidedUSCalWidget(ScriptedLoadableModuleWidget):
 
     #This is the exact same as the code block below but it freezes the US to capture a screenshot 
     self.freezeButton = qt.QPushButton()
-    if slicer.mrmlScene.GetNodesByClass("vtkMRMLSequenceNode").GetNumberOfItems() == 0:
+    if self.sceneIndex.count("vtkMRMLSequenceNode") == 0:
       self.freezeButton.text = "Place Fiducial ('f')"
     else:
       self.freezeButton.text = "Place Fiducial"
@@ -236,13 +420,16 @@ class GuidedUSCalWidget(ScriptedLoadableModuleWidget):
     self.numFidLabel = qt.QLabel()
     self.fiducialLayout.addRow(qt.QLabel("Fiducials collected:"), self.numFidLabel)
     
+    self.historySpinBox = qt.QSpinBox()
+    self.historySpinBox.toolTip = "Go to any step of the calibration history, steps are numbered in the order they were added, including the ones left behind by adding after an undo"
+    self.historySpinBox.setRange(0, 0)
+    self.fiducialLayout.addRow(qt.QLabel("Calibration step:"), self.historySpinBox)
+    
     self.transformTable = ctk.ctkMatrixWidget() 
     self.transformTable.columnCount = 4
     self.transformTable.rowCount = 4 
     self.transformTable.setDecimals(3)
-    for i in range (0,4): 
-      for j in range(0,4): 
-        self.transformTable.setValue(i,j, (self.imageToProbe.GetElement(i,j)))
+    self.transformTable.setValues(arrayFromMatrix(self.imageToProbe).ravel().tolist())
     
     self.fiducialLayout.addRow(qt.QLabel("Image to probe transform:"))
     self.fiducialLayout.addRow(self.transformTable)
@@ -261,6 +448,26 @@ class GuidedUSCalWidget(ScriptedLoadableModuleWidget):
     self.visualizeButton.toolTip = "This button enables the 3D view for visual validation"
     self.validationLayout.addRow(self.visualizeButton)
     self.visualizeButton.connect('clicked(bool)', self.onVisualizeButtonClicked)
+    
+    self.reconstructionSpacingSpinBox = qt.QDoubleSpinBox()
+    self.reconstructionSpacingSpinBox.setRange(0.1, 5.0)
+    self.reconstructionSpacingSpinBox.setSingleStep(0.1)
+    self.reconstructionSpacingSpinBox.setValue(0.5)
+    self.reconstructionSpacingSpinBox.suffix = " mm"
+    self.reconstructionSpacingSpinBox.toolTip = "Voxel size of the reconstructed volume"
+    self.validationLayout.addRow(qt.QLabel("Voxel size:"), self.reconstructionSpacingSpinBox)
+    
+    self.fillHolesCheckBox = qt.QCheckBox()
+    self.fillHolesCheckBox.text = "Fill holes between frames"
+    self.fillHolesCheckBox.setChecked(True)
+    self.validationLayout.addWidget(self.fillHolesCheckBox)
+    
+    self.reconstructButton = qt.QPushButton('Reconstruct Volume')
+    self.reconstructButton.toolTip = "Reconstruct the recorded sweep into a 3D volume using the calibration, shown in the 3D view relative to the needle"
+    self.validationLayout.addRow(self.reconstructButton)
+    
+    self.reconstructionLabel = qt.QLabel()
+    self.validationLayout.addRow(qt.QLabel("Reconstruction:"), self.reconstructionLabel)
     self.resetButton = qt.QPushButton('Reset')
     self.resetButton.setDefault(False)
     self.resetButton.toolTip = "This Button Resets the Module"
@@ -269,7 +476,7 @@ class GuidedUSCalWidget(ScriptedLoadableModuleWidget):
     # Add the containers to the parent
     self.layout.addWidget(self.usContainer)
     self.layout.addWidget(self.calibrationContainer)
-    if slicer.mrmlScene.GetNodesByClass("vtkMRMLSequenceNode").GetNumberOfItems() == 0:
+    if self.sceneIndex.count("vtkMRMLSequenceNode") == 0:
       self.layout.addWidget(self.recordContainer)
     self.layout.addWidget(self.fiducialContainer)
 
@@ -280,7 +487,7 @@ class GuidedUSCalWidget(ScriptedLoadableModuleWidget):
     self.layout.addStretch(1)
 
     # Connections
-    if slicer.mrmlScene.GetNodesByClass("vtkMRMLSequenceNode").GetNumberOfItems() == 0:
+    if self.sceneIndex.count("vtkMRMLSequenceNode") == 0:
       self.connectButton.connect('clicked(bool)', self.onConnectButtonClicked)
       self.freezeButton.connect('clicked(bool)', self.onConnectButtonClicked)
       self.shortcut.connect('activated()', self.onConnectButtonClicked)
@@ -296,20 +503,46 @@ class GuidedUSCalWidget(ScriptedLoadableModuleWidget):
     self.imageSelector.connect('currentNodeChanged(vtkMRMLNode*)', self.onImageChanged)
     self.TransformSelector.connect('currentNodeChanged(vtkMRMLNode*)', self.onTransformChanged)
     self.resetButton.connect('clicked(bool)', self.onResetButtonClicked)
+    self.reconstructButton.connect('clicked(bool)', self.onReconstructButtonClicked)
     self.undoButton.connect('clicked(bool)', self.onUndoButtonClicked)
     self.uShortcut.connect('activated()', self.onUndoButtonClicked)
     self.redoButton.connect('clicked(bool)', self.onRedoButtonClicked)
     self.rShortcut.connect('activated()', self.onRedoButtonClicked)
+    self.historySpinBox.connect('valueChanged(int)', self.onHistoryStepChanged)
+    self.sessionComboBox.connect('currentIndexChanged(int)', self.onSessionChanged)
+    self.addSessionButton.connect('clicked(bool)', self.onAddSessionButtonClicked)
+    self.detectAllButton.connect('clicked(bool)', self.onDetectAllButtonClicked)
+    self.timeOffsetButton.connect('clicked(bool)', self.onTimeOffsetButtonClicked)
+    self.exportLabelsButton.connect('clicked(bool)', self.onExportLabelsButtonClicked)
+    self.trainingShardsButton.connect('clicked(bool)', self.onTrainingShardsButtonClicked)
+    self.detectionTimer.connect('timeout()', self.onDetectionTimer)
+    self.overlayCheckBox.connect('toggled(bool)', self.onOverlayToggled)
+    self.gateBrightSpinBox.connect('valueChanged(int)', self.onGateSettingsChanged)
+    self.gateSharpnessSpinBox.connect('valueChanged(double)', self.onGateSettingsChanged)
+    self.trackingCheckBox.connect('toggled(bool)', self.onTrackingToggled)
+    self.augmentCheckBox.connect('toggled(bool)', self.onAugmentToggled)
     # Disable buttons until conditions are met
     self.connectButton.setEnabled(True) 
     # if slicer.mrmlScene.GetNodesByClass("vtkMRMLSequenceNode").GetNumberOfItems() == 0:
       # self.freezeButton.setEnabled(False) 
     self.StopRecordButton.setEnabled(False)
+    self.updateCalibrationDisplay(False)
+    self.updateTimeOffsetLabel()
     
     self.sceneObserverTag = slicer.mrmlScene.AddObserver(slicer.mrmlScene.NodeAddedEvent, self.onNodeAdded)
+    self.sceneRemovedObserverTag = slicer.mrmlScene.AddObserver(slicer.mrmlScene.NodeRemovedEvent, self.onNodeRemoved)
+    self.sceneClosedObserverTag = slicer.mrmlScene.AddObserver(slicer.mrmlScene.EndCloseEvent, self.onSceneClosed)
   
+  @vtk.calldata_type(vtk.VTK_OBJECT)
+  def onNodeRemoved(self, caller, event, callData):
+    self.sceneIndex.nodeRemoved(callData)
+
+  def onSceneClosed(self, caller, event):
+    self.sceneIndex.rebuild(slicer.mrmlScene)
+
   @vtk.calldata_type(vtk.VTK_OBJECT)
   def onNodeAdded(self, caller, event, callData):
+    self.sceneIndex.nodeAdded(callData)
     if type(callData) is slicer.vtkMRMLSequenceBrowserNode:
       if self.connectorNode is None:
         self.inputIPLineEdit.hide() 
@@ -360,8 +593,6 @@ class GuidedUSCalWidget(ScriptedLoadableModuleWidget):
           if self.transformNode is None:
             print('Please select the tip to probe transform')
         if self.imageNode is not None and self.transformNode is not None:
-          self.numFid = self.numFid + 1 
-          self.numFidLabel.setText(str(self.numFid))
           slicer.modules.markups.logic().StartPlaceMode(0)
           slicer.app.layoutManager().sliceWidget('Red').setCursor(qt.QCursor(2))
       else:
@@ -381,43 +612,23 @@ class GuidedUSCalWidget(ScriptedLoadableModuleWidget):
       if self.transformNode is None:
         print('Please select the tip to probe transform')
     if self.imageNode is not None and self.transformNode is not None:
-      self.numFid = self.numFid+1 
-      self.numFidLabel.setText(str(self.numFid))
       if self.manual.isChecked() == True:
         slicer.modules.markups.logic().StartPlaceMode(0)
         self.markupAddedObserverTag = self.fiducialNode.AddObserver(slicer.vtkMRMLMarkupsNode.PointModifiedEvent, self.onMarkupAdded)
         self.onMarkupAdded(self.fiducialNode, slicer.vtkMRMLMarkupsNode.PointModifiedEvent);
       if self.auto.isChecked() == True: 
         self.fiducialNode.RemoveAllMarkups()
-        self.I = slicer.util.arrayFromVolume(slicer.util.getNode('Image_Probe'))
-        self.shape = self.I.shape
-        self.Im = np.resize(self.I, [self.shape[1],self.shape[2]])
-        self.Im = np.transpose(self.Im)
-        self.Im = np.resize(self.Im, [self.shape[2],self.shape[1],1])
-        self.x = self.Im[:,0:self.shape[1]-5]/255
-        self.w = self.x.shape[0]
-        self.h = self.x.shape[1]
-        if self.wResized != 128: 
-          self.x = np.resize(self.x, [self.wResized,self.hResized,1])
-        else:
-          self.x = np.expand_dims(cv2.resize(self.x, (self.wResized, self.hResized)), axis=3)
-        slicer.util.updateVolumeFromArray(self.node, self.x)
-        self.centroid = self.segment_image(self.Im)
+        # The operator chose this frame, it is segmented even if the gate would reject it
+        self.I = slicer.util.arrayFromVolume(self.imageNode)
+        self.detection = self.detectTip(self.I)
+        self.updateDetectorView()
+        self.centroid = self.detection.position
+        self.detectionLabel.setText(self.detectionText(self.detection))
+        self.isRestoringHistory = True
         self.fiducialNode.AddFiducialFromArray([self.centroid[0], self.centroid[1],0])
-        self.transformNode.GetMatrixTransformToWorld(self.tipToProbeTransform)
-        self.origin = [self.tipToProbeTransform.GetElement(0, 3), self.tipToProbeTransform.GetElement(1,3), self.tipToProbeTransform.GetElement(2,3)]
-        self.dir = [self.tipToProbeTransform.GetElement(0, 2), self.tipToProbeTransform.GetElement(1,2), self.tipToProbeTransform.GetElement(2,2)]
-        self.logic.AddPointAndLine([self.centroid[0],self.centroid[1],0], self.origin, self.dir)
-        self.imageToProbe = self.logic.registrationLogic.CalculateRegistration()
-        if self.dataStack is None: 
-          self.dataStack = [[self.centroid[0],self.centroid[1], self.origin, self.dir]]
-        else: 
-          self.dataStack.append([self.centroid[0],self.centroid[1], self.origin, self.dir])
-        for i in range (0,4): 
-          for j in range(0,4): 
-            self.transformTable.setValue(i,j,(self.imageToProbe.GetElement(i,j)))
-        slicer.app.layoutManager().sliceWidget("Red").sliceController().fitSliceToBackground()
-        if slicer.mrmlScene.GetNodesByClass("vtkMRMLSequenceNode").GetNumberOfItems() == 0:  
+        self.isRestoringHistory = False
+        self.addCorrespondence()
+        if self.sceneIndex.count("vtkMRMLSequenceNode") == 0:  
           self.connectorNode.Start()
           self.connectButton.text = "Disconnect"
           self.freezeButton.text = "(Place Fiducial ('f'))"
@@ -426,6 +637,9 @@ class GuidedUSCalWidget(ScriptedLoadableModuleWidget):
   def onMarkupAdded(self, fiducialNodeCaller, event):
     # Set the location and index to zero because its needs to be initialized
     self.centroid = [0,0,0]
+    if self.isRestoringHistory:
+      # Markups shown when restoring the history are not new correspondences
+      return
     if self.manual.isChecked() == True:
       # This checks if there is not a display node 
       # Do nothing if markup has not been placed
@@ -434,19 +648,74 @@ class GuidedUSCalWidget(ScriptedLoadableModuleWidget):
       # This saves the location the markup is place
       # Collect the point in image space
       self.fiducialNode.GetMarkupPoint(self.fiducialNode.GetNumberOfMarkups()-1, 0, self.centroid)
-      self.transformNode.GetMatrixTransformToWorld(self.tipToProbeTransform)
-      self.origin = [self.tipToProbeTransform.GetElement(0, 3), self.tipToProbeTransform.GetElement(1,3), self.tipToProbeTransform.GetElement(2,3)]
-      self.dir = [self.tipToProbeTransform.GetElement(0, 2), self.tipToProbeTransform.GetElement(1,2), self.tipToProbeTransform.GetElement(2,2)]
-      self.logic.AddPointAndLine([self.centroid[0],self.centroid[1],0], self.origin, self.dir)
-      self.imageToProbe = self.logic.registrationLogic.CalculateRegistration()
-      if self.dataStack is None: 
-        self.dataStack = [[self.centroid[0],self.centroid[1], self.origin, self.dir]]
-      else: 
-        self.dataStack.append([self.centroid[0],self.centroid[1], self.origin, self.dir])
-      for i in range (0,4): 
-        for j in range(0,4): 
-          self.transformTable.setValue(i,j,(self.imageToProbe.GetElement(i,j)))
-      slicer.app.layoutManager().sliceWidget("Red").sliceController().fitSliceToBackground()
+      self.addCorrespondence(manual=True)
+
+  def addCorrespondence(self, manual=False):
+    # Pair the current centroid with the needle line from the tip to probe transform
+    self.activeSession.getTipToProbe(self.tipToProbeTransform)
+    frame, sequenceNode = self.activeSession.currentImageItem()
+    self.activeSession.addCorrespondence(self.centroid, self.tipToProbeTransform, frame, manual)
+    self.updateCalibrationDisplay(False)
+
+  def updateDetectorView(self):
+    # Write the model input and the detected tip in place into the image shown by self.node
+    if self.detection is None or self.detection.modelInput is None:
+      return
+    x = self.detection.modelInput
+    w, h = self.detection.frameSize
+    self.detectorViewFrameSize = (w, h)
+    # Model input is indexed column first
+    image = x[:, :, 0].T
+    created = self.detectorView is None
+    if created:
+      self.detectorView = SharedImageBuffer(image.shape[0], image.shape[1])
+      self.node.SetAndObserveImageData(self.detectorView.imageData)
+      if self.node.GetDisplayNode() is None:
+        self.node.CreateDefaultDisplayNodes()
+    scaleX = image.shape[1] / float(w)
+    scaleY = image.shape[0] / float(h)
+    if self.detectorView.update(image, 255.0, [(self.detection.position[0] * scaleX, self.detection.position[1] * scaleY)]) or created:
+      self.updateDetectorViewGeometry()
+
+  def updateDetectorViewGeometry(self):
+    # Scale the image geometry so that the model input overlays the cropped ultrasound frame
+    if self.detectorView is None or self.imageNode is None or self.detectorViewFrameSize is None:
+      return
+    w, h = self.detectorViewFrameSize
+    ijkToRAS = vtk.vtkMatrix4x4()
+    self.imageNode.GetIJKToRASMatrix(ijkToRAS)
+    scale = vtk.vtkMatrix4x4()
+    scale.SetElement(0, 0, w / float(self.detectorView.shape[1]))
+    scale.SetElement(1, 1, h / float(self.detectorView.shape[0]))
+    vtk.vtkMatrix4x4.Multiply4x4(ijkToRAS, scale, ijkToRAS)
+    self.node.SetIJKToRASMatrix(ijkToRAS)
+
+  def onOverlayToggled(self, checked):
+    compositeNode = slicer.app.layoutManager().sliceWidget('Red').sliceLogic().GetSliceCompositeNode()
+    if checked:
+      compositeNode.SetForegroundVolumeID(self.node.GetID())
+      compositeNode.SetForegroundOpacity(0.5)
+    else:
+      compositeNode.SetForegroundVolumeID(None)
+
+  def updateCalibrationDisplay(self, showCurrentPoint=True):
+    # Keep the counter, step selector, transform table and fiducial in sync with the history
+    self.numFid = self.logic.history.count()
+    self.numFidLabel.setText(str(self.numFid))
+    wasBlocked = self.historySpinBox.blockSignals(True)
+    self.historySpinBox.setRange(0, self.logic.history.length)
+    self.historySpinBox.setValue(self.logic.history.step())
+    self.historySpinBox.blockSignals(wasBlocked)
+    self.undoButton.setEnabled(self.logic.history.canUndo())
+    self.redoButton.setEnabled(self.logic.history.canRedo())
+    self.transformTable.setValues(arrayFromMatrix(self.imageToProbe).ravel().tolist())
+    if showCurrentPoint and self.fiducialNode is not None:
+      self.isRestoringHistory = True
+      self.fiducialNode.RemoveAllMarkups()
+      point = self.logic.history.currentPoint()
+      if point is not None:
+        self.fiducialNode.AddFiducialFromArray([point[0], point[1], 0])
+      self.isRestoringHistory = False
 
   def onImageChanged(self):
     if self.imageNode is not None:
@@ -459,12 +728,17 @@ class GuidedUSCalWidget(ScriptedLoadableModuleWidget):
     else: 
       self.imageNode.GetDisplayNode().SetAutoWindowLevel(0)
       self.imageNode.GetDisplayNode().SetWindowLevelMinMax(0,120)
-      self.imageNode.SetName('Image_Probe') 
-      slicer.app.layoutManager().sliceWidget('Red').sliceLogic().GetSliceCompositeNode().SetBackgroundVolumeID(self.imageSelector.currentNode().GetID())
-      # Configure volume reslice driver, transverse
-      self.resliceLogic.SetDriverForSlice(self.imageNode.GetID(), slicer.mrmlScene.GetNodeByID('vtkMRMLSliceNodeRed'))
-      self.resliceLogic.SetModeForSlice(self.resliceLogic.MODE_TRANSVERSE, slicer.mrmlScene.GetNodeByID('vtkMRMLSliceNodeRed'))
-      slicer.app.layoutManager().sliceWidget("Red").sliceController().fitSliceToBackground()
+      self.imageNode.SetName(self.activeSession.imageName) 
+      self.showSessionImage()
+      self.updateDetectorViewGeometry()
+    self.updateTracking()
+
+  def showSessionImage(self):
+    slicer.app.layoutManager().sliceWidget('Red').sliceLogic().GetSliceCompositeNode().SetBackgroundVolumeID(self.imageNode.GetID())
+    # Configure volume reslice driver, transverse
+    self.resliceLogic.SetDriverForSlice(self.imageNode.GetID(), slicer.mrmlScene.GetNodeByID('vtkMRMLSliceNodeRed'))
+    self.resliceLogic.SetModeForSlice(self.resliceLogic.MODE_TRANSVERSE, slicer.mrmlScene.GetNodeByID('vtkMRMLSliceNodeRed'))
+    slicer.app.layoutManager().sliceWidget("Red").sliceController().fitSliceToBackground()
 
   def onTransformChanged(self):
     if self.transformNode is not None: 
@@ -477,8 +751,134 @@ class GuidedUSCalWidget(ScriptedLoadableModuleWidget):
     else:
       self.needleModel.SetAndObserveTransformNodeID(self.transformNode.GetID()) 
     
+  def onAddSessionButtonClicked(self):
+    number = len(self.sessions) + 1
+    self.sessions.append(CalibrationSession('Probe ' + str(number), 'Image_Probe_' + str(number)))
+    self.onGateSettingsChanged()
+    self.sessionComboBox.addItem(self.sessions[-1].name)
+    self.sessionComboBox.setCurrentIndex(len(self.sessions) - 1)
+
+  def onGateSettingsChanged(self, value=None):
+    # All probes use the same thresholds, they depend on the scanner settings
+    for session in self.sessions:
+      session.frameGate.brightThreshold = self.gateBrightSpinBox.value
+      session.frameGate.minSharpness = self.gateSharpnessSpinBox.value
+
+  def onSessionChanged(self, index):
+    if index < 0 or index >= len(self.sessions):
+      return
+    self.activeSession = self.sessions[index]
+    # Show the nodes of the new session without re-running the selection logic
+    for selector, node in [(self.imageSelector, self.imageNode), (self.TransformSelector, self.transformNode)]:
+      wasBlocked = selector.blockSignals(True)
+      selector.setCurrentNode(node)
+      selector.blockSignals(wasBlocked)
+    if self.transformNode is not None:
+      self.needleModel.SetAndObserveTransformNodeID(self.transformNode.GetID())
+    else:
+      self.needleModel.SetAndObserveTransformNodeID(None)
+    if self.imageNode is not None:
+      self.showSessionImage()
+      self.updateDetectorViewGeometry()
+    self.updateCalibrationDisplay()
+    self.updateGateLabel()
+    self.updateTimeOffsetLabel()
+    self.updateTracking()
+
+  def sessionSequences(self, session):
+    # Sequences played back (or recorded) into the transform and image nodes of the session
+    sequences = []
+    for proxyNode in [session.transformNode, session.imageNode]:
+      browser = self.sequenceLogic.GetFirstBrowserNodeForProxyNode(proxyNode) if proxyNode is not None else None
+      sequences.append(browser.GetSequenceNode(proxyNode) if browser is not None else None)
+    return sequences
+
+  def onTimeOffsetButtonClicked(self):
+    transformSequence, imageSequence = self.sessionSequences(self.activeSession)
+    if transformSequence is None or imageSequence is None:
+      print('Please select the image and tip to probe transform of a recorded sweep')
+      return
+    try:
+      self.activeSession.calibrateTime(transformSequence, imageSequence)
+    except ValueError as e:
+      logging.error('Temporal calibration failed: ' + str(e))
+      return
+    logging.info(self.activeSession.name + ": image lag " + str(self.activeSession.timeOffset) + " s")
+    self.updateTimeOffsetLabel()
+
+  def onExportLabelsButtonClicked(self):
+    # Frames of the recorded sweep shown for the session (if any) and the live frames kept when points were placed
+    session = self.activeSession
+    transformSequence, imageSequence = self.sessionSequences(session)
+    path = qt.QFileDialog.getSaveFileName(None, "Export Labeled Frames", "LabeledFrames.npz", "NumPy archive (*.npz)")
+    if not path:
+      return
+    try:
+      count = self.logic.ExportLabeledFrames(imageSequence, path, transformSequence, session.timeOffset, session.sequenceFramePoses(imageSequence))
+    except ValueError as e:
+      logging.error('Export of labeled frames failed: ' + str(e))
+      return
+    logging.info(str(count) + " labeled frames saved to " + path)
+
+  def onTrainingShardsButtonClicked(self):
+    paths = qt.QFileDialog.getOpenFileNames(None, "Labeled Frames Of The Sessions", "", "NumPy archive (*.npz)")
+    if not paths:
+      return
+    directory = qt.QFileDialog.getExistingDirectory(None, "Training Shard Directory")
+    if not directory:
+      return
+    try:
+      index = self.logic.WriteTrainingShards(paths, directory)
+    except ValueError as e:
+      logging.error('Unable to write training shards: ' + str(e))
+      return
+    logging.info(str(index['samples']) + " samples of " + str(len(paths)) + " sessions written to " + str(len(index['shards'])) + " shards in " + directory)
+
+  def updateTimeOffsetLabel(self):
+    if self.activeSession.framePoses is None:
+      self.timeOffsetLabel.setText("Not calibrated")
+    else:
+      self.timeOffsetLabel.setText("{0:.1f} ms (correlation {1:.2f}, {2} frames)".format(1000.0 * self.activeSession.timeOffset, self.activeSession.timeCorrelation, len(self.activeSession.framePoses)))
+
+  def updateGateLabel(self):
+    # Frames rejected by the gate of the active probe
+    self.gateLabel.setText(self.frameGate.summary())
+
+  def onDetectAllButtonClicked(self):
+    # Snapshot every probe's frame and pose on the main thread, detect on the shared worker pool
+    augment = self.augmentCheckBox.isChecked()
+    for session in self.sessions:
+      if session.imageNode is None or session.transformNode is None:
+        continue
+      frame = np.array(slicer.util.arrayFromVolume(session.imageNode))
+      if self.gateCheckBox.isChecked() and not session.frameGate.accept(frame):
+        continue
+      tipToProbeTransform = vtk.vtkMatrix4x4()
+      session.getTipToProbe(tipToProbeTransform)
+      item, sequenceNode = session.currentImageItem()
+      self.detectionScheduler.submit(frame, self.onScheduledDetection, (session, tipToProbeTransform, item), augment)
+    self.detectionScheduler.flush()
+    self.updateGateLabel()
+    if self.detectionScheduler.busy():
+      self.detectionTimer.start()
+
+  def onDetectionTimer(self):
+    self.detectionScheduler.processCompleted()
+    if not self.detectionScheduler.busy():
+      self.detectionTimer.stop()
+
+  def onScheduledDetection(self, detection, context):
+    session, tipToProbeTransform, item = context
+    session.addCorrespondence(detection.position, tipToProbeTransform, item)
+    logging.info(session.name + ": " + str(detection))
+    if session is self.activeSession:
+      self.detection = detection
+      self.centroid = detection.position
+      self.detectionLabel.setText(self.detectionText(detection))
+      self.updateCalibrationDisplay()
+
   def onInputChanged(self, string):
-    if slicer.mrmlScene.GetNodesByClass("vtkMRMLSequenceNode").GetNumberOfItems() == 0:
+    if self.sceneIndex.count("vtkMRMLSequenceNode") == 0:
       if re.match("\d{1,3}\.\d{1,3}\.\d{1,3}[^0-9]", self.inputIPLineEdit.text) and self.inputPortLineEdit.text != "" and int(self.inputPortLineEdit.text) > 0 and int(self.inputPortLineEdit.text) <= 65535:
         self.connectButton.enabled = True
         if self.connectorNode is not None:
@@ -487,7 +887,8 @@ class GuidedUSCalWidget(ScriptedLoadableModuleWidget):
         self.connectButton.enabled = True
         
   def onCopyButtonClicked(self):
-    self.outputTransform = str(self.imageToProbe.GetElement(0,0))+" "+ str(self.imageToProbe.GetElement(0,1))+" "+str(self.imageToProbe.GetElement(0,2))+" "+str(self.imageToProbe.GetElement(0,3))+ "\r\n"+str(self.imageToProbe.GetElement(1,0))+" "+str(self.imageToProbe.GetElement(1,1))+" "+str(self.imageToProbe.GetElement(1,2))+" "+str(self.imageToProbe.GetElement(1,3)) + "\r\n"+str(self.imageToProbe.GetElement(2,0))+" "+str(self.imageToProbe.GetElement(2,1))+" "+str(self.imageToProbe.GetElement(2,2))+" "+str(self.imageToProbe.GetElement(2,3))
+    rows = arrayFromMatrix(self.imageToProbe)[0:3]
+    self.outputTransform = "\r\n".join([" ".join([str(value) for value in row]) for row in rows.tolist()])
     clipboard.copy(self.outputTransform)
 
   def onRecordButtonClicked(self):
@@ -549,6 +950,12 @@ class GuidedUSCalWidget(ScriptedLoadableModuleWidget):
     if self.sceneObserverTag is not None:
       slicer.mrmlScene.RemoveObserver(self.sceneObserverTag)
       self.sceneObserverTag = None
+    if self.sceneRemovedObserverTag is not None:
+      slicer.mrmlScene.RemoveObserver(self.sceneRemovedObserverTag)
+      self.sceneRemovedObserverTag = None
+    if self.sceneClosedObserverTag is not None:
+      slicer.mrmlScene.RemoveObserver(self.sceneClosedObserverTag)
+      self.sceneClosedObserverTag = None
 
     if self.connectButton is not None:
       self.connectButton.disconnect('clicked(bool)', self.onConnectButtonClicked)
@@ -560,6 +967,12 @@ class GuidedUSCalWidget(ScriptedLoadableModuleWidget):
       self.inputPortLineEdit.disconnect('textChanged(QString)', self.onInputChanged)
     if self.imageSelector is not None:
       self.imageSelector.disconnect('currentNodeChanged(vtkMRMLNode*)', self.onImageChanged)
+    self.detectionTimer.stop()
+    self.detectionScheduler.shutdown()
+    if self.trackedImageObserverTag is not None:
+      self.trackedImageNode.RemoveObserver(self.trackedImageObserverTag)
+      self.trackedImageNode = None
+      self.trackedImageObserverTag = None
 
   def onVisualizeButtonClicked(self):
     if self.fiducialNode is not None:
@@ -579,56 +992,591 @@ class GuidedUSCalWidget(ScriptedLoadableModuleWidget):
       else:
         self.imageNode.SetAndObserveTransformNodeID(self.outputRegistrationTransformNode.GetID())
         self.outputRegistrationTransformNode.SetMatrixTransformToParent(self.imageToProbe)
+  def onReconstructButtonClicked(self):
+    session = self.activeSession
+    transformSequence, imageSequence = self.sessionSequences(session)
+    if transformSequence is None or imageSequence is None:
+      print('Please select the image and tip to probe transform of a recorded sweep')
+      return
+    # Lag corrected poses are reused when the same recording was temporally calibrated
+    framePoses = session.framePoses if session.imageSequence is not None and session.imageSequence.GetID() == imageSequence.GetID() else None
+    fillHoleIterations = 1 if self.fillHolesCheckBox.isChecked() else 0
+    startTime = time.time()
+    volume, origin, spacing = self.logic.ReconstructVolume(transformSequence, imageSequence, session.imageToProbe, session.timeOffset, self.reconstructionSpacingSpinBox.value, fillHoleIterations, framePoses)
+    if session.reconstructionNode is None or session.reconstructionNode.GetScene() is None:
+      session.reconstructionNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode')
+      session.reconstructionNode.SetName(slicer.mrmlScene.GetUniqueNameByString(session.name + ' Reconstruction'))
+      session.reconstructionNode.CreateDefaultDisplayNodes()
+    slicer.util.updateVolumeFromArray(session.reconstructionNode, volume)
+    session.reconstructionNode.SetOrigin(origin)
+    session.reconstructionNode.SetSpacing(spacing, spacing, spacing)
+    # The volume is in needle tip coordinates, the tip to probe transform puts it next to the calibrated image
+    session.reconstructionNode.SetAndObserveTransformNodeID(session.transformNode.GetID())
+    volumeRenderingLogic = slicer.modules.volumerendering.logic()
+    displayNode = volumeRenderingLogic.GetFirstVolumeRenderingDisplayNode(session.reconstructionNode)
+    if displayNode is None:
+      displayNode = volumeRenderingLogic.CreateDefaultVolumeRenderingNodes(session.reconstructionNode)
+    displayNode.SetVisibility(True)
+    self.reconstructionLabel.setText("{0} x {1} x {2} voxels of {3:.2f} mm in {4:.1f} s".format(volume.shape[2], volume.shape[1], volume.shape[0], spacing, time.time() - startTime))
+
   def onResetButtonClicked(self):
     slicer.mrmlScene.Clear(0)
   
-  def segment_image(self,x):
-      y = self.model.predict(np.expand_dims(self.x, axis=0)).T
-      # Scale predicted coordinates to pixel coordinate
-      y[0] = int((y[0] + 1.0) * (self.w/2))
-      y[1] = int((y[1] + 1.0) * (self.h/2))
-      # Reshape y to a row vector
-      y = np.squeeze(y.T, axis=0)
-      
-      return [y[0],y[1],0]
+  def detectionText(self, detection):
+    if detection.tracked:
+      quality = "correlation {0:.2f}".format(detection.confidence)
+    elif np.isnan(detection.confidence):
+      quality = "confidence not estimated"
+    else:
+      quality = "confidence {0:.2f}".format(detection.confidence)
+    return "{0:.1f}, {1:.1f} ({2}, {3:.1f} ms)".format(detection.position[0], detection.position[1], quality, 1000.0 * detection.inferenceTime)
+
+  def segment_image(self, image, topK=1):
+    # Returns a NeedleDetection with the sub-pixel tip location, confidence and candidates
+    return self.detector.detect(image, topK, self.augmentCheckBox.isChecked())
+
+  def detectTip(self, image):
+    # When tracking, the tracker has already located the tip in the shown frame
+    tracker = self.activeSession.tracker
+    if self.trackingCheckBox.isChecked() and tracker is not None and tracker.lastDetection is not None:
+      return tracker.lastDetection
+    return self.segment_image(image)
+
+  def onTrackingToggled(self, checked):
+    self.updateTracking()
+
+  def updateTracking(self):
+    # Follow the image of the active session while tracking is enabled, every new frame is tracked
+    if self.trackedImageObserverTag is not None:
+      self.trackedImageNode.RemoveObserver(self.trackedImageObserverTag)
+      self.trackedImageNode = None
+      self.trackedImageObserverTag = None
+    if not self.trackingCheckBox.isChecked() or self.imageNode is None:
+      return
+    if self.activeSession.tracker is None:
+      # Own detector, so that tracking keyframes do not share state with the scheduled detections, only the model and its lock
+      detector = NeedleDetector(self.model, self.wResized, self.hResized, predictLock=self.detector.predictLock)
+      self.activeSession.tracker = NeedleTracker(detector)
+    # Frames of another image may not continue the stream that was tracked
+    self.activeSession.tracker.reset()
+    self.activeSession.tracker.augment = self.augmentCheckBox.isChecked()
+    self.trackedImageNode = self.imageNode
+    self.trackedImageObserverTag = self.trackedImageNode.AddObserver(slicer.vtkMRMLVolumeNode.ImageDataModifiedEvent, self.onTrackedImageModified)
+    self.trackingLabel.setText(self.activeSession.tracker.summary())
+
+  def onAugmentToggled(self, checked):
+    # Keyframe detections of the trackers follow the setting, other detections read it when they are made
+    for session in self.sessions:
+      if session.tracker is not None:
+        session.tracker.augment = checked
+
+  def onTrackedImageModified(self, caller, event):
+    tracker = self.activeSession.tracker
+    self.detection = tracker.track(slicer.util.arrayFromVolume(self.trackedImageNode))
+    self.centroid = self.detection.position
+    if not self.detection.tracked:
+      self.updateDetectorView()
+    self.detectionLabel.setText(self.detectionText(self.detection))
+    self.trackingLabel.setText(tracker.summary())
   
   def onUndoButtonClicked(self):
-    self.logic.registrationLogic.Reset() 
-    if self.redoStack is None: 
-      self.redoStack = [self.dataStack[-1]] 
-    else: 
-      self.redoStack.append(self.dataStack[-1])
-    self.dataStack.pop(-1)
-    for i in range(0,len(self.dataStack)):
-      self.logic.AddPointAndLine([self.dataStack[i][0],self.dataStack[i][1],0], self.dataStack[i][2], self.dataStack[i][3])
-      self.imageToProbe = self.logic.registrationLogic.CalculateRegistration()
-    self.numFid = self.numFid -1 
-    self.numFidLabel.setText(self.numFid)
-    self.fiducialNode.RemoveAllMarkups()
-    for i in range (0,4): 
-      for j in range(0,4): 
-        self.transformTable.setValue(i,j,(self.imageToProbe.GetElement(i,j)))
+    if not self.logic.Undo():
+      print('There is nothing to undo')
+      return
+    self.imageToProbe = self.logic.GetRegistration()
+    self.updateCalibrationDisplay()
+
   def onRedoButtonClicked(self):
-    self.logic.registrationLogic.Reset() 
-    if self.redoStack is not None:
-      self.dataStack.append(self.redoStack[-1])
-    else: 
+    if not self.logic.Redo():
       print('There is nothing to redo')
-    self.redoStack.pop(-1)
-    for i in range(0,len(self.dataStack)):
-      self.logic.AddPointAndLine([self.dataStack[i][0],self.dataStack[i][1],0], self.dataStack[i][2], self.dataStack[i][3])
-      self.imageToProbe = self.logic.registrationLogic.CalculateRegistration()
-    self.numFid = self.numFid +1 
-    self.numFidLabel.setText(self.numFid)
-    self.fiducialNode.AddFiducialFromArray([self.dataStack[i][0],self.dataStack[i][1],0]) 
-    for i in range (0,4): 
-      for j in range(0,4): 
-        self.transformTable.setValue(i,j,(self.imageToProbe.GetElement(i,j)))
+      return
+    self.imageToProbe = self.logic.GetRegistration()
+    self.updateCalibrationDisplay()
+
+  def onHistoryStepChanged(self, step):
+    if not self.logic.JumpToStep(step):
+      return
+    self.imageToProbe = self.logic.GetRegistration()
+    self.updateCalibrationDisplay()
+
 class GuidedUSCalLogic(ScriptedLoadableModuleLogic):
   def __init__(self):
-    self.registrationLogic = slicer.vtkSlicerPointToLineRegistrationLogic()
-    self.registrationLogic.SetLandmarkRegistrationModeToAnisotropic()
-  def AddPointAndLine(self, point, lineOrigin, lineDirection):
-    self.registrationLogic.AddPointAndLine(point, lineOrigin, lineDirection)
-    
-  
+    self.history = CalibrationHistory()
+    # Registration logics holding the correspondences up to a history step, by step, the most recently used last
+    self.solvers = collections.OrderedDict()
+    self.maxSolvers = 4
+    # Copies of the live frames manual points were placed on, by history step
+    self.liveSamples = {}
+  def CreateSolver(self):
+    solver = slicer.vtkSlicerPointToLineRegistrationLogic()
+    solver.SetLandmarkRegistrationModeToAnisotropic()
+    return solver
+  def AddCorrespondence(self, point, lineOrigin, lineDirection, frame=-1, manual=False):
+    # Adding to the end of a branch continues with its solver, only a new branch (adding after an undo or
+    # jump) needs a solver filled with the correspondences up to where it starts
+    solver = self.solvers.pop(self.history.step(), None)
+    if solver is None:
+      solver = self.CreateSolver()
+      points, origins, directions = self.history.activeCorrespondences()
+      for i in range(0, len(points)):
+        solver.AddPointAndLine(points[i], origins[i], directions[i])
+    solver.AddPointAndLine(point, lineOrigin, lineDirection)
+    registration = solver.CalculateRegistration()
+    self.history.add(point, lineOrigin, lineDirection, arrayFromMatrix(registration), frame, manual)
+    self.solvers[self.history.step()] = solver
+    if len(self.solvers) > self.maxSolvers:
+      self.solvers.popitem(last=False)
+    return self.GetRegistration()
+  def GetRegistration(self):
+    # Cached registration of the current history step
+    return matrixFromArray(self.history.registration())
+  def GetSequenceTimes(self, sequenceNode):
+    # Index values of a recording are timestamps in seconds
+    return sequenceTimes(sequenceNode)
+  def GetSequenceMatrices(self, sequenceNode):
+    return matricesFromSequence(sequenceNode)
+  def EstimateTimeOffset(self, transformSequence, imageSequence, maxOffset=0.5):
+    # Returns the delay of the images (s), the correlation of the motion signals and the pose of every frame
+    trackerTimes = self.GetSequenceTimes(transformSequence)
+    matrices = self.GetSequenceMatrices(transformSequence)
+    imageTimes = self.GetSequenceTimes(imageSequence)
+    frames = (slicer.util.arrayFromVolume(imageSequence.GetNthDataNode(i)) for i in range(0, len(imageTimes)))
+    imageSignalTimes, imageSignal = TemporalCalibration.imageMotionSignal(imageTimes, frames)
+    trackerSignalTimes, trackerSignal = TemporalCalibration.trackerMotionSignal(trackerTimes, matrices)
+    offset, correlation = TemporalCalibration.estimateTimeOffset(imageSignalTimes, imageSignal, trackerSignalTimes, trackerSignal, maxOffset)
+    return offset, correlation, TemporalCalibration.framePoses(imageTimes, trackerTimes, matrices, offset)
+  def ReconstructVolume(self, transformSequence, imageSequence, imageToProbe, timeOffset=0.0, spacing=0.5, fillHoleIterations=1, framePoses=None):
+    # Reconstructs the recorded frames in needle tip coordinates, returns the volume array, origin and spacing
+    imageTimes = self.GetSequenceTimes(imageSequence)
+    if framePoses is None:
+      framePoses = TemporalCalibration.framePoses(imageTimes, self.GetSequenceTimes(transformSequence), self.GetSequenceMatrices(transformSequence), timeOffset)
+    imageToProbeArray = arrayFromMatrix(imageToProbe)
+    firstImage = imageSequence.GetNthDataNode(0)
+    ijkToRAS = vtk.vtkMatrix4x4()
+    firstImage.GetIJKToRASMatrix(ijkToRAS)
+    ijkToRASArray = arrayFromMatrix(ijkToRAS)
+    # pixel -> image -> probe -> needle tip, frame poses are tip to probe
+    pixelToTip = np.matmul(np.linalg.inv(framePoses), imageToProbeArray.dot(ijkToRASArray))
+    frameShape = slicer.util.arrayFromVolume(firstImage).shape[1:3]
+    reconstructor = VolumeReconstructor(spacing, fillHoleIterations=fillHoleIterations)
+    return reconstructor.reconstruct(lambda i: slicer.util.arrayFromVolume(imageSequence.GetNthDataNode(i))[0], pixelToTip, frameShape)
+  def AddLiveSample(self, imageNode, point, tipToProbe):
+    # Keep the live frame of the last step with the point in pixels, live frames are not recorded anywhere else
+    rasToIJK = vtk.vtkMatrix4x4()
+    imageNode.GetRASToIJKMatrix(rasToIJK)
+    label = np.array(rasToIJK.MultiplyPoint([point[0], point[1], point[2], 1])[0:2])
+    frame = slicer.util.arrayFromVolume(imageNode)[0].copy()
+    self.liveSamples[self.history.step()] = (frame, label, np.array(tipToProbe), np.array(imageNode.GetSpacing()[0:2]))
+  def LabeledSamples(self, imageSequence=None, transformSequence=None, timeOffset=0.0, framePoses=None):
+    # Frames of the active manual steps with the point in pixels, the tip to probe pose and the pixel spacing of each
+    # Poses of recorded frames are framePoses if given, otherwise interpolated from transformSequence (NaN without it)
+    frames = []
+    labels = []
+    poses = []
+    spacings = []
+    if imageSequence is not None:
+      items, points = self.history.labeledFrames()
+      selected = items < imageSequence.GetNumberOfDataNodes()
+      items = items[selected]
+      points = points[selected]
+      if framePoses is not None:
+        poses.extend(list(framePoses[items]))
+      elif transformSequence is not None and len(items) > 0:
+        imageTimes = sequenceTimes(imageSequence)[items]
+        poses.extend(list(TemporalCalibration.framePoses(imageTimes, sequenceTimes(transformSequence), matricesFromSequence(transformSequence), timeOffset)))
+      else:
+        poses.extend([np.full((4, 4), np.nan)] * len(items))
+      rasToIJK = vtk.vtkMatrix4x4()
+      for i, item in enumerate(items):
+        imageNode = imageSequence.GetNthDataNode(int(item))
+        frames.append(slicer.util.arrayFromVolume(imageNode)[0])
+        imageNode.GetRASToIJKMatrix(rasToIJK)
+        labels.append(rasToIJK.MultiplyPoint([points[i][0], points[i][1], points[i][2], 1])[0:2])
+        spacings.append(imageNode.GetSpacing()[0:2])
+    for step in self.history.liveLabeledSteps():
+      if step in self.liveSamples:
+        frame, label, pose, spacing = self.liveSamples[step]
+        frames.append(frame)
+        labels.append(label)
+        poses.append(pose)
+        spacings.append(spacing)
+    return frames, np.array(labels).reshape(-1, 2), np.array(poses).reshape(-1, 4, 4), np.array(spacings).reshape(-1, 2)
+  def ExportLabeledFrames(self, imageSequence, path, transformSequence=None, timeOffset=0.0, framePoses=None):
+    # Saves the labeled samples, for evaluating needle detectors and as a session of the training shards
+    frames, labels, poses, spacings = self.LabeledSamples(imageSequence, transformSequence, timeOffset, framePoses)
+    # Recorded and live frames are stacked into one array, the labels are in pixels so frames are not resized
+    shapes = sorted(set(frame.shape for frame in frames))
+    if len(shapes) > 1:
+      raise ValueError("Labeled frames have different sizes (" + ", ".join("x".join(str(n) for n in reversed(shape)) for shape in shapes) + " pixels), place the points of one session on images of one size")
+    np.savez_compressed(path, frames=np.array(frames), labels=labels, poses=poses, spacing=spacings)
+    return len(frames)
+  def WriteTrainingShards(self, paths, directory, shardSize=256, maxWorkers=None):
+    # Shuffles the exported sessions into shards on a process pool, returns the shard index
+    return TrainingShards.writeShards(paths, directory, shardSize, maxWorkers=maxWorkers)
+  def Undo(self):
+    return self.history.undo()
+  def Redo(self):
+    return self.history.redo()
+  def JumpToStep(self, step):
+    return self.history.jumpTo(step)
+
+class GuidedUSCalTest(ScriptedLoadableModuleTest):
+  # Model that regresses the brightest pixel of its input, optionally with noise
+  class BrightestPixelModel(object):
+    def __init__(self, noise):
+      self.noise = noise
+      self.random = np.random.RandomState(0)
+      self.predictions = 0
+    def predict(self, inputs):
+      self.predictions += 1
+      tips = np.array([np.unravel_index(np.argmax(x[:, :, 0]), x.shape[0:2]) for x in inputs], dtype=np.float64)
+      return 2.0 * tips / inputs.shape[1:3] - 1.0 + self.random.normal(0, self.noise, tips.shape)
+
+  def setUp(self):
+    slicer.mrmlScene.Clear(0)
+
+  def runTest(self):
+    self.setUp()
+    self.test_CalibrationHistory()
+    self.test_SceneNodeIndex()
+    self.test_TemporalCalibration()
+    self.test_DetectorEvaluation()
+    self.test_VolumeReconstructor()
+    self.test_TransformUtils()
+    self.test_TrainingShards()
+    self.test_NeedleTracker()
+    self.test_DetectionScheduler()
+    self.test_ExportLabeledFrames()
+    self.test_FrameGate()
+    self.test_SharedImageBuffer()
+    self.test_SessionSwitch()
+
+  def test_CalibrationHistory(self):
+    self.delayDisplay("Starting the calibration history test")
+    history = CalibrationHistory(capacity=2)
+    for i in range(0, 5):
+      history.add([i, i, 0], [0, 0, i], [0, 0, 1], np.eye(4) * (i + 1))
+    self.assertEqual(history.count(), 5)
+    self.assertTrue(history.undo())
+    self.assertTrue(history.undo())
+    self.assertEqual(history.count(), 3)
+    self.assertEqual(history.registration()[0, 0], 3)
+    self.assertTrue(history.redo())
+    self.assertEqual(history.currentPoint()[0], 3)
+    self.assertTrue(history.jumpTo(1))
+    self.assertEqual(history.registration()[0, 0], 1)
+    # Adding after going back starts a new branch, the old one stays reachable
+    history.add([9, 9, 0], [0, 0, 9], [0, 0, 1], np.eye(4) * 9)
+    self.assertEqual(history.length, 6)
+    self.assertEqual(history.count(), 2)
+    self.assertFalse(history.canRedo())
+    np.testing.assert_array_equal(history.activeCorrespondences()[0][:, 0], [0, 9])
+    self.assertTrue(history.jumpTo(4))
+    self.assertEqual(history.count(), 4)
+    np.testing.assert_array_equal(history.activeCorrespondences()[0][:, 0], [0, 1, 2, 3])
+    # Redo returns to the step that was undone
+    self.assertTrue(history.undo())
+    self.assertTrue(history.redo())
+    self.assertEqual(history.step(), 4)
+    self.assertFalse(history.jumpTo(7))
+    self.delayDisplay('Test passed!')
+
+  def test_SceneNodeIndex(self):
+    self.delayDisplay("Starting the scene node index test")
+    index = SceneNodeIndex(["vtkMRMLSequenceNode", "vtkMRMLSequenceBrowserNode"])
+    first = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSequenceNode")
+    index.rebuild(slicer.mrmlScene)
+    self.assertEqual(index.count("vtkMRMLSequenceNode"), 1)
+    observerTags = [slicer.mrmlScene.AddObserver(slicer.mrmlScene.NodeAddedEvent, vtk.calldata_type(vtk.VTK_OBJECT)(lambda caller, event, node: index.nodeAdded(node))),
+                    slicer.mrmlScene.AddObserver(slicer.mrmlScene.NodeRemovedEvent, vtk.calldata_type(vtk.VTK_OBJECT)(lambda caller, event, node: index.nodeRemoved(node)))]
+    try:
+      second = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSequenceNode")
+      slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSequenceBrowserNode")
+      slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+      self.assertEqual(index.count("vtkMRMLSequenceNode"), 2)
+      self.assertEqual(index.count("vtkMRMLSequenceBrowserNode"), 1)
+      self.assertEqual(index.count("vtkMRMLScalarVolumeNode"), 0)
+      slicer.mrmlScene.RemoveNode(first)
+      self.assertEqual(index.nodes("vtkMRMLSequenceNode"), [second])
+      self.assertEqual(index.firstNode("vtkMRMLSequenceNode"), second)
+    finally:
+      for tag in observerTags:
+        slicer.mrmlScene.RemoveObserver(tag)
+    self.delayDisplay('Test passed!')
+
+  def test_TemporalCalibration(self):
+    self.delayDisplay("Starting the temporal calibration test")
+    # Probe swept along y at 100 Hz, the same motion seen in the images 80 ms late
+    trackerTimes = np.arange(0, 10, 0.01)
+    matrices = np.tile(np.eye(4), (len(trackerTimes), 1, 1))
+    matrices[:, 1, 3] = 20 * np.sin(2 * np.pi * 0.5 * trackerTimes + 0.3 * np.sin(0.7 * trackerTimes))
+    signalTimes, trackerSignal = TemporalCalibration.trackerMotionSignal(trackerTimes, matrices)
+    offset, correlation = TemporalCalibration.estimateTimeOffset(signalTimes + 0.08, trackerSignal, signalTimes, trackerSignal)
+    self.assertAlmostEqual(offset, 0.08, delta=0.005)
+    self.assertGreater(correlation, 0.9)
+    poses = TemporalCalibration.framePoses([0.105], trackerTimes, matrices, 0.1)
+    self.assertAlmostEqual(poses[0, 1, 3], 0.5 * (matrices[0, 1, 3] + matrices[1, 1, 3]))
+    self.delayDisplay('Test passed!')
+
+  def test_DetectorEvaluation(self):
+    self.delayDisplay("Starting the detector evaluation test")
+    frames = np.zeros((8, 69, 64), np.uint8)
+    labels = np.column_stack([np.arange(8) * 8, np.arange(8) * 7])
+    frames[np.arange(8), labels[:, 1], labels[:, 0]] = 255
+    detectors = [('exact', NeedleDetector(self.BrightestPixelModel(0.0), 64, 64)), ('noisy', NeedleDetector(self.BrightestPixelModel(0.5), 64, 64))]
+    results = DetectorEvaluation.evaluateDetectors(detectors, list(frames), labels, tolerance=0.5, batchSize=3)
+    exact = [result for result in results if result['name'] == 'exact'][0]
+    self.assertAlmostEqual(exact['p95Error'], 0.0)
+    self.assertTrue(exact['pareto'])
+    self.assertEqual(DetectorEvaluation.fastestWithinTolerance(results, 0.5)['name'], 'exact')
+    self.delayDisplay('Test passed!')
+
+  def test_VolumeReconstructor(self):
+    self.delayDisplay("Starting the volume reconstruction test")
+    # 10 x 10 pixel frames of 1 mm pixels in the x-z plane, swept along y every 2 mm, with the intensity equal to y
+    pixelToReference = np.tile(np.array([[1.0, 0, 0, 0], [0, 0, 0, 0], [0, 1.0, 0, 0], [0, 0, 0, 1.0]]), (5, 1, 1))
+    pixelToReference[:, 1, 3] = np.arange(5) * 2.0
+    reconstructor = VolumeReconstructor(spacing=1.0, chunkSize=2, maxWorkers=2, fillHoleIterations=0)
+    volume, origin, spacing = reconstructor.reconstruct(lambda i: np.full((10, 10), 2.0 * i), pixelToReference, (10, 10))
+    self.assertEqual(volume.shape, (10, 9, 10))
+    np.testing.assert_allclose(volume[:, 0::2, :], np.tile(np.arange(5) * 2.0, (10, 10, 1)).transpose(0, 2, 1))
+    reconstructor.fillHoleIterations = 1
+    volume, origin, spacing = reconstructor.reconstruct(lambda i: np.full((10, 10), 2.0 * i), pixelToReference, (10, 10))
+    # Slices between two frames get the mean of both
+    np.testing.assert_allclose(volume[:, 1::2, :], np.tile(np.arange(4) * 2.0 + 1.0, (10, 10, 1)).transpose(0, 2, 1))
+    self.delayDisplay('Test passed!')
+
+  def test_TransformUtils(self):
+    self.delayDisplay("Starting the transform utilities test")
+    matrix = vtk.vtkMatrix4x4()
+    matrix.SetElement(0, 3, 10.0)
+    matrix.SetElement(1, 2, -1.0)
+    array = arrayFromMatrix(matrix)
+    self.assertEqual(array[0, 3], 10.0)
+    self.assertEqual(array[1, 2], -1.0)
+    array[2, 3] = 5.0
+    self.assertEqual(updateMatrixFromArray(matrix, array).GetElement(2, 3), 5.0)
+    # Translation only, the workspace array keeps its rotation
+    workspace = np.eye(4)
+    updateMatrixFromTranslation(matrix, [1.0, 2.0, 3.0], workspace)
+    np.testing.assert_array_equal(arrayFromMatrix(matrix)[0:3, 3], [1.0, 2.0, 3.0])
+    self.assertEqual(matrix.GetElement(1, 2), 0.0)
+    # All items of a transform sequence at once
+    sequenceNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSequenceNode")
+    transformNode = slicer.vtkMRMLLinearTransformNode()
+    for i in range(0, 3):
+      array[0, 3] = i
+      transformNode.SetMatrixTransformToParent(matrixFromArray(array))
+      sequenceNode.SetDataNodeAtValue(transformNode, str(0.1 * i))
+    matrices = matricesFromSequence(sequenceNode)
+    self.assertEqual(matrices.shape, (3, 4, 4))
+    np.testing.assert_allclose(matrices[:, 0, 3], [0, 1, 2])
+    np.testing.assert_allclose(sequenceTimes(sequenceNode), [0, 0.1, 0.2])
+    slicer.mrmlScene.RemoveNode(sequenceNode)
+    self.delayDisplay('Test passed!')
+
+  def test_TrainingShards(self):
+    self.delayDisplay("Starting the training shards test")
+    directory = os.path.join(slicer.app.temporaryPath, "GuidedUSCalTrainingShards")
+    paths = []
+    for session, count in enumerate([7, 0, 13]):
+      # Frame i of a session has its label and pose translation set to (i, session)
+      frames = np.zeros((count, 16, 16), np.uint8)
+      frames[:, 0, 0] = np.arange(count)
+      frames[:, 0, 1] = session
+      poses = np.tile(np.eye(4), (count, 1, 1))
+      poses[:, 0, 3] = session
+      path = os.path.join(slicer.app.temporaryPath, "GuidedUSCalSession" + str(session) + ".npz")
+      np.savez_compressed(path, frames=frames, labels=np.column_stack([np.arange(count), np.full(count, session)]), poses=poses, spacing=np.array([0.1, 0.1]))
+      paths.append(path)
+    index = TrainingShards.writeShards(paths, os.path.join(directory, "shards"), shardSize=8, maxWorkers=2)
+    self.assertEqual([shard['samples'] for shard in index['shards']], [8, 8, 4])
+    self.assertEqual([session['samples'] for session in index['sessions']], [7, 0, 13])
+    samples = []
+    for frames, labels, poses in TrainingShards.readShards(os.path.join(directory, "shards"), batchSize=6, seed=0):
+      np.testing.assert_array_equal(frames[:, 0, 0:2], labels)
+      np.testing.assert_array_equal(poses[:, 0, 3], labels[:, 1])
+      samples.extend([tuple(label) for label in labels.tolist()])
+    # Every sample exactly once
+    self.assertEqual(sorted(samples), sorted([(i, 0) for i in range(7)] + [(i, 2) for i in range(13)]))
+    self.delayDisplay('Test passed!')
+
+  def test_NeedleTracker(self):
+    self.delayDisplay("Starting the needle tracker test")
+    # Bright tip moving 0.7 and 0.6 pixels per frame over a noisy background
+    random = np.random.RandomState(0)
+    rows, columns = np.mgrid[0:69, 0:64]
+    tips = np.column_stack([10 + 0.7 * np.arange(35), 12 + 0.6 * np.arange(35)])
+    model = self.BrightestPixelModel(0.0)
+    tracker = NeedleTracker(NeedleDetector(model, 64, 64), maxInterval=10)
+    errors = []
+    for x, y in tips:
+      frame = 40 + 10 * random.rand(69, 64) + 200 * np.exp(-((columns - x) ** 2 + (rows - y) ** 2) / 8.0)
+      detection = tracker.track(frame.astype(np.uint8)[np.newaxis])
+      errors.append(np.linalg.norm(np.array(detection.position[0:2]) - [x, y]))
+    # The model only runs on every 10th frame
+    self.assertEqual(model.predictions, 4)
+    self.assertEqual(tracker.reasonCounts[NeedleTracker.INTERVAL], 3)
+    self.assertLess(max(errors), 1.5)
+    # A frame far from the prediction is detected again
+    frame = np.zeros((69, 64), np.uint8)
+    frame[50, 20] = 255
+    self.assertFalse(tracker.track(frame).tracked)
+    self.assertEqual(tracker.reasonCounts[NeedleTracker.LOST], 1)
+    self.delayDisplay('Test passed!')
+
+  def test_DetectionScheduler(self):
+    self.delayDisplay("Starting the detection scheduler test")
+    frames = np.zeros((5, 69, 64), np.uint8)
+    frames[np.arange(5), 10 + 5 * np.arange(5), 20] = 255
+    scheduler = DetectionScheduler(NeedleDetector(self.BrightestPixelModel(0.0), 64, 64), maxBatchSize=2)
+    detections = {}
+    for i in range(0, 5):
+      scheduler.submit(frames[i], lambda detection, i: detections.__setitem__(i, detection), i, augment=(i % 2 == 1))
+    scheduler.flush()
+    startTime = time.time()
+    while scheduler.busy() and time.time() - startTime < 10:
+      scheduler.processCompleted()
+      time.sleep(0.01)
+    self.assertEqual(sorted(detections.keys()), list(range(0, 5)))
+    for i, detection in detections.items():
+      # Every detection carries its own model input, only augmented ones estimate the confidence
+      self.assertEqual(detection.frameSize, (64, 64))
+      self.assertEqual(np.argmax(detection.modelInput[20, :, 0]), 10 + 5 * i)
+      self.assertEqual(np.isnan(detection.confidence), i % 2 == 0)
+    scheduler.shutdown()
+    self.assertFalse(scheduler.busy())
+    self.delayDisplay('Test passed!')
+
+  def test_ExportLabeledFrames(self):
+    self.delayDisplay("Starting the labeled frame export test")
+    logic = GuidedUSCalLogic()
+    imageSequence = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSequenceNode")
+    imageNode = slicer.vtkMRMLScalarVolumeNode()
+    for i in range(0, 2):
+      slicer.util.updateVolumeFromArray(imageNode, np.full((1, 16, 20), i, np.uint8))
+      imageSequence.SetDataNodeAtValue(imageNode, str(0.1 * i))
+    liveNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+    path = os.path.join(slicer.app.temporaryPath, "GuidedUSCalLabeledFrames.npz")
+    if os.path.exists(path):
+      os.remove(path)
+    try:
+      # One point on a recorded frame and one on a live frame of another size
+      logic.history.add([1, 2, 0], [0, 0, 0], [0, 0, 1], np.eye(4), 1, True)
+      logic.history.add([3, 4, 0], [0, 0, 0], [0, 0, 1], np.eye(4), -1, True)
+      slicer.util.updateVolumeFromArray(liveNode, np.zeros((1, 12, 10), np.uint8))
+      logic.AddLiveSample(liveNode, [3, 4, 0], np.eye(4))
+      with self.assertRaises(ValueError):
+        logic.ExportLabeledFrames(imageSequence, path)
+      self.assertFalse(os.path.exists(path))
+      # The live frame of the same size as the recorded ones is exported with them
+      slicer.util.updateVolumeFromArray(liveNode, np.full((1, 16, 20), 7, np.uint8))
+      logic.AddLiveSample(liveNode, [3, 4, 0], np.eye(4))
+      self.assertEqual(logic.ExportLabeledFrames(imageSequence, path), 2)
+      with np.load(path) as data:
+        self.assertEqual(data['frames'].shape, (2, 16, 20))
+        np.testing.assert_array_equal(data['frames'][:, 0, 0], [1, 7])
+        np.testing.assert_allclose(data['labels'], [[1, 2], [3, 4]])
+    finally:
+      slicer.mrmlScene.RemoveNode(imageSequence)
+      slicer.mrmlScene.RemoveNode(liveNode)
+    self.delayDisplay('Test passed!')
+
+  def test_FrameGate(self):
+    self.delayDisplay("Starting the frame gate test")
+    gate = FrameGate()
+    random = np.random.RandomState(0)
+    # Speckle with a bright needle echo
+    frame = random.randint(0, 100, (128, 128)).astype(np.uint8)
+    frame[60:62, 20:100] = 255
+    # Smooth blob, bright enough to be a needle but without detail
+    y, x = np.mgrid[0:128, 0:128]
+    blurred = (255 * np.exp(-((x - 64) ** 2 + (y - 64) ** 2) / (2 * 8.0 ** 2))).astype(np.uint8)
+    moved = random.randint(0, 100, (128, 128)).astype(np.uint8)
+    moved[62:64, 20:100] = 255
+    frames = [(frame, FrameGate.ACCEPTED),
+              (np.zeros((128, 128), np.uint8), FrameGate.NO_NEEDLE),
+              (np.full((128, 128), 255, np.uint8), FrameGate.SATURATED),
+              (blurred, FrameGate.BLURRED),
+              (frame.copy(), FrameGate.UNCHANGED),
+              (moved[np.newaxis], FrameGate.ACCEPTED)]
+    for image, reason in frames:
+      self.assertEqual(gate.accept(image), reason == FrameGate.ACCEPTED)
+      self.assertEqual(gate.lastReason, reason)
+    self.assertEqual(gate.reasonCounts, {FrameGate.ACCEPTED: 2, FrameGate.NO_NEEDLE: 1, FrameGate.SATURATED: 1, FrameGate.BLURRED: 1, FrameGate.UNCHANGED: 1})
+    self.assertAlmostEqual(gate.rejectionRate(), 4.0 / 6.0)
+    self.assertEqual(gate.summary(), "4 of 6 (66.7%) - no needle: 1, saturated: 1, blurred: 1, unchanged: 1")
+    gate.reset()
+    self.assertEqual(gate.summary(), "0 of 0 (0.0%)")
+    self.delayDisplay('Test passed!')
+
+  def test_SharedImageBuffer(self):
+    self.delayDisplay("Starting the shared image buffer test")
+    from vtk.util import numpy_support
+    buffer = SharedImageBuffer(4, 6)
+    imageData = buffer.imageData
+    scalars = imageData.GetPointData().GetScalars()
+    # The image data shows the NumPy update without being reallocated
+    image = np.arange(24).reshape(4, 6)
+    self.assertFalse(buffer.update(image, 2.0))
+    self.assertIs(imageData.GetPointData().GetScalars(), scalars)
+    self.assertTrue(np.shares_memory(numpy_support.vtk_to_numpy(scalars), buffer.array))
+    np.testing.assert_array_equal(numpy_support.vtk_to_numpy(scalars).reshape(4, 6), image * 2)
+    self.assertEqual(imageData.GetDimensions(), (6, 4, 1))
+    # Markers are drawn into the same memory
+    buffer.update(np.zeros((4, 6)), markers=[(2, 1)], markerRadius=1)
+    self.assertEqual(numpy_support.vtk_to_numpy(scalars).reshape(4, 6)[1, 2], 255)
+    # Another shape reallocates the scalars of the same image data
+    self.assertTrue(buffer.update(np.ones((3, 5))))
+    self.assertIs(buffer.imageData, imageData)
+    self.assertIsNot(imageData.GetPointData().GetScalars(), scalars)
+    self.assertEqual(imageData.GetDimensions(), (5, 3, 1))
+    self.assertEqual(buffer.shape, (3, 5))
+    np.testing.assert_array_equal(numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars()), np.ones(15))
+    self.delayDisplay('Test passed!')
+
+  def test_SessionSwitch(self):
+    self.delayDisplay("Starting the session switch test")
+    widget = slicer.modules.guideduscal.widgetRepresentation().self()
+    numberOfSessions = len(widget.sessions)
+    widget.onAddSessionButtonClicked()
+    widget.onAddSessionButtonClicked()
+    first, second = widget.sessions[-2:]
+    try:
+      # Each probe gets its own points, registration and rejected frames
+      first.logic.history.add([10, 20, 0], [0, 0, 0], [0, 0, 1], np.diag([2.0, 2.0, 2.0, 1.0]), manual=True)
+      first.imageToProbe = first.logic.GetRegistration()
+      first.frameGate.accept(np.zeros((32, 32), np.uint8))
+      for point in [[5, 6, 0], [7, 8, 0]]:
+        second.logic.history.add(point, [0, 0, 0], [0, 0, 1], np.diag([3.0, 3.0, 3.0, 1.0]), manual=True)
+      second.imageToProbe = second.logic.GetRegistration()
+
+      widget.sessionComboBox.setCurrentIndex(len(widget.sessions) - 2)
+      self.assertIs(widget.activeSession, first)
+      self.assertIs(widget.logic, first.logic)
+      self.assertEqual(widget.numFidLabel.text, "1")
+      np.testing.assert_allclose(slicer.util.arrayFromMarkupsControlPoints(widget.fiducialNode), [[10, 20, 0]])
+      self.assertEqual(widget.transformTable.value(0, 0), 2.0)
+      self.assertTrue(widget.gateLabel.text.startswith("1 of 1"))
+
+      widget.sessionComboBox.setCurrentIndex(len(widget.sessions) - 1)
+      self.assertIs(widget.activeSession, second)
+      self.assertEqual(widget.numFidLabel.text, "2")
+      np.testing.assert_allclose(slicer.util.arrayFromMarkupsControlPoints(widget.fiducialNode), [[7, 8, 0]])
+      self.assertEqual(widget.transformTable.value(0, 0), 3.0)
+      self.assertEqual(widget.gateLabel.text, "0 of 0 (0.0%)")
+      # Switching back does not mix the sessions
+      widget.sessionComboBox.setCurrentIndex(len(widget.sessions) - 2)
+      self.assertEqual(first.logic.history.count(), 1)
+      self.assertEqual(second.logic.history.count(), 2)
+      self.assertEqual(arrayFromMatrix(first.imageToProbe)[0, 0], 2.0)
+      self.assertEqual(arrayFromMatrix(second.imageToProbe)[0, 0], 3.0)
+      self.assertTrue(widget.gateLabel.text.startswith("1 of 1"))
+    finally:
+      widget.sessionComboBox.setCurrentIndex(0)
+      for session in [second, first]:
+        widget.sessions.remove(session)
+        widget.sessionComboBox.removeItem(len(widget.sessions))
+        slicer.mrmlScene.RemoveNode(session.outputRegistrationTransformNode)
+      self.assertEqual(len(widget.sessions), numberOfSessions)
+    self.delayDisplay('Test passed!')
@@ -0,0 +1,136 @@
+import numpy as np
+
+class CalibrationHistory(object):
+  """Array-backed tree of point-to-line correspondences.
+
+  Each step stores one correspondence (image point, needle line origin and
+  direction), the registration computed after adding it and the step it was added
+  to. Steps are numbered 1, 2, ... in the order they were added, step 0 is the empty
+  calibration. Undo moves to the parent step, redo back to the child that was last
+  left or added, and jumping goes to any step; all of them restore the cached
+  registration in constant time without re-running the solver. Adding a
+  correspondence after an undo starts a new branch, the steps of the old branch
+  stay reachable with jumpTo.
+
+  Each step also records the item of the recorded image sequence the point was
+  placed on (-1 for a live image) and whether it was placed manually, manual
+  points on recorded frames are the labels used to evaluate needle detectors.
+  """
+  def __init__(self, capacity=64):
+    # Row 0 is the empty calibration, row i is step i
+    self.points = np.zeros((capacity + 1, 3))
+    self.origins = np.zeros((capacity + 1, 3))
+    self.directions = np.zeros((capacity + 1, 3))
+    self.registrations = np.zeros((capacity + 1, 4, 4))
+    self.registrations[0] = np.eye(4)
+    self.frames = np.full(capacity + 1, -1, dtype=np.int64)
+    self.manual = np.zeros(capacity + 1, dtype=bool)
+    self.parents = np.zeros(capacity + 1, dtype=np.int64)
+    # Number of correspondences active at each step
+    self.depths = np.zeros(capacity + 1, dtype=np.int64)
+    # Step that redo goes to from each step, 0 if there is none
+    self.redoSteps = np.zeros(capacity + 1, dtype=np.int64)
+    # Number of stored steps, on all branches
+    self.length = 0
+    # Current step
+    self.cursor = 0
+
+  def capacity(self):
+    return self.points.shape[0] - 1
+
+  def grow(self, capacity):
+    for name in ['points', 'origins', 'directions', 'registrations', 'frames', 'manual', 'parents', 'depths', 'redoSteps']:
+      old = getattr(self, name)
+      new = np.zeros((capacity + 1,) + old.shape[1:], dtype=old.dtype)
+      new[:self.length + 1] = old[:self.length + 1]
+      setattr(self, name, new)
+
+  def add(self, point, origin, direction, registration, frame=-1, manual=False):
+    if self.length >= self.capacity():
+      self.grow(2 * self.capacity())
+    step = self.length + 1
+    self.points[step] = point
+    self.origins[step] = origin
+    self.directions[step] = direction
+    self.registrations[step] = registration
+    self.frames[step] = frame
+    self.manual[step] = manual
+    self.parents[step] = self.cursor
+    self.depths[step] = self.depths[self.cursor] + 1
+    self.redoSteps[step] = 0
+    self.redoSteps[self.cursor] = step
+    self.length = step
+    self.cursor = step
+
+  def clear(self):
+    self.length = 0
+    self.cursor = 0
+    self.redoSteps[0] = 0
+
+  def count(self):
+    """Number of active correspondences."""
+    return int(self.depths[self.cursor])
+
+  def step(self):
+    return self.cursor
+
+  def canUndo(self):
+    return self.cursor > 0
+
+  def canRedo(self):
+    return self.redoSteps[self.cursor] > 0
+
+  def undo(self):
+    if not self.canUndo():
+      return False
+    parent = self.parents[self.cursor]
+    self.redoSteps[parent] = self.cursor
+    self.cursor = int(parent)
+    return True
+
+  def redo(self):
+    if not self.canRedo():
+      return False
+    self.cursor = int(self.redoSteps[self.cursor])
+    return True
+
+  def jumpTo(self, step):
+    """Makes step current, on whatever branch it is, 0 <= step <= length."""
+    if step < 0 or step > self.length:
+      return False
+    self.cursor = step
+    return True
+
+  def registration(self):
+    """Cached registration for the current step, identity if there is none."""
+    return self.registrations[self.cursor]
+
+  def currentPoint(self):
+    if self.cursor == 0:
+      return None
+    return self.points[self.cursor]
+
+  def activeSteps(self):
+    """Steps from the first to the current one on the branch of the current step."""
+    steps = np.empty(self.count(), dtype=np.int64)
+    step = self.cursor
+    for i in range(len(steps) - 1, -1, -1):
+      steps[i] = step
+      step = self.parents[step]
+    return steps
+
+  def activeCorrespondences(self):
+    """Returns the active points, line origins and line directions."""
+    steps = self.activeSteps()
+    return self.points[steps], self.origins[steps], self.directions[steps]
+
+  def labeledFrames(self):
+    """Returns the recorded frame items and image points of the active manual steps placed on recorded frames."""
+    steps = self.activeSteps()
+    steps = steps[self.manual[steps] & (self.frames[steps] >= 0)]
+    return self.frames[steps], self.points[steps]
+
+  def liveLabeledSteps(self):
+    """Returns the active manual steps placed on live images."""
+    steps = self.activeSteps()
+    return steps[self.manual[steps] & (self.frames[steps] < 0)]
@@ -0,0 +1,63 @@
+import concurrent.futures
+import logging
+
+class DetectionScheduler(object):
+  """Runs needle detections for several calibration sessions on a shared thread pool.
+
+  Frames submitted between two flush() calls are grouped into batches so that the
+  model runs once per batch instead of once per probe. Callbacks are not called from
+  the worker threads: processCompleted() has to be called periodically from the main
+  thread (e.g. from a QTimer) and invokes callback(detection, context) there, which
+  keeps all scene updates on the main thread. The workers only share the detector,
+  whose model predictions are serialized, so preprocessing of one batch overlaps
+  with the prediction of another.
+  """
+  def __init__(self, detector, maxWorkers=2, maxBatchSize=16):
+    self.detector = detector
+    self.maxBatchSize = maxBatchSize
+    self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=maxWorkers)
+    self.pending = []
+    self.running = []
+
+  def submit(self, frame, callback, context=None, augment=False):
+    self.pending.append((frame, callback, context, augment))
+
+  def flush(self):
+    # Frames with and without test-time augmentation go to separate batches
+    for augment in [False, True]:
+      items = [item for item in self.pending if item[3] == augment]
+      for start in range(0, len(items), self.maxBatchSize):
+        batch = items[start:start + self.maxBatchSize]
+        future = self.executor.submit(self.detector.detectBatch, [item[0] for item in batch], 1, augment)
+        self.running.append((future, batch))
+    self.pending = []
+
+  def busy(self):
+    return len(self.pending) > 0 or len(self.running) > 0
+
+  def processCompleted(self):
+    """Calls the callbacks of finished batches, returns the number of detections delivered."""
+    delivered = 0
+    running = self.running
+    self.running = []
+    for future, batch in running:
+      if not future.done():
+        self.running.append((future, batch))
+        continue
+      if future.cancelled():
+        continue
+      if future.exception() is not None:
+        logging.error("Needle detection failed: " + str(future.exception()))
+        continue
+      for detection, (frame, callback, context, augment) in zip(future.result(), batch):
+        callback(detection, context)
+        delivered += 1
+    return delivered
+
+  def shutdown(self):
+    # Batches that have not started are cancelled, a running one finishes in the background
+    self.pending = []
+    for future, batch in self.running:
+      future.cancel()
+    self.executor.shutdown(wait=False)
+    self.running = []
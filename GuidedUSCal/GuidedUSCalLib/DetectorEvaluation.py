@@ -0,0 +1,168 @@
+"""Localization error against speed of needle detectors, on labeled recorded frames.
+
+Labeled frames are exported from calibration sessions (manual fiducials placed on
+recorded frames) as .npz files with 'frames', 'labels' (N x 2, column and row in
+pixels) and 'spacing' (mm per pixel). Every candidate detector runs over all frames
+in batches queued to a worker thread, and the results are summarized in a table that marks
+the candidates no other candidate beats in both error and latency.
+
+Models can be compared from the command line with the Slicer Python (needs TensorFlow), e.g.:
+
+  PythonSlicer -m GuidedUSCalLib.DetectorEvaluation --labels LabeledFrames.npz -- cnn_model_best.keras.h5 small_model.h5
+"""
+import argparse
+import concurrent.futures
+import os
+import time
+import tracemalloc
+
+import numpy as np
+
+from .NeedleDetector import NeedleDetector
+
+def loadLabeledFrames(paths):
+  """Returns the frames (list of 2D arrays), labels (N x 2) and spacings (N x 2) of one or more exported files."""
+  frames = []
+  labels = []
+  spacings = []
+  for path in paths:
+    with np.load(path) as data:
+      frames.extend(list(data['frames']))
+      labels.append(np.asarray(data['labels'], dtype=np.float64).reshape(-1, 2))
+      spacing = np.asarray(data['spacing'], dtype=np.float64) if 'spacing' in data else np.ones(2)
+      # One spacing for all frames or one per frame
+      spacings.append(np.broadcast_to(spacing.reshape(-1, 2), labels[-1].shape))
+  if len(labels) == 0:
+    return [], np.zeros((0, 2)), np.zeros((0, 2))
+  return frames, np.concatenate(labels), np.concatenate(spacings)
+
+def detectAll(detector, frames, batchSize=16, maxWorkers=1):
+  """Detects all frames in batches queued to a thread pool, one worker by default.
+
+  The workers share the detector, which serializes its model predictions, so more workers
+  only overlap the preprocessing of one batch with the prediction of another.
+  Returns the detected positions (N x 2), confidences (N), the latency of every frame
+  (time from submitting its batch until the batch was detected, including the time it
+  waited in the queue, s) and the wall time.
+  """
+  positions = np.full((len(frames), 2), np.nan)
+  confidences = np.zeros(len(frames))
+  latencies = np.zeros(len(frames))
+  augment = detector.augment
+
+  def detectBatch(start):
+    detections = detector.detectBatch(frames[start:start + batchSize], 1, augment)
+    return start, detections, time.perf_counter()
+
+  wallStart = time.perf_counter()
+  with concurrent.futures.ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+    futures = []
+    submitted = {}
+    for start in range(0, len(frames), batchSize):
+      # Timestamped on this thread, so that the latency includes queueing
+      submitted[start] = time.perf_counter()
+      futures.append(executor.submit(detectBatch, start))
+    for future in concurrent.futures.as_completed(futures):
+      start, detections, finished = future.result()
+      end = start + len(detections)
+      positions[start:end] = [detection.position[0:2] for detection in detections]
+      confidences[start:end] = [detection.confidence for detection in detections]
+      latencies[start:end] = finished - submitted[start]
+  return positions, confidences, latencies, time.perf_counter() - wallStart
+
+def evaluateDetector(name, detector, frames, labels, spacings=None, tolerance=1.0, batchSize=16, maxWorkers=1):
+  """Error distribution (mm, or pixels without spacings), latency percentiles (s), throughput
+  (frames/s) and peak memory (bytes) of one detector.
+
+  Peak memory is measured with tracemalloc, so it covers NumPy and Python allocations
+  (model inputs, outputs and batches) but not the internal buffers of the model runtime.
+  """
+  labels = np.asarray(labels, dtype=np.float64).reshape(-1, 2)
+  spacings = np.ones_like(labels) if spacings is None else np.asarray(spacings, dtype=np.float64).reshape(-1, 2)
+  startedTracing = not tracemalloc.is_tracing()
+  if startedTracing:
+    tracemalloc.start()
+  try:
+    positions, confidences, latencies, wallTime = detectAll(detector, frames, batchSize, maxWorkers)
+    peakMemory = tracemalloc.get_traced_memory()[1]
+  finally:
+    if startedTracing:
+      tracemalloc.stop()
+  errors = np.linalg.norm((positions - labels) * spacings, axis=1)
+  return {'name': name,
+          'inputSize': (getattr(detector, 'inputWidth', None), getattr(detector, 'inputHeight', None)),
+          'frames': len(frames),
+          'meanError': float(np.mean(errors)) if len(errors) > 0 else np.nan,
+          'medianError': float(np.median(errors)) if len(errors) > 0 else np.nan,
+          'p95Error': float(np.percentile(errors, 95)) if len(errors) > 0 else np.nan,
+          'maxError': float(np.max(errors)) if len(errors) > 0 else np.nan,
+          'withinTolerance': float(np.mean(errors <= tolerance)) if len(errors) > 0 else np.nan,
+          'p50Latency': float(np.percentile(latencies, 50)) if len(latencies) > 0 else np.nan,
+          'p95Latency': float(np.percentile(latencies, 95)) if len(latencies) > 0 else np.nan,
+          'p99Latency': float(np.percentile(latencies, 99)) if len(latencies) > 0 else np.nan,
+          'throughput': len(frames) / wallTime if wallTime > 0 else np.nan,
+          'peakMemory': peakMemory,
+          'errors': errors,
+          'confidences': confidences}
+
+def paretoOptimal(results, errorKey='p95Error', latencyKey='p95Latency'):
+  """For every result, whether no other result has both a lower or equal error and latency, and one of them lower."""
+  errors = np.array([result[errorKey] for result in results], dtype=np.float64)
+  latencies = np.array([result[latencyKey] for result in results], dtype=np.float64)
+  notWorse = (errors[:, np.newaxis] <= errors[np.newaxis, :]) & (latencies[:, np.newaxis] <= latencies[np.newaxis, :])
+  better = (errors[:, np.newaxis] < errors[np.newaxis, :]) | (latencies[:, np.newaxis] < latencies[np.newaxis, :])
+  # dominated[j]: some i is not worse than j in both and better in one
+  dominated = np.any(notWorse & better, axis=0)
+  return ~dominated
+
+def fastestWithinTolerance(results, tolerance, errorKey='p95Error'):
+  """The result with the highest throughput whose error is within tolerance, None if there is none."""
+  accepted = [result for result in results if result[errorKey] <= tolerance]
+  if len(accepted) == 0:
+    return None
+  return max(accepted, key=lambda result: result['throughput'])
+
+def evaluateDetectors(detectors, frames, labels, spacings=None, tolerance=1.0, batchSize=16, maxWorkers=1):
+  """Evaluates (name, detector) pairs one after the other, returns the results sorted by p95 latency with a 'pareto' flag."""
+  results = [evaluateDetector(name, detector, frames, labels, spacings, tolerance, batchSize, maxWorkers) for name, detector in detectors]
+  results.sort(key=lambda result: result['p95Latency'])
+  for result, optimal in zip(results, paretoOptimal(results)):
+    result['pareto'] = bool(optimal)
+  return results
+
+def formatTable(results, tolerance=1.0):
+  lines = ["{0:<30} {1:>9} {2:>6} {3:>8} {4:>8} {5:>8} {6:>8} {7:>8} {8:>8} {9:>8} {10:>8} {11}".format(
+    "model", "input", "frames", "median", "p95 err", "in tol", "p50 ms", "p95 ms", "p99 ms", "fps", "peak MB", "pareto")]
+  for result in results:
+    width, height = result['inputSize']
+    lines.append("{0:<30} {1:>9} {2:>6d} {3:>8.2f} {4:>8.2f} {5:>7.0f}% {6:>8.1f} {7:>8.1f} {8:>8.1f} {9:>8.1f} {10:>8.1f} {11}".format(
+      result['name'][-30:], str(width) + "x" + str(height), result['frames'], result['medianError'], result['p95Error'],
+      100.0 * result['withinTolerance'], 1000.0 * result['p50Latency'], 1000.0 * result['p95Latency'], 1000.0 * result['p99Latency'],
+      result['throughput'], result['peakMemory'] / 1e6, "*" if result.get('pareto') else ""))
+  best = fastestWithinTolerance(results, tolerance)
+  lines.append("Fastest model within " + str(tolerance) + " (p95 error): " + (best['name'] if best is not None else "none"))
+  return "\n".join(lines)
+
+def detectorFromModelFile(path, augment=False):
+  # Imported here so that the rest of the module does not need TensorFlow
+  from tensorflow.keras.models import load_model
+  model = load_model(path)
+  inputShape = model.input_shape
+  return NeedleDetector(model, inputShape[1], inputShape[2], augment)
+
+def main():
+  parser = argparse.ArgumentParser(description="Compare needle detection models on labeled recorded frames.")
+  parser.add_argument("--labels", nargs="+", required=True, help="labeled frame files exported from calibration sessions")
+  parser.add_argument("models", nargs="+", help="Keras model files")
+  parser.add_argument("--tolerance", type=float, default=1.0, help="acceptable p95 error in mm")
+  parser.add_argument("--batch", type=int, default=16, help="frames per model prediction")
+  parser.add_argument("--workers", type=int, default=1, help="worker threads, more than one overlaps preprocessing with prediction")
+  parser.add_argument("--augment", action="store_true", help="use test-time augmentation")
+  args = parser.parse_args()
+  frames, labels, spacings = loadLabeledFrames(args.labels)
+  detectors = [(os.path.basename(path), detectorFromModelFile(path, args.augment)) for path in args.models]
+  results = evaluateDetectors(detectors, frames, labels, spacings, args.tolerance, args.batch, args.workers)
+  print(formatTable(results, args.tolerance))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,87 @@
+import numpy as np
+
+class FrameGate(object):
+  """Cheap per-frame test that runs ahead of the needle detection CNN.
+
+  A frame is rejected when it contains no bright echo that could be the needle,
+  when it is saturated, when it is too blurred to localize anything, or when it
+  is nearly identical to the last accepted frame. All statistics are computed
+  with vectorized NumPy operations on a subsampled copy of the frame.
+  """
+  ACCEPTED = "accepted"
+  NO_NEEDLE = "no needle"
+  SATURATED = "saturated"
+  BLURRED = "blurred"
+  UNCHANGED = "unchanged"
+
+  def __init__(self, stride=2, brightThreshold=180, minBrightFraction=0.0002, maxBrightFraction=0.05, minSharpness=15.0, minFrameDifference=1.0):
+    # Only every stride-th row and column is examined
+    self.stride = stride
+    # Intensity above which a pixel is considered part of a needle echo
+    self.brightThreshold = brightThreshold
+    # Acceptable range for the fraction of bright pixels in the frame
+    self.minBrightFraction = minBrightFraction
+    self.maxBrightFraction = maxBrightFraction
+    # Minimum variance of the Laplacian, frames below this are considered blurred
+    self.minSharpness = minSharpness
+    # Minimum mean absolute intensity difference to the last accepted frame, 0 disables the test
+    self.minFrameDifference = minFrameDifference
+    self.reset()
+
+  def reset(self):
+    self.numberOfFrames = 0
+    self.numberOfRejectedFrames = 0
+    self.reasonCounts = dict((reason, 0) for reason in [self.ACCEPTED, self.NO_NEEDLE, self.SATURATED, self.BLURRED, self.UNCHANGED])
+    self.lastReason = None
+    self.lastStatistics = {}
+    self.previousFrame = None
+
+  def computeStatistics(self, frame):
+    # Accepts a 2D frame, or a 3D volume with a single slice as returned by arrayFromVolume
+    frame = np.asarray(frame)
+    if frame.ndim == 3:
+      frame = frame[0]
+    sub = frame[::self.stride, ::self.stride].astype(np.float32)
+    brightFraction = np.count_nonzero(sub > self.brightThreshold) / float(sub.size)
+    laplacian = sub[:-2, 1:-1] + sub[2:, 1:-1] + sub[1:-1, :-2] + sub[1:-1, 2:] - 4.0 * sub[1:-1, 1:-1]
+    sharpness = float(laplacian.var())
+    if self.previousFrame is not None and self.previousFrame.shape == sub.shape:
+      difference = float(np.abs(sub - self.previousFrame).mean())
+    else:
+      difference = None
+    return sub, {'brightFraction': brightFraction, 'sharpness': sharpness, 'difference': difference}
+
+  def accept(self, frame):
+    """Returns True if the frame is worth passing to the detector."""
+    sub, statistics = self.computeStatistics(frame)
+    if statistics['brightFraction'] < self.minBrightFraction:
+      reason = self.NO_NEEDLE
+    elif statistics['brightFraction'] > self.maxBrightFraction:
+      reason = self.SATURATED
+    elif statistics['sharpness'] < self.minSharpness:
+      reason = self.BLURRED
+    elif statistics['difference'] is not None and statistics['difference'] < self.minFrameDifference:
+      reason = self.UNCHANGED
+    else:
+      reason = self.ACCEPTED
+      self.previousFrame = sub
+
+    self.numberOfFrames += 1
+    if reason != self.ACCEPTED:
+      self.numberOfRejectedFrames += 1
+    self.reasonCounts[reason] += 1
+    self.lastReason = reason
+    self.lastStatistics = statistics
+    return reason == self.ACCEPTED
+
+  def rejectionRate(self):
+    if self.numberOfFrames == 0:
+      return 0.0
+    return self.numberOfRejectedFrames / float(self.numberOfFrames)
+
+  def summary(self):
+    text = str(self.numberOfRejectedFrames) + " of " + str(self.numberOfFrames) + " (" + str(round(100.0 * self.rejectionRate(), 1)) + "%)"
+    rejected = [reason + ": " + str(count) for reason, count in self.reasonCounts.items() if reason != self.ACCEPTED and count > 0]
+    if len(rejected) > 0:
+      text += " - " + ", ".join(rejected)
+    return text
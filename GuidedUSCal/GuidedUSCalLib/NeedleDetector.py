@@ -0,0 +1,169 @@
+import threading
+import time
+import numpy as np
+
+try:
+  import cv2
+except ImportError:
+  cv2 = None
+
+class NeedleDetection(object):
+  """Result of a needle tip detection.
+
+  position is the sub-pixel tip location as [x, y, 0] in image pixel coordinates,
+  confidence is in [0, 1], candidates is a list of ([x, y, 0], score) pairs sorted
+  by decreasing score, and inferenceTime is the model prediction time in seconds.
+  Positions followed by a NeedleTracker between keyframes have tracked set, their
+  confidence is the template correlation and inferenceTime the tracking time.
+  Detections of the model carry the model input (modelInput) and the width and
+  height of the cropped frame it was made from (frameSize), tracked ones have None.
+  """
+  def __init__(self, position, confidence, candidates=None, inferenceTime=0.0, tracked=False, modelInput=None, frameSize=None):
+    self.position = position
+    self.confidence = confidence
+    self.candidates = candidates if candidates is not None else [(position, confidence)]
+    self.inferenceTime = inferenceTime
+    self.tracked = tracked
+    self.modelInput = modelInput
+    self.frameSize = frameSize
+
+  def __repr__(self):
+    return "NeedleDetection(position=[" + ", ".join([str(round(p, 2)) for p in self.position]) + "], confidence=" + str(round(self.confidence, 3)) + ")"
+
+class NeedleDetector(object):
+  """Wraps the needle tip regression model.
+
+  The model regresses the tip location in normalized [-1, 1] coordinates. Without
+  augmentation there is nothing to estimate the confidence from: it is NaN, or 0 when
+  the prediction falls outside the image. With test-time augmentation, shifted and mirrored copies of each frame are
+  predicted in the same batch as the original and the spread of the back-projected
+  predictions gives the confidence and the candidate list.
+
+  detect and detectBatch can be called from several threads, they keep no state on
+  the detector and the model predictions are serialized by predictLock. Detectors
+  sharing a model can share the lock too.
+  """
+  # Lateral and axial shifts (in model input pixels) used for test-time augmentation, with and without mirroring
+  AUGMENTATION_SHIFTS = [(0, 0), (2, 0), (-2, 0), (0, 2), (0, -2)]
+
+  def __init__(self, model, inputWidth, inputHeight, augment=False, confidenceScale=4.0, candidateRadius=3.0, predictLock=None):
+    self.model = model
+    self.inputWidth = inputWidth
+    self.inputHeight = inputHeight
+    # Default for detections that do not choose whether to augment
+    self.augment = augment
+    # Spread of the augmented predictions, in pixels, at which confidence drops to exp(-1)
+    self.confidenceScale = confidenceScale
+    # Predictions closer than this many pixels are merged into the same candidate
+    self.candidateRadius = candidateRadius
+    self.predictLock = predictLock if predictLock is not None else threading.Lock()
+
+  def preprocess(self, frame):
+    """Converts an image array (as returned by arrayFromVolume) into model input.
+
+    Returns the model input together with the width and height of the cropped frame
+    used to scale predictions back to pixels.
+    """
+    frame = np.asarray(frame)
+    if frame.ndim == 3:
+      frame = frame[0]
+    rows, cols = frame.shape
+    x = np.transpose(frame).reshape([cols, rows, 1])
+    x = x[:, 0:rows-5] / 255.0
+    w = x.shape[0]
+    h = x.shape[1]
+    if self.inputWidth != 128 or cv2 is None:
+      x = np.resize(x, [self.inputWidth, self.inputHeight, 1])
+    else:
+      x = np.expand_dims(cv2.resize(x, (self.inputWidth, self.inputHeight)), axis=-1)
+    return x, w, h
+
+  def augmentations(self, x):
+    inputs = []
+    transforms = []
+    for mirrored in [False, True]:
+      source = x[::-1] if mirrored else x
+      for shift in self.AUGMENTATION_SHIFTS:
+        inputs.append(np.roll(source, shift, axis=(0, 1)))
+        transforms.append((mirrored, shift))
+    return inputs, transforms
+
+  def detect(self, frame, topK=1, augment=None):
+    return self.detectBatch([frame], topK, augment)[0]
+
+  def detectBatch(self, frames, topK=1, augment=None):
+    """Detects the needle tip in a list of frames with a single model prediction.
+
+    augment selects test-time augmentation for this call, None uses self.augment.
+    """
+    if len(frames) == 0:
+      return []
+    if augment is None:
+      augment = self.augment
+    inputs = []
+    modelInputs = []
+    sizes = []
+    transforms = None
+    for frame in frames:
+      x, w, h = self.preprocess(frame)
+      modelInputs.append(x)
+      sizes.append((w, h))
+      if augment:
+        augmented, transforms = self.augmentations(x)
+        inputs.extend(augmented)
+      else:
+        inputs.append(x)
+    inputs = np.stack(inputs)
+
+    with self.predictLock:
+      startTime = time.perf_counter()
+      y = np.asarray(self.model.predict(inputs), dtype=np.float64).reshape([len(inputs), -1])[:, 0:2]
+      inferenceTime = (time.perf_counter() - startTime) / len(frames)
+
+    if augment:
+      y = y.reshape([len(frames), len(transforms), 2])
+      # Undo the augmentations in normalized coordinates
+      mirrored = np.array([t[0] for t in transforms])
+      shifts = np.array([t[1] for t in transforms], dtype=np.float64)
+      y = y - 2.0 * shifts / np.array([self.inputWidth, self.inputHeight])
+      # Mirroring maps pixel i to inputWidth-1-i, hence the extra one pixel offset
+      y[:, mirrored, 0] = -y[:, mirrored, 0] - 2.0 / self.inputWidth
+    else:
+      y = y.reshape([len(frames), 1, 2])
+
+    detections = []
+    for index, (w, h) in enumerate(sizes):
+      # Scale predicted coordinates to pixel coordinates
+      predictions = (y[index] + 1.0) * np.array([w / 2.0, h / 2.0])
+      detection = self.summarize(predictions, y[index], inferenceTime, topK)
+      detection.modelInput = modelInputs[index]
+      detection.frameSize = (w, h)
+      detections.append(detection)
+    return detections
+
+  def summarize(self, predictions, normalized, inferenceTime, topK):
+    consensus = np.median(predictions, axis=0)
+    spread = np.sqrt(np.mean(np.sum((predictions - consensus) ** 2, axis=1)))
+    # Predictions outside the image are not trustworthy
+    inside = np.mean(np.all(np.abs(normalized) <= 1.0, axis=1))
+    if len(predictions) > 1:
+      confidence = float(inside * np.exp(-(spread / self.confidenceScale) ** 2))
+    else:
+      # A single prediction says nothing about its reliability unless it is outside the image
+      confidence = np.nan if inside > 0 else 0.0
+
+    # Greedily merge predictions into candidates, scored by their share of the votes
+    candidates = []
+    remaining = predictions
+    while len(remaining) > 0 and len(candidates) < topK:
+      center = np.median(remaining, axis=0)
+      members = np.linalg.norm(remaining - center, axis=1) <= self.candidateRadius
+      if not np.any(members):
+        members = np.arange(len(remaining)) == 0
+      center = remaining[members].mean(axis=0)
+      score = float(confidence * np.count_nonzero(members) / float(len(predictions)))
+      candidates.append(([float(center[0]), float(center[1]), 0], score))
+      remaining = remaining[~members]
+
+    position = [float(consensus[0]), float(consensus[1]), 0]
+    return NeedleDetection(position, confidence, candidates, inferenceTime)
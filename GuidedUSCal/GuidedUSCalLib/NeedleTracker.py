@@ -0,0 +1,155 @@
+import time
+
+import numpy as np
+
+from .NeedleDetector import NeedleDetection
+
+def parabolaPeak(left, center, right):
+  # Offset of the vertex of the parabola through three equally spaced values, 0 if there is no maximum
+  curvature = left - 2.0 * center + right
+  if curvature >= 0:
+    return 0.0
+  return 0.5 * (left - right) / curvature
+
+class NeedleTracker(object):
+  """Follows the needle tip from frame to frame, running the detector only on keyframes.
+
+  On a keyframe the detector runs and a template around the detected tip is kept. On the
+  following frames the tip position is predicted with a constant velocity (alpha-beta)
+  filter, and the template is matched by normalized cross correlation at all offsets of
+  a small window around the prediction at once. The detector runs again when the best
+  correlation drops below minCorrelation, when the template cannot be matched near the
+  image border, or after maxInterval frames. Positions are [x, y, 0] in image pixels
+  like the detections of NeedleDetector.
+  """
+  START = "start"
+  LOST = "lost"
+  INTERVAL = "interval"
+
+  def __init__(self, detector, templateRadius=8, searchRadius=10, minCorrelation=0.7, maxInterval=15, minDetectionConfidence=0.5, alpha=0.8, beta=0.3):
+    self.detector = detector
+    # Test-time augmentation of the keyframe detections, None uses the default of the detector
+    self.augment = None
+    # Template is (2 * templateRadius + 1) pixels square, searched up to searchRadius pixels from the prediction
+    self.templateRadius = templateRadius
+    self.searchRadius = searchRadius
+    self.minCorrelation = minCorrelation
+    self.maxInterval = maxInterval
+    # Keyframe detections below this confidence do not start tracking, detections without a confidence (NaN) do
+    self.minDetectionConfidence = minDetectionConfidence
+    # Gains of the filter: share of the measurement residual added to the position and to the velocity
+    self.alpha = alpha
+    self.beta = beta
+    self.reset()
+
+  def reset(self):
+    self.template = None
+    self.position = None
+    # Pixels per frame
+    self.velocity = np.zeros(2)
+    self.framesSinceKeyframe = 0
+    self.lastDetection = None
+    self.numberOfFrames = 0
+    self.reasonCounts = dict((reason, 0) for reason in [self.START, self.LOST, self.INTERVAL])
+
+  def numberOfKeyframes(self):
+    return sum(self.reasonCounts.values())
+
+  def keyframeRate(self):
+    if self.numberOfFrames == 0:
+      return 0.0
+    return self.numberOfKeyframes() / float(self.numberOfFrames)
+
+  def summary(self):
+    text = str(self.numberOfKeyframes()) + " of " + str(self.numberOfFrames) + " (" + str(round(100.0 * self.keyframeRate(), 1)) + "%)"
+    reasons = [reason + ": " + str(count) for reason, count in self.reasonCounts.items() if count > 0]
+    if len(reasons) > 0:
+      text += " - " + ", ".join(reasons)
+    return text
+
+  def extractTemplate(self, image, position):
+    # Zero mean, unit norm patch around position, None if it does not fit into the image or is flat
+    r = self.templateRadius
+    x = int(round(position[0]))
+    y = int(round(position[1]))
+    if x - r < 0 or y - r < 0 or y + r + 1 > image.shape[0] or x + r + 1 > image.shape[1]:
+      return None
+    template = image[y - r:y + r + 1, x - r:x + r + 1].astype(np.float32)
+    template -= template.mean()
+    norm = np.sqrt(np.sum(template * template))
+    if norm == 0:
+      return None
+    return template / norm
+
+  def match(self, image, predicted):
+    """Best matching tip position near predicted and its correlation, (None, 0) if the window is too small."""
+    r = self.templateRadius
+    size = 2 * r + 1
+    reach = self.searchRadius + r
+    x = int(round(predicted[0]))
+    y = int(round(predicted[1]))
+    top = max(y - reach, 0)
+    left = max(x - reach, 0)
+    window = image[top:min(y + reach + 1, image.shape[0]), left:min(x + reach + 1, image.shape[1])].astype(np.float32)
+    if window.shape[0] < size or window.shape[1] < size:
+      return None, 0.0
+    # Every template sized patch of the window as a view: row offset x column offset x size x size
+    rowStride, columnStride = window.strides
+    patches = np.lib.stride_tricks.as_strided(window, shape=(window.shape[0] - size + 1, window.shape[1] - size + 1, size, size),
+                                              strides=(rowStride, columnStride, rowStride, columnStride), writeable=False)
+    # The template has zero mean, so the patch means drop out of the numerator
+    numerator = np.einsum('ijkl,kl->ij', patches, self.template)
+    sums = np.einsum('ijkl->ij', patches)
+    variance = np.einsum('ijkl,ijkl->ij', patches, patches) - sums * sums / float(size * size)
+    flat = variance <= 1e-3
+    correlation = numerator / np.sqrt(np.where(flat, 1.0, variance))
+    correlation[flat] = 0.0
+    row, column = np.unravel_index(np.argmax(correlation), correlation.shape)
+    best = float(correlation[row, column])
+    position = np.array([left + column + r, top + row + r], dtype=np.float64)
+    if 0 < column < correlation.shape[1] - 1:
+      position[0] += parabolaPeak(correlation[row, column - 1], best, correlation[row, column + 1])
+    if 0 < row < correlation.shape[0] - 1:
+      position[1] += parabolaPeak(correlation[row - 1, column], best, correlation[row + 1, column])
+    return position, best
+
+  def keyframe(self, image, frame, reason):
+    detection = self.detector.detect(frame, 1, self.augment)
+    self.reasonCounts[reason] += 1
+    self.framesSinceKeyframe = 0
+    measured = np.array(detection.position[0:2], dtype=np.float64)
+    self.template = self.extractTemplate(image, measured) if not detection.confidence < self.minDetectionConfidence else None
+    if self.template is None:
+      self.position = None
+      self.velocity = np.zeros(2)
+    else:
+      # The detection anchors the template, it only corrects the velocity of the filter
+      if self.position is not None:
+        self.velocity += self.beta * (measured - (self.position + self.velocity))
+      self.position = measured
+    return detection
+
+  def track(self, frame):
+    """Returns the NeedleDetection of the next frame of the stream, tracked ones have tracked set."""
+    startTime = time.perf_counter()
+    frame = np.asarray(frame)
+    image = frame[0] if frame.ndim == 3 else frame
+    self.numberOfFrames += 1
+    if self.template is None:
+      self.lastDetection = self.keyframe(image, frame, self.START)
+      return self.lastDetection
+    if self.framesSinceKeyframe + 1 >= self.maxInterval:
+      self.lastDetection = self.keyframe(image, frame, self.INTERVAL)
+      return self.lastDetection
+    predicted = self.position + self.velocity
+    measured, correlation = self.match(image, predicted)
+    if measured is None or correlation < self.minCorrelation:
+      self.lastDetection = self.keyframe(image, frame, self.LOST)
+      return self.lastDetection
+    residual = measured - predicted
+    self.position = predicted + self.alpha * residual
+    self.velocity += self.beta * residual
+    self.framesSinceKeyframe += 1
+    position = [float(self.position[0]), float(self.position[1]), 0]
+    self.lastDetection = NeedleDetection(position, correlation, inferenceTime=time.perf_counter() - startTime, tracked=True)
+    return self.lastDetection
@@ -0,0 +1,53 @@
+import collections
+
+class SceneNodeIndex(object):
+  """Nodes of a few MRML classes in a scene, for constant time counts and typed lookups.
+
+  The index is filled once by rebuild(scene) and then kept up to date by calling
+  nodeAdded() and nodeRemoved() from the scene NodeAddedEvent and NodeRemovedEvent
+  observers, so the scene is not scanned again. Nodes are matched with IsA(), so a
+  node is also counted under the classes it derives from. Classes that are not
+  tracked always count zero.
+  """
+  def __init__(self, classNames):
+    self.classNames = list(classNames)
+    self.nodesByClass = dict((className, collections.OrderedDict()) for className in self.classNames)
+
+  def reset(self):
+    for nodes in self.nodesByClass.values():
+      nodes.clear()
+
+  def rebuild(self, scene):
+    """Rescans the scene, only needed at start up and after the scene was closed."""
+    self.reset()
+    for className in self.classNames:
+      collection = scene.GetNodesByClass(className)
+      for i in range(0, collection.GetNumberOfItems()):
+        self.nodeAdded(collection.GetItemAsObject(i))
+
+  def nodeAdded(self, node):
+    if node is None:
+      return
+    for className, nodes in self.nodesByClass.items():
+      if node.IsA(className):
+        nodes[node] = True
+
+  def nodeRemoved(self, node):
+    if node is None:
+      return
+    for nodes in self.nodesByClass.values():
+      nodes.pop(node, None)
+
+  def count(self, className):
+    nodes = self.nodesByClass.get(className)
+    return len(nodes) if nodes is not None else 0
+
+  def nodes(self, className):
+    """Nodes of className in the order they were added."""
+    return list(self.nodesByClass.get(className, ()))
+
+  def firstNode(self, className):
+    nodes = self.nodesByClass.get(className)
+    if not nodes:
+      return None
+    return next(iter(nodes))
@@ -0,0 +1,48 @@
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+class SharedImageBuffer(object):
+  """Single-slice vtkImageData whose scalars share memory with a NumPy array.
+
+  The image is allocated once and updated in place: update() writes into the
+  shared array and only marks the image data as modified, so no VTK image or
+  volume is created per frame. Only an image of another shape reallocates the
+  scalars, the vtkImageData object stays the same.
+  """
+  def __init__(self, rows, columns, dtype=np.uint8):
+    self.dtype = dtype
+    self.imageData = vtk.vtkImageData()
+    self.allocate(rows, columns)
+    self.markerValue = np.iinfo(dtype).max if np.issubdtype(dtype, np.integer) else 1.0
+
+  def allocate(self, rows, columns):
+    self.shape = (rows, columns)
+    # Array layout matches arrayFromVolume: slice, row, column
+    self.array = np.zeros((1, rows, columns), self.dtype)
+    self.imageData.SetDimensions(columns, rows, 1)
+    # deep=False makes VTK use the NumPy memory directly, self.array keeps it alive
+    self.vtkArray = numpy_support.numpy_to_vtk(self.array.ravel(), deep=False)
+    self.imageData.GetPointData().SetScalars(self.vtkArray)
+
+  def update(self, image, scale=1.0, markers=None, markerRadius=3):
+    """Copies image (rows x columns) into the buffer, optionally drawing cross markers at (column, row) positions.
+
+    Returns True if the buffer was reallocated because the shape of image changed.
+    """
+    reallocated = np.shape(image) != self.shape
+    if reallocated:
+      self.allocate(np.shape(image)[0], np.shape(image)[1])
+    np.multiply(image, scale, out=self.array[0], casting='unsafe')
+    if markers is not None:
+      rows, columns = self.shape
+      for column, row in markers:
+        column = int(round(column))
+        row = int(round(row))
+        if row < 0 or row >= rows or column < 0 or column >= columns:
+          continue
+        self.array[0, row, max(column - markerRadius, 0):column + markerRadius + 1] = self.markerValue
+        self.array[0, max(row - markerRadius, 0):row + markerRadius + 1, column] = self.markerValue
+    self.vtkArray.Modified()
+    self.imageData.Modified()
+    return reallocated
@@ -0,0 +1,171 @@
+"""Time offset between the image and tracker streams of a recorded sweep, and pose interpolation.
+
+The probe is swept back and forth during the recording. Both streams are reduced to a
+motion signal (how much the image content or the probe pose changes per second), the
+signals are resampled onto a common uniform time grid and cross-correlated with FFTs.
+The lag of the correlation peak is the delay of the image stream: the image with
+timestamp t shows the probe at tracker time t - offset. Times are in seconds.
+"""
+import numpy as np
+
+def midpoints(timestamps):
+  timestamps = np.asarray(timestamps, dtype=np.float64)
+  return 0.5 * (timestamps[1:] + timestamps[:-1])
+
+def imageMotionSignal(timestamps, frames, stride=2):
+  """Mean absolute intensity change per second between consecutive frames.
+
+  frames is a sequence (or iterator) of 2D or single slice 3D arrays, every stride-th row and
+  column is used. Returns the times between the frames and the signal, both of length N-1.
+  """
+  timestamps = np.asarray(timestamps, dtype=np.float64)
+  signal = np.zeros(max(len(timestamps) - 1, 0))
+  previous = None
+  for i, frame in enumerate(frames):
+    frame = np.asarray(frame)
+    current = frame.reshape(frame.shape[-2:])[::stride, ::stride].astype(np.float32)
+    if previous is not None:
+      signal[i - 1] = np.abs(current - previous).mean()
+    previous = current
+  durations = np.diff(timestamps)
+  durations[durations <= 0.0] = np.inf
+  return midpoints(timestamps), signal / durations
+
+def trackerMotionSignal(timestamps, matrices, leverArm=50.0):
+  """Speed of the probe (mm/s) between consecutive poses (N x 4 x 4).
+
+  Rotations are converted to the speed of a point leverArm mm from the tracked origin,
+  roughly where the image is, so that tilting the probe also counts as motion.
+  """
+  timestamps = np.asarray(timestamps, dtype=np.float64)
+  matrices = np.asarray(matrices, dtype=np.float64)
+  translation = np.linalg.norm(np.diff(matrices[:, 0:3, 3], axis=0), axis=1)
+  # Frobenius norm of the rotation change is sqrt(2) times the chord of the rotation angle
+  rotation = np.linalg.norm(np.diff(matrices[:, 0:3, 0:3], axis=0), axis=(1, 2)) / np.sqrt(2.0)
+  durations = np.diff(timestamps)
+  durations[durations <= 0.0] = np.inf
+  return midpoints(timestamps), (translation + leverArm * rotation) / durations
+
+def resample(times, signal, gridTimes):
+  return np.interp(gridTimes, times, signal)
+
+def normalize(signal):
+  signal = signal - signal.mean()
+  deviation = signal.std()
+  return signal / deviation if deviation > 0 else signal
+
+def estimateTimeOffset(imageTimes, imageSignal, trackerTimes, trackerSignal, maxOffset=0.5, sampleInterval=None):
+  """Delay of the image signal with respect to the tracker signal, in seconds.
+
+  Both signals are resampled every sampleInterval seconds (by default the smaller median
+  sample interval of the two) over the time span they have in common, and offsets up to
+  maxOffset in both directions are searched. The peak is refined with a parabola through
+  the neighbouring lags. Returns the offset and the normalized correlation at the peak
+  (1 for identical shapes, around 0 when the signals are unrelated).
+  """
+  imageTimes = np.asarray(imageTimes, dtype=np.float64)
+  trackerTimes = np.asarray(trackerTimes, dtype=np.float64)
+  if len(imageTimes) < 2 or len(trackerTimes) < 2:
+    raise ValueError("Temporal calibration needs at least two samples of each stream")
+  if sampleInterval is None:
+    sampleInterval = min(np.median(np.diff(imageTimes)), np.median(np.diff(trackerTimes)))
+  start = max(imageTimes[0], trackerTimes[0])
+  end = min(imageTimes[-1], trackerTimes[-1])
+  if not sampleInterval > 0 or end - start < 2 * maxOffset:
+    raise ValueError("The streams do not overlap long enough for the temporal calibration")
+  gridTimes = np.arange(start, end, sampleInterval)
+  a = normalize(resample(imageTimes, imageSignal, gridTimes))
+  b = normalize(resample(trackerTimes, trackerSignal, gridTimes))
+  n = len(gridTimes)
+  # Zero padded to at least 2n so the circular correlation equals the linear one
+  size = 1 << int(np.ceil(np.log2(2 * n)))
+  correlation = np.fft.irfft(np.fft.rfft(a, size) * np.conj(np.fft.rfft(b, size)), size)
+  maxLag = min(int(np.ceil(maxOffset / sampleInterval)), n - 1)
+  # correlation[k] = sum(a[t + k] * b[t]), negative lags are at the end
+  lags = np.arange(-maxLag, maxLag + 1)
+  values = correlation[lags] / n
+  peak = int(np.argmax(values))
+  lag = float(lags[peak])
+  if 0 < peak < len(values) - 1:
+    left, center, right = values[peak - 1], values[peak], values[peak + 1]
+    curvature = left - 2.0 * center + right
+    if curvature < 0:
+      lag += 0.5 * (left - right) / curvature
+  return lag * sampleInterval, float(values[peak])
+
+def matricesToQuaternions(matrices):
+  """Unit quaternions (N x 4, w x y z) of the rotation part of N x 4 x 4 (or N x 3 x 3) matrices."""
+  r = np.asarray(matrices, dtype=np.float64)[:, 0:3, 0:3]
+  # Largest of the four candidate components is used to avoid dividing by a small number
+  candidates = np.stack([1.0 + r[:, 0, 0] + r[:, 1, 1] + r[:, 2, 2],
+                         1.0 + r[:, 0, 0] - r[:, 1, 1] - r[:, 2, 2],
+                         1.0 - r[:, 0, 0] + r[:, 1, 1] - r[:, 2, 2],
+                         1.0 - r[:, 0, 0] - r[:, 1, 1] + r[:, 2, 2]], axis=1)
+  largest = np.argmax(candidates, axis=1)
+  s = 2.0 * np.sqrt(np.maximum(candidates[np.arange(len(r)), largest], 1e-12))
+  q = np.empty((len(r), 4))
+  case = largest == 0
+  q[case] = np.column_stack([0.25 * s[case], (r[case, 2, 1] - r[case, 1, 2]) / s[case], (r[case, 0, 2] - r[case, 2, 0]) / s[case], (r[case, 1, 0] - r[case, 0, 1]) / s[case]])
+  case = largest == 1
+  q[case] = np.column_stack([(r[case, 2, 1] - r[case, 1, 2]) / s[case], 0.25 * s[case], (r[case, 0, 1] + r[case, 1, 0]) / s[case], (r[case, 0, 2] + r[case, 2, 0]) / s[case]])
+  case = largest == 2
+  q[case] = np.column_stack([(r[case, 0, 2] - r[case, 2, 0]) / s[case], (r[case, 0, 1] + r[case, 1, 0]) / s[case], 0.25 * s[case], (r[case, 1, 2] + r[case, 2, 1]) / s[case]])
+  case = largest == 3
+  q[case] = np.column_stack([(r[case, 1, 0] - r[case, 0, 1]) / s[case], (r[case, 0, 2] + r[case, 2, 0]) / s[case], (r[case, 1, 2] + r[case, 2, 1]) / s[case], 0.25 * s[case]])
+  return q / np.linalg.norm(q, axis=1)[:, np.newaxis]
+
+def quaternionsToMatrices(q):
+  w, x, y, z = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+  r = np.empty((len(q), 3, 3))
+  r[:, 0, 0] = 1.0 - 2.0 * (y * y + z * z)
+  r[:, 0, 1] = 2.0 * (x * y - w * z)
+  r[:, 0, 2] = 2.0 * (x * z + w * y)
+  r[:, 1, 0] = 2.0 * (x * y + w * z)
+  r[:, 1, 1] = 1.0 - 2.0 * (x * x + z * z)
+  r[:, 1, 2] = 2.0 * (y * z - w * x)
+  r[:, 2, 0] = 2.0 * (x * z - w * y)
+  r[:, 2, 1] = 2.0 * (y * z + w * x)
+  r[:, 2, 2] = 1.0 - 2.0 * (x * x + y * y)
+  return r
+
+def slerp(q0, q1, fraction):
+  """Spherical linear interpolation between rows of q0 and q1 (N x 4) at fraction (N)."""
+  dot = np.sum(q0 * q1, axis=1)
+  # q and -q are the same rotation, take the shorter way
+  q1 = np.where(dot[:, np.newaxis] < 0, -q1, q1)
+  dot = np.abs(dot)
+  angle = np.arccos(np.clip(dot, -1.0, 1.0))
+  sinAngle = np.sin(angle)
+  # Nearly identical rotations are interpolated linearly
+  close = sinAngle < 1e-6
+  safeSin = np.where(close, 1.0, sinAngle)
+  w0 = np.where(close, 1.0 - fraction, np.sin((1.0 - fraction) * angle) / safeSin)
+  w1 = np.where(close, fraction, np.sin(fraction * angle) / safeSin)
+  q = w0[:, np.newaxis] * q0 + w1[:, np.newaxis] * q1
+  return q / np.linalg.norm(q, axis=1)[:, np.newaxis]
+
+def interpolatePoses(timestamps, matrices, queryTimes):
+  """Poses (M x 4 x 4) at queryTimes, interpolated from poses (N x 4 x 4) recorded at increasing timestamps.
+
+  Translations are interpolated linearly and rotations with slerp, all query times at once.
+  Query times before the first or after the last pose get the first or last pose.
+  """
+  timestamps = np.asarray(timestamps, dtype=np.float64)
+  matrices = np.asarray(matrices, dtype=np.float64)
+  queryTimes = np.atleast_1d(np.asarray(queryTimes, dtype=np.float64))
+  if len(timestamps) == 1:
+    return np.repeat(matrices[0:1], len(queryTimes), axis=0)
+  after = np.clip(np.searchsorted(timestamps, queryTimes, side='right'), 1, len(timestamps) - 1)
+  before = after - 1
+  durations = timestamps[after] - timestamps[before]
+  fraction = np.where(durations > 0, (queryTimes - timestamps[before]) / np.where(durations > 0, durations, 1.0), 0.0)
+  fraction = np.clip(fraction, 0.0, 1.0)
+  quaternions = matricesToQuaternions(matrices)
+  result = np.tile(np.eye(4), (len(queryTimes), 1, 1))
+  result[:, 0:3, 0:3] = quaternionsToMatrices(slerp(quaternions[before], quaternions[after], fraction))
+  result[:, 0:3, 3] = matrices[before, 0:3, 3] + fraction[:, np.newaxis] * (matrices[after, 0:3, 3] - matrices[before, 0:3, 3])
+  return result
+
+def framePoses(imageTimes, trackerTimes, matrices, offset):
+  """Tracker pose of every frame: the poses interpolated at the frame timestamps corrected by offset."""
+  return interpolatePoses(trackerTimes, matrices, np.asarray(imageTimes, dtype=np.float64) - offset)
@@ -0,0 +1,205 @@
+"""Labeled frames of many calibration sessions as shuffled, compressed, fixed size shards for training.
+
+Every session file is exported from a calibration session (Export Labeled Frames) and
+holds 'frames' (N x rows x columns), 'labels' (N x 2, column and row of the needle tip
+in pixels), 'poses' (N x 4 x 4 tip to probe) and 'spacing' (N x 2, mm per pixel).
+writeShards() shuffles the samples of all sessions together and writes them to
+shard-00000.npz, shard-00001.npz, ... with shardSize samples each (the last one may
+be smaller), plus index.json with the shard files, their sample counts and the
+sessions the samples came from. Every shard also stores the session and frame item of
+each of its samples.
+
+The sessions are read on a process pool, each worker writes the frames of one session
+straight into the uncompressed staging files of the shards they were shuffled into,
+then the shards are compressed on the pool. No process holds more than one session or
+one shard in memory. Sessions can be combined from the command line, e.g.:
+
+  PythonSlicer -m GuidedUSCalLib.TrainingShards --output TrainingData Session1.npz Session2.npz
+"""
+import argparse
+import concurrent.futures
+import json
+import os
+import shutil
+import zipfile
+
+import numpy as np
+
+from VASSTCommon import ProcessPool
+
+INDEX_FILE = "index.json"
+VERSION = 1
+
+def arrayHeader(path, name):
+  """Shape and dtype of an array in a .npz file, without reading the array."""
+  with zipfile.ZipFile(path) as archive:
+    with archive.open(name + ".npy") as f:
+      version = np.lib.format.read_magic(f)
+      if version == (1, 0):
+        shape, fortranOrder, dtype = np.lib.format.read_array_header_1_0(f)
+      else:
+        shape, fortranOrder, dtype = np.lib.format.read_array_header_2_0(f)
+  return shape, dtype
+
+def readSessionLabels(path):
+  """Labels, poses and spacings (N x 2, N x 4 x 4, N x 2) of a session file, poses are NaN if the file has none."""
+  with np.load(path) as data:
+    labels = np.asarray(data['labels'], dtype=np.float64).reshape(-1, 2)
+    poses = np.asarray(data['poses'], dtype=np.float64) if 'poses' in data else np.full((len(labels), 4, 4), np.nan)
+    spacing = np.asarray(data['spacing'], dtype=np.float64) if 'spacing' in data else np.ones(2)
+  return labels, poses, np.broadcast_to(spacing.reshape(-1, 2), labels.shape).copy()
+
+def stagingPath(directory, shard):
+  return os.path.join(directory, "frames-" + "{0:05d}".format(shard) + ".npy")
+
+def shardFileName(shard):
+  return "shard-" + "{0:05d}".format(shard) + ".npz"
+
+def stageSession(path, shards, slots, staging):
+  # Writes the frames of one session into the staging files at their shuffled positions, other
+  # sessions write other slots of the same files at the same time
+  with np.load(path) as data:
+    frames = data['frames']
+  for shard in np.unique(shards):
+    selected = shards == shard
+    stagedFrames = np.load(stagingPath(staging, shard), mmap_mode='r+')
+    stagedFrames[slots[selected]] = frames[selected]
+    stagedFrames.flush()
+    del stagedFrames
+  return len(frames)
+
+def compressShard(stagedPath, shardPath, labels, poses, spacings, sessions, items):
+  np.savez_compressed(shardPath, frames=np.load(stagedPath, mmap_mode='r'), labels=labels, poses=poses, spacing=spacings, sessions=sessions, items=items)
+  os.remove(stagedPath)
+  return shardPath
+
+def writeShards(paths, directory, shardSize=256, seed=0, maxWorkers=None):
+  """Shuffles the samples of the session files into shards in directory, returns the index.
+
+  Frames of all sessions must have the same size and type. maxWorkers is the number of
+  processes (default: one per CPU, 1 runs everything in this process).
+  """
+  if shardSize < 1:
+    raise ValueError("Shards need at least one sample")
+  labels = []
+  poses = []
+  spacings = []
+  sessions = []
+  items = []
+  frameShape = None
+  frameType = None
+  for i, path in enumerate(paths):
+    sessionLabels, sessionPoses, sessionSpacings = readSessionLabels(path)
+    if len(sessionLabels) == 0:
+      continue
+    shape, dtype = arrayHeader(path, 'frames')
+    if shape[0] != len(sessionLabels):
+      raise ValueError(path + " has " + str(shape[0]) + " frames but " + str(len(sessionLabels)) + " labels")
+    if frameShape is None:
+      frameShape, frameType = shape[1:], dtype
+    elif shape[1:] != frameShape or dtype != frameType:
+      raise ValueError("Frames of " + path + " are " + str(shape[1:]) + " " + str(dtype) + ", other sessions have " + str(frameShape) + " " + str(frameType))
+    labels.append(sessionLabels)
+    poses.append(sessionPoses)
+    spacings.append(sessionSpacings)
+    sessions.append(np.full(len(sessionLabels), i, dtype=np.int32))
+    items.append(np.arange(len(sessionLabels), dtype=np.int32))
+  count = sum([len(sessionLabels) for sessionLabels in labels])
+  if not os.path.isdir(directory):
+    os.makedirs(directory)
+  index = {'version': VERSION, 'shardSize': shardSize, 'samples': count, 'seed': seed,
+           'frameShape': list(frameShape) if frameShape is not None else None, 'frameType': str(frameType) if frameType is not None else None,
+           'sessions': [{'file': os.path.abspath(path), 'samples': 0} for path in paths], 'shards': []}
+  if count > 0:
+    labels = np.concatenate(labels)
+    poses = np.concatenate(poses)
+    spacings = np.concatenate(spacings)
+    sessions = np.concatenate(sessions)
+    items = np.concatenate(items)
+    # Sample i of the concatenated sessions goes to position order[i] of the concatenated shards
+    order = np.random.RandomState(seed).permutation(count)
+    shards = order // shardSize
+    slots = order % shardSize
+    numberOfShards = (count + shardSize - 1) // shardSize
+    staging = os.path.join(directory, "staging")
+    if not os.path.isdir(staging):
+      os.makedirs(staging)
+    try:
+      for shard in range(0, numberOfShards):
+        size = min(shardSize, count - shard * shardSize)
+        np.lib.format.open_memmap(stagingPath(staging, shard), mode='w+', dtype=frameType, shape=(size,) + tuple(frameShape))
+      sessionArguments = []
+      for i, path in enumerate(paths):
+        selected = sessions == i
+        index['sessions'][i]['samples'] = int(np.count_nonzero(selected))
+        if index['sessions'][i]['samples'] > 0:
+          sessionArguments.append((path, shards[selected], slots[selected], staging))
+      maxWorkers = maxWorkers or os.cpu_count()
+      ProcessPool.starmap(stageSession, sessionArguments, maxWorkers)
+      # Metadata in shard order
+      positions = np.argsort(order)
+      shardArguments = []
+      for shard in range(0, numberOfShards):
+        shardSamples = positions[shard * shardSize:(shard + 1) * shardSize]
+        shardArguments.append((stagingPath(staging, shard), os.path.join(directory, shardFileName(shard)),
+                               labels[shardSamples], poses[shardSamples], spacings[shardSamples], sessions[shardSamples], items[shardSamples]))
+        index['shards'].append({'file': shardFileName(shard), 'samples': len(shardSamples)})
+      ProcessPool.starmap(compressShard, shardArguments, maxWorkers)
+    finally:
+      shutil.rmtree(staging, ignore_errors=True)
+  with open(os.path.join(directory, INDEX_FILE), 'w') as f:
+    json.dump(index, f, indent=2)
+  return index
+
+def readIndex(directory):
+  with open(os.path.join(directory, INDEX_FILE)) as f:
+    return json.load(f)
+
+def loadShard(path):
+  with np.load(path) as data:
+    return data['frames'], data['labels'], data['poses']
+
+def readShards(directory, batchSize=32, shuffle=True, seed=None):
+  """Yields batches of (frames, labels, poses) from the shards of directory.
+
+  With shuffle the shards are read in random order and the samples of each shard are
+  shuffled again. The next shard is loaded on a thread while the current one is consumed,
+  only the last batch can have less than batchSize samples.
+  """
+  index = readIndex(directory)
+  random = np.random.RandomState(seed)
+  paths = [os.path.join(directory, shard['file']) for shard in index['shards']]
+  if shuffle:
+    paths = [paths[i] for i in random.permutation(len(paths))]
+  remainder = None
+  with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+    future = executor.submit(loadShard, paths[0]) if len(paths) > 0 else None
+    for i in range(0, len(paths)):
+      arrays = future.result()
+      if i + 1 < len(paths):
+        future = executor.submit(loadShard, paths[i + 1])
+      if shuffle:
+        order = random.permutation(len(arrays[0]))
+        arrays = [array[order] for array in arrays]
+      if remainder is not None:
+        arrays = [np.concatenate([previous, array]) for previous, array in zip(remainder, arrays)]
+      full = len(arrays[0]) - len(arrays[0]) % batchSize
+      for start in range(0, full, batchSize):
+        yield tuple(array[start:start + batchSize] for array in arrays)
+      remainder = [array[full:] for array in arrays]
+  if remainder is not None and len(remainder[0]) > 0:
+    yield tuple(remainder)
+
+def main():
+  parser = argparse.ArgumentParser(description="Combine labeled frames exported from calibration sessions into shuffled training shards.")
+  parser.add_argument("sessions", nargs="+", help="labeled frame files exported from calibration sessions")
+  parser.add_argument("--output", required=True, help="directory of the shards and index")
+  parser.add_argument("--shard-size", type=int, default=256, help="samples per shard")
+  parser.add_argument("--seed", type=int, default=0, help="seed of the shuffle")
+  parser.add_argument("--workers", type=int, default=None, help="processes, default one per CPU")
+  args = parser.parse_args()
+  index = writeShards(args.sessions, args.output, args.shard_size, args.seed, args.workers)
+  print(str(index['samples']) + " samples of " + str(len(args.sessions)) + " sessions written to " + str(len(index['shards'])) + " shards in " + args.output)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,126 @@
+import concurrent.futures
+import logging
+import threading
+
+import numpy as np
+
+class VolumeReconstructor(object):
+  """Freehand 3D reconstruction of tracked ultrasound frames into an axis aligned voxel grid.
+
+  Every pixel is transformed with the pixel to reference matrix of its frame and added to
+  the nearest voxel, voxels get the mean of the pixels that fell into them. Frames are
+  requested one at a time from the calling thread and processed in chunks on a thread
+  pool, each worker adds into its own accumulator and the accumulators are summed at
+  the end. At most two chunks per worker are held in memory, so the recording is never
+  loaded as a whole. Empty voxels between the frames can be filled with the mean of
+  their filled neighbours.
+  """
+  def __init__(self, spacing=0.5, chunkSize=16, maxWorkers=4, stride=1, fillHoleIterations=1, maxVoxels=256**3):
+    # Voxel size in mm, increased when the grid would have more than maxVoxels voxels
+    self.spacing = spacing
+    self.chunkSize = chunkSize
+    self.maxWorkers = maxWorkers
+    # Only every stride-th row and column of the frames is used
+    self.stride = stride
+    self.fillHoleIterations = fillHoleIterations
+    self.maxVoxels = maxVoxels
+
+  def grid(self, pixelToReference, frameShape):
+    """Origin, spacing and dimensions (x, y, z) of the grid that contains all frames."""
+    rows, columns = frameShape
+    corners = np.array([[0, 0, 0, 1], [columns - 1, 0, 0, 1], [0, rows - 1, 0, 1], [columns - 1, rows - 1, 0, 1]], dtype=np.float64).T
+    points = np.matmul(pixelToReference, corners)[:, 0:3, :]
+    low = points.min(axis=(0, 2))
+    high = points.max(axis=(0, 2))
+    spacing = float(self.spacing)
+    dimensions = np.floor((high - low) / spacing).astype(np.int64) + 1
+    if np.prod(dimensions) > self.maxVoxels:
+      spacing *= (float(np.prod(dimensions)) / self.maxVoxels) ** (1.0 / 3.0)
+      dimensions = np.floor((high - low) / spacing).astype(np.int64) + 1
+      logging.info("Reconstruction spacing increased to " + str(round(spacing, 3)) + " mm to stay within " + str(self.maxVoxels) + " voxels")
+    return low, spacing, dimensions
+
+  def reconstruct(self, getFrame, pixelToReference, frameShape):
+    """Reconstructs the frames getFrame(0) ... getFrame(N-1) (rows x columns) placed by pixelToReference (N x 4 x 4).
+
+    Pixel (column, row) is mapped to pixelToReference.dot([column, row, 0, 1]). Returns the
+    volume (z, y, x, float32), its origin and spacing in the reference frame.
+    """
+    pixelToReference = np.asarray(pixelToReference, dtype=np.float64)
+    origin, spacing, dimensions = self.grid(pixelToReference, frameShape)
+    numberOfVoxels = int(np.prod(dimensions))
+    rows, columns = frameShape
+    rowIndices, columnIndices = np.mgrid[0:rows:self.stride, 0:columns:self.stride]
+    # Homogeneous pixel coordinates without the (zero) slice coordinate: column, row, 1
+    pixels = np.vstack([columnIndices.ravel(), rowIndices.ravel(), np.ones(columnIndices.size)])
+
+    accumulators = []
+    lock = threading.Lock()
+    local = threading.local()
+
+    def accumulate(frames, matrices):
+      if not hasattr(local, 'sums'):
+        local.sums = np.zeros(numberOfVoxels, dtype=np.float32)
+        local.counts = np.zeros(numberOfVoxels, dtype=np.int32)
+        with lock:
+          accumulators.append((local.sums, local.counts))
+      # Positions of all pixels of all frames of the chunk: frames x 3 x pixels
+      positions = np.matmul(matrices[:, 0:3, [0, 1, 3]], pixels)
+      voxels = np.rint((positions - origin[:, np.newaxis]) / spacing).astype(np.int64)
+      inside = np.all((voxels >= 0) & (voxels < dimensions[:, np.newaxis]), axis=1)
+      indices = ((voxels[:, 2] * dimensions[1] + voxels[:, 1]) * dimensions[0] + voxels[:, 0])[inside]
+      values = frames[inside]
+      if len(indices) == 0:
+        return
+      # A chunk only covers a slab of the volume, only count within its index range
+      first = indices.min()
+      last = indices.max() + 1
+      local.sums[first:last] += np.bincount(indices - first, values, last - first)
+      local.counts[first:last] += np.bincount(indices - first, None, last - first)
+
+    numberOfFrames = len(pixelToReference)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=self.maxWorkers) as executor:
+      running = []
+      for start in range(0, numberOfFrames, self.chunkSize):
+        end = min(start + self.chunkSize, numberOfFrames)
+        frames = np.empty((end - start, pixels.shape[1]), dtype=np.float32)
+        for i in range(start, end):
+          frames[i - start] = np.asarray(getFrame(i))[::self.stride, ::self.stride].ravel()
+        running.append(executor.submit(accumulate, frames, pixelToReference[start:end]))
+        if len(running) >= 2 * self.maxWorkers:
+          running.pop(0).result()
+      for future in running:
+        future.result()
+
+    sums = np.zeros(numberOfVoxels, dtype=np.float32)
+    counts = np.zeros(numberOfVoxels, dtype=np.int32)
+    for threadSums, threadCounts in accumulators:
+      sums += threadSums
+      counts += threadCounts
+    shape = (dimensions[2], dimensions[1], dimensions[0])
+    sums = sums.reshape(shape)
+    counts = counts.reshape(shape)
+    filled = counts > 0
+    volume = np.zeros(shape, dtype=np.float32)
+    volume[filled] = sums[filled] / counts[filled]
+    for i in range(0, self.fillHoleIterations):
+      volume, filled = fillHoles(volume, filled)
+    return volume, origin, spacing
+
+def boxSum(array):
+  # Sum over the 3 x 3 x 3 neighbourhood of every voxel, computed axis by axis
+  result = array
+  for axis in range(0, 3):
+    padded = np.pad(result, [(1, 1) if a == axis else (0, 0) for a in range(0, 3)], mode='constant')
+    length = result.shape[axis]
+    result = np.take(padded, range(0, length), axis=axis) + np.take(padded, range(1, length + 1), axis=axis) + np.take(padded, range(2, length + 2), axis=axis)
+  return result
+
+def fillHoles(volume, filled):
+  """Sets empty voxels with at least one filled neighbour to the mean of their filled neighbours."""
+  sums = boxSum(np.where(filled, volume, 0.0).astype(np.float32))
+  counts = boxSum(filled.astype(np.float32))
+  holes = ~filled & (counts > 0)
+  volume = volume.copy()
+  volume[holes] = sums[holes] / counts[holes]
+  return volume, filled | holes
@@ -0,0 +1,8 @@
+from .CalibrationHistory import CalibrationHistory
+from .DetectionScheduler import DetectionScheduler
+from .FrameGate import FrameGate
+from .NeedleDetector import NeedleDetection, NeedleDetector
+from .NeedleTracker import NeedleTracker
+from .SceneNodeIndex import SceneNodeIndex
+from .SharedImageBuffer import SharedImageBuffer
+from .VolumeReconstructor import VolumeReconstructor
@@ -1,10 +1,20 @@
 import os
+import socket
 import unittest
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import numpy as np
 import logging
-import tempfile
+from VRVisionExperimentLib import BackgroundWriter, DwellDetector, ExperimentSession, FrameMonitor, PosePublisher, PoseSubscriber, ReplayPath, TargetSequenceError, TargetSequenceLoader, TrialStore, trialKey
+from VRVisionExperimentLib import Simulation
+from VRVisionExperimentLib.TrialAnalysis import analyzeParticipant, mergeResults, summarizeByCondition
+from VASSTCommon import ProcessPool
+from VASSTCommon.TransformUtils import arrayFromMatrix, matrixFromArray, positionFromMatrix, updateMatrixFromArray, updateMatrixFromTranslation
+
+ROOM_WALLS = ['Back', 'Front', 'Left', 'Right', 'Roof', 'Floor']
+
+# Meshes and transforms read from the module resources, loaded once per process and shared by all logic instances
+assetCache = {}
 
 # VRVisionExperiment
 class VRVisionExperiment(ScriptedLoadableModule):
@@ -18,8 +28,22 @@ class VRVisionExperiment(ScriptedLoadableModule):
     self.parent.helpText += self.getDefaultModuleDocumentationLink()
     self.parent.acknowledgementText = """This module was developed through funding provided by the BrainsCAN initiative."""
 
+def sessionProperty(name):
+  # Widget attribute that is stored on the experiment session of the logic
+  return property(lambda self: getattr(self.logic.session, name), lambda self, value: setattr(self.logic.session, name, value))
+
 # VRVisionExperimentWidget
 class VRVisionExperimentWidget(ScriptedLoadableModuleWidget):
+  isStarted = sessionProperty('started')
+  capturedSequence = sessionProperty('capturedSequence')
+  currentReferenceSequence = sessionProperty('currentReferenceSequence')
+  currentIndex = sessionProperty('currentIndex')
+  floorHeight = sessionProperty('floorHeight')
+  facePosition = sessionProperty('facePosition')
+  poseRecorder = sessionProperty('recorder')
+  dwellDetector = sessionProperty('dwellDetector')
+  writer = sessionProperty('writer')
+
   def __init__(self, parent=None):
     ScriptedLoadableModuleWidget.__init__(self, parent)
 
@@ -36,19 +60,19 @@ class VRVisionExperimentWidget(ScriptedLoadableModuleWidget):
     self.cubeModelRight = None
     self.cubeModelRoof = None
     self.cubeModelFloor = None
-    self.transformNodeBack = None
-    self.transformNodeFront = None
-    self.transformNodeLeft = None
-    self.transformNodeRight = None
-    self.transformNodeRoof = None
-    self.transformNodeFloor = None
+    self.cubeTransformBack = None
+    self.cubeTransformFront = None
+    self.cubeTransformLeft = None
+    self.cubeTransformRight = None
+    self.cubeTransformRoof = None
+    self.cubeTransformFloor = None
     self.rootCubeTransformNode = None
     self.sphereTransformNode = None
 
     self.isInit = False
-    self.isStarted = False
 
     self.initButton = None
+    self.clearSceneCheckBox = None
     self.startButton = None
     self.previousButton = None
     self.nextButton = None
@@ -56,8 +80,6 @@ class VRVisionExperimentWidget(ScriptedLoadableModuleWidget):
     self.saveButton = None
     self.resetButton = None
 
-    self.captureTimer = qt.QElapsedTimer()
-
     self.participantIdLineEdit = None
     self.inputsGroupBox = None
     self.trialNumberSpinBox = None
@@ -72,26 +94,65 @@ class VRVisionExperimentWidget(ScriptedLoadableModuleWidget):
     self.nomotionSequenceButton = None
     self.replaySequenceButton = None
 
+    self.replayGroupBox = None
+    self.replayRecordingComboBox = None
+    self.replayStreamComboBox = None
+    self.replayLoadButton = None
+    self.replayPlayButton = None
+    self.replayExportButton = None
+
     self.controlGroupBox = None
     self.showControllerCheckBox = None
     self.showNeedleCheckBox = None
     self.showSphereCheckBox = None
+    self.autoCaptureCheckBox = None
+
+    self.streamGroupBox = None
+    self.streamCheckBox = None
+    self.streamHostLineEdit = None
+    self.streamPortSpinBox = None
+    self.streamRateSpinBox = None
 
     self.resultGroupBox = None
     self.resultLabel = None
+    self.frameLabel = None
+    self.analyzeButton = None
 
     self.motionSequence = []
     self.nomotionSequence = []
     self.replaySequence = []
 
-    self.capturedSequence = []
-    self.currentReferenceSequence = []
-    self.currentIndex = 0
-
-    self.floorHeight = 0.0
-    self.facePosition = []
-
-    self.savedSequenceFiles = []
+    self.outputDirectoryPathLineEdit = None
+
+    # Controller and HMD poses are sampled into the preallocated arrays of the session recorder during a capture
+    self.poseObservations = []
+    self.recorderMatrix = vtk.vtkMatrix4x4()
+
+    # Latest poses are streamed to a monitoring workstation from the publisher thread while streaming is on
+    self.posePublisher = None
+    self.streamPose = np.eye(4)
+
+    # VR render timing and time spent in module callbacks, saved with each trial
+    self.frameMonitor = FrameMonitor()
+    self.frameObservations = []
+    self.frameTimer = qt.QTimer()
+    self.frameTimer.setInterval(1000)
+
+    # Replay of a recorded trajectory, the sphere position is updated at the start of every VR frame
+    self.replaying = False
+    self.replayPath = None
+    self.replaySource = None
+    self.replayStorePath = ""
+    self.replayPoints = []
+    self.replayStartTime = 0.0
+    self.replayMatrix = vtk.vtkMatrix4x4()
+    self.replayArray = np.eye(4)
+    # Path replayed towards every target of a trial in the Replay condition
+    self.conditionReplayPath = None
+
+    # Captured sequences are written to disk off the main thread by the session writer
+    self.writerTimer = qt.QTimer()
+    self.writerTimer.setInterval(100)
 
   def setup(self):
     ScriptedLoadableModuleWidget.setup(self)
@@ -99,9 +160,17 @@ class VRVisionExperimentWidget(ScriptedLoadableModuleWidget):
     self.layout.setContentsMargins(6,6,6,6)
 
     # Init Button
+    widget = qt.QWidget()
+    layout = qt.QHBoxLayout(widget)
+    layout.setContentsMargins(0,0,0,0)
     self.initButton = qt.QPushButton("Initialize")
     self.initButton.toolTip = "Initialize VR system, controllers, and room."
-    self.layout.addWidget(self.initButton)
+    self.clearSceneCheckBox = qt.QCheckBox("Clear scene")
+    self.clearSceneCheckBox.toolTip = "Clear the whole scene and recreate the room. Otherwise the existing room, sphere and needle are reused."
+    self.clearSceneCheckBox.checked = False
+    layout.addWidget(self.initButton, 1)
+    layout.addWidget(self.clearSceneCheckBox)
+    self.layout.addWidget(widget)
 
     # Calibration buttons
     self.calibrateGroupBox = qt.QGroupBox("Calibrations")
@@ -131,9 +200,14 @@ class VRVisionExperimentWidget(ScriptedLoadableModuleWidget):
     self.trialNumberSpinBox.setValue(1)
     self.trialNumberSpinBox.setSingleStep(1)
     self.trialNumberSpinBox.setMinimum(1)
+    self.outputDirectoryPathLineEdit = ctk.ctkPathLineEdit()
+    self.outputDirectoryPathLineEdit.filters = ctk.ctkPathLineEdit.Dirs
+    self.outputDirectoryPathLineEdit.currentPath = qt.QDir.homePath()
+    self.outputDirectoryPathLineEdit.toolTip = "Directory of the participant trial files."
     layout.addRow("Participant ID:", self.participantIdLineEdit)
     layout.addRow("Condition:", self.conditionComboBox)
     layout.addRow("Trial Number:", self.trialNumberSpinBox)
+    layout.addRow("Output directory:", self.outputDirectoryPathLineEdit)
     self.layout.addWidget(self.inputsGroupBox)
 
     # Sequences loading
@@ -147,6 +221,37 @@ class VRVisionExperimentWidget(ScriptedLoadableModuleWidget):
     layout.addWidget(self.replaySequenceButton)
     self.layout.addWidget(self.sequenceGroupBox)
 
+    # Replay of a recorded trajectory
+    self.replayGroupBox = qt.QGroupBox("Replay Path")
+    self.replayGroupBox.enabled = False
+    layout = qt.QFormLayout(self.replayGroupBox)
+    widget = qt.QWidget()
+    rowLayout = qt.QHBoxLayout(widget)
+    rowLayout.setContentsMargins(0,0,0,0)
+    self.replayRecordingComboBox = qt.QComboBox()
+    self.replayRecordingComboBox.toolTip = "Recorded point whose trajectory the sphere follows. In the Replay condition it is replayed towards every target."
+    self.replayLoadButton = qt.QPushButton("Load...")
+    self.replayLoadButton.toolTip = "Select a participant trial file to replay from."
+    rowLayout.addWidget(self.replayRecordingComboBox, 1)
+    rowLayout.addWidget(self.replayLoadButton)
+    self.replayStreamComboBox = qt.QComboBox()
+    self.replayStreamComboBox.addItems(["Controller", "HMD"])
+    self.replayPlayButton = qt.QPushButton("Play")
+    self.replayPlayButton.toolTip = "Move the sphere along the recorded trajectory with its original timing."
+    self.replayPlayButton.enabled = False
+    self.replayExportButton = qt.QPushButton("Load as Sequence")
+    self.replayExportButton.toolTip = "Load the recorded trajectory as a sequence of transforms, e.g. to browse or export it with the Sequences module."
+    self.replayExportButton.enabled = False
+    layout.addRow("Recording:", widget)
+    layout.addRow("Trajectory:", self.replayStreamComboBox)
+    widget = qt.QWidget()
+    rowLayout = qt.QHBoxLayout(widget)
+    rowLayout.setContentsMargins(0,0,0,0)
+    rowLayout.addWidget(self.replayPlayButton)
+    rowLayout.addWidget(self.replayExportButton)
+    layout.addRow(widget)
+    self.layout.addWidget(self.replayGroupBox)
+
     # Control UI
     self.controlGroupBox = qt.QGroupBox("Controls")
     layout = qt.QFormLayout(self.controlGroupBox)
@@ -156,8 +261,31 @@ class VRVisionExperimentWidget(ScriptedLoadableModuleWidget):
     layout.addRow("Show controller: ", self.showControllerCheckBox)
     layout.addRow("Show needle: ", self.showNeedleCheckBox)
     layout.addRow("Show sphere: ", self.showSphereCheckBox)
+    self.autoCaptureCheckBox = qt.QCheckBox()
+    self.autoCaptureCheckBox.toolTip = "Start recording when a target is shown, capture when the controller rests on it and move to the next target."
+    layout.addRow("Automatic capture: ", self.autoCaptureCheckBox)
     self.layout.addWidget(self.controlGroupBox)
 
+    # Pose streaming UI
+    self.streamGroupBox = qt.QGroupBox("Pose Streaming")
+    layout = qt.QFormLayout(self.streamGroupBox)
+    self.streamHostLineEdit = qt.QLineEdit("127.0.0.1")
+    self.streamHostLineEdit.toolTip = "Address of the monitoring workstation"
+    self.streamPortSpinBox = qt.QSpinBox()
+    self.streamPortSpinBox.setRange(1, 65535)
+    self.streamPortSpinBox.value = 18950
+    self.streamRateSpinBox = qt.QSpinBox()
+    self.streamRateSpinBox.setRange(1, 240)
+    self.streamRateSpinBox.value = 60
+    self.streamRateSpinBox.suffix = " Hz"
+    self.streamCheckBox = qt.QCheckBox()
+    self.streamCheckBox.toolTip = "Send the controller, HMD and target poses as UDP messages, receive them with python -m VRVisionExperimentLib.PoseStreaming"
+    layout.addRow("Host: ", self.streamHostLineEdit)
+    layout.addRow("Port: ", self.streamPortSpinBox)
+    layout.addRow("Rate: ", self.streamRateSpinBox)
+    layout.addRow("Stream poses: ", self.streamCheckBox)
+    self.layout.addWidget(self.streamGroupBox)
+
     # Capture related buttons
     widget = qt.QWidget()
     layout = qt.QHBoxLayout(widget)
@@ -190,9 +318,19 @@ class VRVisionExperimentWidget(ScriptedLoadableModuleWidget):
 
     # Results box
     self.resultGroupBox = qt.QGroupBox("Results")
-    layout = qt.QHBoxLayout(self.resultGroupBox)
+    layout = qt.QVBoxLayout(self.resultGroupBox)
+    widget = qt.QWidget()
+    rowLayout = qt.QHBoxLayout(widget)
+    rowLayout.setContentsMargins(0,0,0,0)
     self.resultLabel = qt.QLabel("")
-    layout.addWidget(self.resultLabel)
+    rowLayout.addWidget(self.resultLabel)
+    self.analyzeButton = qt.QPushButton("Analyze...")
+    self.analyzeButton.toolTip = "Summarize saved participant trial files per condition."
+    rowLayout.addWidget(self.analyzeButton)
+    layout.addWidget(widget)
+    self.frameLabel = qt.QLabel("")
+    self.frameLabel.toolTip = "VR rendering over the last frames."
+    layout.addWidget(self.frameLabel)
     self.layout.addWidget(self.resultGroupBox)
 
     self.doConnect()
@@ -210,10 +348,13 @@ class VRVisionExperimentWidget(ScriptedLoadableModuleWidget):
     self.saveButton.connect('clicked(bool)', self.onSaveButton)
     self.resetButton.connect('clicked(bool)', self.onResetButton)
     self.captureButton.connect('clicked(bool)', self.onCaptureButton)
+    self.analyzeButton.connect('clicked(bool)', self.onAnalyzeButton)
 
     self.showControllerCheckBox.connect('stateChanged(int)', self.onShowControllerCheckBox)
     self.showNeedleCheckBox.connect('stateChanged(int)', self.onShowNeedleCheckBox)
     self.showSphereCheckBox.connect('stateChanged(int)', self.onShowSphereCheckBox)
+    self.autoCaptureCheckBox.connect('toggled(bool)', self.onAutoCaptureToggled)
+    self.streamCheckBox.connect('toggled(bool)', self.onStreamToggled)
 
     self.floorButton.connect('clicked(bool)', self.onFloorButton)
     self.faceButton.connect('clicked(bool)', self.onFaceButton)
@@ -222,6 +363,13 @@ class VRVisionExperimentWidget(ScriptedLoadableModuleWidget):
     self.nomotionSequenceButton.connect('clicked(bool)', self.onLoadNoMotionButton)
     self.replaySequenceButton.connect('clicked(bool)', self.onLoadReplayButton)
 
+    self.writerTimer.connect('timeout()', self.onWriterTimer)
+    self.frameTimer.connect('timeout()', self.onFrameTimer)
+
+    self.replayLoadButton.connect('clicked(bool)', self.onReplayLoadButton)
+    self.replayPlayButton.connect('clicked(bool)', self.onReplayPlayButton)
+    self.replayExportButton.connect('clicked(bool)', self.onReplayExportButton)
+
   def safeDisconnect(self, obj, functionName, function):
     if obj is not None and hasattr(obj, "disconnect"):
       obj.disconnect(functionName, function)
@@ -235,10 +383,14 @@ class VRVisionExperimentWidget(ScriptedLoadableModuleWidget):
     self.safeDisconnect(self.saveButton, 'clicked(bool)', self.onSaveButton)
     self.safeDisconnect(self.resetButton, 'clicked(bool)', self.onResetButton)
     self.safeDisconnect(self.captureButton, 'clicked(bool)', self.onCaptureButton)
+    self.safeDisconnect(self.analyzeButton, 'clicked(bool)', self.onAnalyzeButton)
 
     self.safeDisconnect(self.showControllerCheckBox, 'stateChanged(int)', self.onShowControllerCheckBox)
     self.safeDisconnect(self.showNeedleCheckBox, 'stateChanged(int)', self.onShowNeedleCheckBox)
     self.safeDisconnect(self.showSphereCheckBox, 'stateChanged(int)', self.onShowSphereCheckBox)
+    self.safeDisconnect(self.autoCaptureCheckBox, 'toggled(bool)', self.onAutoCaptureToggled)
+    self.safeDisconnect(self.streamCheckBox, 'toggled(bool)', self.onStreamToggled)
+    self.stopStreaming()
 
     self.safeDisconnect(self.floorButton, 'clicked(bool)', self.onFloorButton)
     self.safeDisconnect(self.faceButton, 'clicked(bool)', self.onFaceButton)
@@ -247,12 +399,27 @@ class VRVisionExperimentWidget(ScriptedLoadableModuleWidget):
     self.safeDisconnect(self.nomotionSequenceButton, 'clicked(bool)', self.onLoadNoMotionButton)
     self.safeDisconnect(self.replaySequenceButton, 'clicked(bool)', self.onLoadReplayButton)
 
+    self.removePoseObservers()
+    self.removeFrameObservers()
+    self.safeDisconnect(self.frameTimer, 'timeout()', self.onFrameTimer)
+
+    self.replaying = False
+    self.safeDisconnect(self.replayLoadButton, 'clicked(bool)', self.onReplayLoadButton)
+    self.safeDisconnect(self.replayPlayButton, 'clicked(bool)', self.onReplayPlayButton)
+    self.safeDisconnect(self.replayExportButton, 'clicked(bool)', self.onReplayExportButton)
+
+    # Make sure every captured sequence reaches the disk before the module goes away
+    self.writerTimer.stop()
+    self.safeDisconnect(self.writerTimer, 'timeout()', self.onWriterTimer)
+    self.writer.shutdown()
+    self.onWriterTimer()
+
   def onFloorButton(self):
     # Record current Z position of controller as floor
     controllerNode = slicer.mrmlScene.GetNodeByID(self.needleModelNode.GetTransformNodeID())
     mat = vtk.vtkMatrix4x4()
     controllerNode.GetMatrixTransformToParent(mat)
-    self.floorHeight = mat.GetElement(2, 3)
+    self.logic.session.calibrateFloor(positionFromMatrix(mat).tolist())
     self.updateRoomPosition()
     self.resultLabel.text = "Floor position detected as " + str(self.floorHeight) + "."
 
@@ -261,23 +428,26 @@ class VRVisionExperimentWidget(ScriptedLoadableModuleWidget):
     controllerNode = slicer.mrmlScene.GetNodeByID(self.needleModelNode.GetTransformNodeID())
     mat = vtk.vtkMatrix4x4()
     controllerNode.GetMatrixTransformToParent(mat)
-    x = mat.GetElement(0, 3)
-    y = mat.GetElement(1, 3)
-    z = mat.GetElement(2, 3)
-    self.facePosition = [x,y,z]
+    x, y, z = positionFromMatrix(mat).tolist()
+    self.setFacePosition([x,y,z])
     self.updateRoomPosition()
     self.resultLabel.text = "Face position detected as " + str(x) + ", " + str(y) + ", " + str(z) + "."
 
+  def setFacePosition(self, facePosition):
+    # Reference targets are converted to world coordinates once here, not for every target
+    self.logic.session.setFacePosition(facePosition)
+
   def updateRoomPosition(self):
     # Update cube root position so that the room is centered about the headset
     cubeMat = vtk.vtkMatrix4x4()
     self.rootCubeTransformNode.GetMatrixTransformToParent(cubeMat)
     hmdMat = vtk.vtkMatrix4x4()
     self.vrView.mrmlVirtualRealityViewNode().GetHMDTransformNode().GetMatrixTransformToParent(hmdMat)
-    cubeMat.SetElement(0, 3, hmdMat.GetElement(0, 3))
-    cubeMat.SetElement(1, 3, hmdMat.GetElement(1, 3))
+    cube = arrayFromMatrix(cubeMat)
+    cube[0:2, 3] = positionFromMatrix(hmdMat)[0:2]
     # Calculate the height of the cube as 1m off the floor (cube is 2m, centered at 1m)
-    cubeMat.SetElement(2, 3, self.floorHeight + 1000.0)
+    cube[2, 3] = self.floorHeight + 1000.0
+    updateMatrixFromArray(cubeMat, cube)
     self.rootCubeTransformNode.SetMatrixTransformToParent(cubeMat)
 
   def onShowControllerCheckBox(self, newState):
@@ -300,119 +470,336 @@ class VRVisionExperimentWidget(ScriptedLoadableModuleWidget):
     if len(self.currentReferenceSequence) == 0:
       self.error("Unable to load reference sequence.")
       return()
+    if self.replaying:
+      self.stopReplay()
+    self.conditionReplayPath = None
+    if self.conditionComboBox.currentText == "Replay":
+      # The sphere moves to every target along the recorded trajectory selected for replay
+      if len(self.replayPoints) == 0:
+        self.error("Select a recorded trajectory under Replay Path for the Replay condition.")
+        return()
+      self.conditionReplayPath = self.loadSelectedReplayPath()
+      if self.conditionReplayPath is None:
+        return()
+    # Frame timing and replay presentation are saved per trial
+    self.frameMonitor.clear()
+    self.replayPath = None
 
     # Show sphere and move to first position in currentReferenceSequence position, relative to "home" position
     self.showSphereCheckBox.setChecked(True)
     self.sphereModelNode.GetDisplayNode().SetVisibility(True)
-    self.currentIndex = 0
-    self.onCurrentIndexChanged()
 
-    # Resize capture list to the size of the reference list
-    self.capturedSequence = []
-    for i in range(0, len(self.currentReferenceSequence)):
-      self.capturedSequence.append([0,0,0])
-    self.savedSequenceFiles = []
-
-    self.isStarted = True
+    session = self.logic.session
+    session.outputDirectory = self.outputDirectoryPathLineEdit.currentPath
+    session.participantId = self.participantIdLineEdit.text
+    session.startTrial(self.trialNumberSpinBox.value, self.conditionComboBox.currentText, self.currentReferenceSequence)
+    self.onCurrentIndexChanged()
     self.updateUI()
 
   def onNextButton(self):
-    self.currentIndex = min(self.currentIndex + 1, len(self.currentReferenceSequence)-1)
+    self.logic.session.setCurrentIndex(self.currentIndex + 1)
     self.onCurrentIndexChanged()
 
   def onPreviousButton(self):
-    self.currentIndex = max(self.currentIndex - 1, 0)
+    self.logic.session.setCurrentIndex(self.currentIndex - 1)
     self.onCurrentIndexChanged()
 
   def onCurrentIndexChanged(self):
-    # Transform point in face coord system to world/RAS coord system
-    _point_face = np.asarray([[self.currentReferenceSequence[self.currentIndex][0]],
-                         [self.currentReferenceSequence[self.currentIndex][1]],
-                         [self.currentReferenceSequence[self.currentIndex][2]],
-                         [1.0]], dtype=np.float64)
-    _faceToWorld = np.asmatrix(np.eye(4))
-    _faceToWorld[0, 3] = self.facePosition[0]
-    _faceToWorld[1, 3] = self.facePosition[1]
-    _faceToWorld[2, 3] = self.facePosition[2]
-    _point_world = _faceToWorld * _point_face
-    mat = vtk.vtkMatrix4x4()
-    mat.SetElement(0, 3, _point_world[0,0])
-    mat.SetElement(1, 3, _point_world[1,0])
-    mat.SetElement(2, 3, _point_world[2,0])
-    self.sphereTransformNode.SetMatrixTransformToParent(mat)
-    self.resultLabel.text = "Now capturing index " + str(self.currentIndex+1) + " of " + str(len(self.currentReferenceSequence)) + "."
+    with self.frameMonitor.timed("onCurrentIndexChanged"):
+      self.sphereTransformNode.SetMatrixTransformToParent(self.logic.targetToWorldMatrix(self.currentIndex))
+      self.publishTarget(self.logic.session.worldTargets[self.currentIndex])
+      self.resultLabel.text = "Now capturing index " + str(self.currentIndex+1) + " of " + str(len(self.currentReferenceSequence)) + "."
+      # Changing the index cancels a capture in progress
+      self.captureButton.text = "Go!"
+      if self.isStarted and self.autoCaptureCheckBox.checked:
+        self.startAutoCapture()
+      if self.isStarted and self.conditionReplayPath is not None:
+        if self.replaying:
+          self.stopReplay()
+        self.conditionReplayPath.moveEndTo(self.logic.session.referenceSequence[self.currentIndex])
+        self.conditionReplayPath.setFaceToWorld(self.logic.session.faceToWorld)
+        self.startReplay(self.conditionReplayPath)
+
+  def onStreamToggled(self, checked):
+    if not checked:
+      self.stopStreaming()
+      return()
+    publisher = PosePublisher(self.streamHostLineEdit.text, self.streamPortSpinBox.value, self.streamRateSpinBox.value)
+    try:
+      publisher.start()
+    except (OSError, socket.error) as e:
+      self.error("Unable to stream poses to " + self.streamHostLineEdit.text + ": " + str(e))
+      self.streamCheckBox.checked = False
+      return()
+    self.posePublisher = publisher
+    if self.isStarted:
+      self.publishTarget(self.logic.session.worldTargets[self.currentIndex])
+    for widget in [self.streamHostLineEdit, self.streamPortSpinBox, self.streamRateSpinBox]:
+      widget.enabled = False
+
+  def stopStreaming(self):
+    if self.posePublisher is not None:
+      self.posePublisher.stop()
+      self.posePublisher = None
+    for widget in [self.streamHostLineEdit, self.streamPortSpinBox, self.streamRateSpinBox]:
+      if widget is not None:
+        widget.enabled = True
+
+  def publishTarget(self, position):
+    if self.posePublisher is not None:
+      self.posePublisher.updatePosition('Target', position, self.poseRecorder.clock())
+      self.posePublisher.setState(self.logic.session.trialNumber, self.currentIndex)
+
+  def onAutoCaptureToggled(self, checked):
+    if checked and self.isStarted:
+      self.startAutoCapture()
+    else:
+      self.logic.session.stopAutoCapture()
+
+  def startAutoCapture(self):
+    self.logic.session.startAutoCapture()
+    self.captureButton.text = "Capture"
 
   def onCaptureButton(self):
-    if self.captureButton.text == "Go!":
-      self.captureTimer.start()
-      self.captureButton.text = "Capture"
-      self.toolSequenceNode.RemoveAllDataNodes()
-      self.hmdSequenceNode.RemoveAllDataNodes()
-      self.sequenceBrowserNode.RecordingActiveOn()
-    else:
-      timeElapsed = self.captureTimer.elapsed()
-      self.sequenceBrowserNode.RecordingActiveOff()
-
-      # Save sequences for this point into a temporary filename
-      # For now, save into two files, _controller and _hmd
-      proto_filename = os.path.join(tempfile.tempdir, "participant" + self.participantIdLineEdit.text + "_trial" + str(self.trialNumberSpinBox.value) + "_" + self.conditionComboBox.currentText)
-      result = slicer.util.saveNode(self.toolSequenceNode, proto_filename + '_controller.seq.mha')
-      if not result:
-        self.error("Unable to save controller path file. Please see Slicer error log.")
-      else:
-        self.savedSequenceFiles.append(proto_filename + '_controller.seq.mha')
-      result = slicer.util.saveNode(self.hmdSequenceNode, proto_filename + '_hmd.seq.mha')
-      if not result:
-        self.error("Unable to save hmd path file. Please see Slicer error log.")
+    with self.frameMonitor.timed("onCaptureButton"):
+      if self.captureButton.text == "Go!":
+        self.logic.session.startCapture()
+        self.captureButton.text = "Capture"
       else:
-        self.savedSequenceFiles.append(proto_filename + '_hmd.seq.mha')
+        self.finishCapture()
 
-      self.captureButton.text = "Go!"
-      controllerNode = slicer.mrmlScene.GetNodeByID(self.needleModelNode.GetTransformNodeID())
-      mat = vtk.vtkMatrix4x4()
-      controllerNode.GetMatrixTransformToParent(mat)
-      x = mat.GetElement(0, 3)
-      y = mat.GetElement(1, 3)
-      z = mat.GetElement(2, 3)
-      _worldToFace = np.asmatrix(np.eye(4))
-      _worldToFace[0, 3] = -self.facePosition[0]
-      _worldToFace[1, 3] = -self.facePosition[1]
-      _worldToFace[2, 3] = -self.facePosition[2]
-      _point_world = np.asarray([[x],[y],[z],[1.0]], dtype=np.float64)
-      _point_face = _worldToFace * _point_world
-      self.capturedSequence[self.currentIndex] = [ [_point_face[0,0], _point_face[1,0], _point_face[2,0]], self.currentReferenceSequence[self.currentIndex], timeElapsed ]
-      self.updateUI()
-      self.resultLabel.text = "Point for index " + str(self.currentIndex+1) + " collected."
+  def finishCapture(self):
+    # Capture the current controller position
+    controllerNode = slicer.mrmlScene.GetNodeByID(self.needleModelNode.GetTransformNodeID())
+    mat = vtk.vtkMatrix4x4()
+    controllerNode.GetMatrixTransformToParent(mat)
+    self.logic.session.finishCapture(positionFromMatrix(mat).tolist())
+    self.onCaptureFinished()
 
-  def onSaveButton(self):
-    # Build filename string
-    proto_filename = "participant" + self.participantIdLineEdit.text + "_trial" + str(self.trialNumberSpinBox.value) + "_" + self.conditionComboBox.currentText + ".txt"
-    filename = qt.QFileDialog.getSaveFileName(slicer.util.mainWindow(), "Save sequence", proto_filename)
-    if filename == '':
-      self.resultLabel.text = "File not saved."
+  def onCaptureFinished(self):
+    self.writerTimer.start()
+    self.captureButton.text = "Go!"
+    self.updateUI()
+    self.resultLabel.text = "Point for index " + str(self.currentIndex+1) + " collected."
+
+  def onDwellDetected(self, capture):
+    # The capture may have finished, or another one started, since the dwell was detected
+    if not self.isStarted or not self.logic.session.dwellCaptureActive(capture):
+      return()
+    with self.frameMonitor.timed("onDwellDetected"):
+      self.logic.session.captureAtDwell()
+      self.onCaptureFinished()
+    if self.currentIndex < len(self.currentReferenceSequence) - 1:
+      self.logic.session.setCurrentIndex(self.currentIndex + 1)
+      self.onCurrentIndexChanged()
+    else:
+      self.resultLabel.text = "All " + str(len(self.currentReferenceSequence)) + " points collected."
+
+  def addPoseObservers(self, controllerNode, hmdNode):
+    self.removePoseObservers()
+    for node, name in [(controllerNode, 'Controller'), (hmdNode, 'HMD')]:
+      tag = node.AddObserver(slicer.vtkMRMLTransformNode.TransformModifiedEvent, lambda caller, event, name=name: self.onPoseModified(caller, name))
+      self.poseObservations.append((node, tag))
+
+  def removePoseObservers(self):
+    for node, tag in self.poseObservations:
+      node.RemoveObserver(tag)
+    self.poseObservations = []
+
+  def onPoseModified(self, transformNode, name):
+    # Called for every controller/HMD update, write the matrix straight into the recorder storage
+    slot = self.poseRecorder.reserve(name)
+    fetched = slot is not None
+    if fetched:
+      transformNode.GetMatrixTransformToParent(self.recorderMatrix)
+      self.recorderMatrix.DeepCopy(slot, self.recorderMatrix)
+    if self.posePublisher is not None:
+      if not fetched:
+        transformNode.GetMatrixTransformToParent(self.recorderMatrix)
+        fetched = True
+      self.recorderMatrix.DeepCopy(self.streamPose.ravel(), self.recorderMatrix)
+      self.posePublisher.update(name, self.streamPose, self.poseRecorder.clock())
+    if name == 'Controller' and self.dwellDetector.armed():
+      if not fetched:
+        transformNode.GetMatrixTransformToParent(self.recorderMatrix)
+      position = positionFromMatrix(self.recorderMatrix)
+      if self.logic.session.updateDwell(self.poseRecorder.clock(), position) == DwellDetector.DWELL:
+        # Do not modify the scene from within the transform observer
+        capture = self.logic.session.dwellCapture
+        qt.QTimer.singleShot(0, lambda: self.onDwellDetected(capture))
+
+  def addFrameObservers(self, renderWindow):
+    self.removeFrameObservers()
+    for event, callback in [(vtk.vtkCommand.StartEvent, self.onVRFrameStarted), (vtk.vtkCommand.EndEvent, self.onVRFrameEnded)]:
+      tag = renderWindow.AddObserver(event, lambda caller, event, callback=callback: callback())
+      self.frameObservations.append((renderWindow, tag))
+    self.frameTimer.start()
+
+  def removeFrameObservers(self):
+    for renderWindow, tag in self.frameObservations:
+      renderWindow.RemoveObserver(tag)
+    self.frameObservations = []
+    self.frameTimer.stop()
+
+  def onVRFrameStarted(self):
+    self.frameMonitor.frameStarted()
+    if self.replaying:
+      self.updateReplay()
+
+  def onVRFrameEnded(self):
+    self.frameMonitor.frameEnded()
+    if self.replaying:
+      self.replayPath.framePresented(self.poseRecorder.clock() - self.replayStartTime)
+
+  def onFrameTimer(self):
+    statistics = self.frameMonitor.statistics()
+    if statistics['frames'] == 0:
+      self.frameLabel.text = "No VR frames rendered."
       return()
+    self.frameLabel.text = ("VR: {0:.0f} fps, render {1:.1f} ms (95%: {2:.1f} ms, max {3:.1f} ms), ".format(statistics['frameRate'],
+      1000.0 * statistics['meanRenderTime'], 1000.0 * statistics['p95RenderTime'], 1000.0 * statistics['maxRenderTime'])
+      + str(statistics['lateFrames']) + " late, " + str(statistics['droppedFrames']) + " dropped")
 
-    with open(filename, 'w') as f:
-      f.write("#cap_x, cap_y, cap_z, ref_x, ref_y, ref_z, elapsed_time\n")
-      for cap in self.capturedSequence:
-        f.write(str(cap[0][0]) + "," + str(cap[0][1]) + "," + str(cap[0][2]) + "," + str(cap[1][0]) + "," + str(cap[1][1]) + "," + str(cap[1][2]) + "," + str(cap[2]) + "\n")
-
-    # Rename all sequence files according to naming convention
-    file_root = os.path.basename(filename)
-    file_root_no_ext = file_root[:file_root.index('.')]
-    for filename in self.savedSequenceFiles:
-      if "_controller" in filename:
-        os.rename(filename, os.path.join(os.path.dirname(filename), file_root_no_ext + '_controller.seq.mha'))
+  def onReplayLoadButton(self):
+    path = qt.QFileDialog.getOpenFileName(slicer.util.mainWindow(), "Participant trial file", self.outputDirectoryPathLineEdit.currentPath, "Trial files (*" + TrialStore.EXTENSION + ")")
+    if path == '':
+      return()
+    self.replayStorePath = path
+    self.replayPoints = self.logic.replayPoints(path)
+    self.replayRecordingComboBox.clear()
+    for trial, pointIndex in self.replayPoints:
+      self.replayRecordingComboBox.addItem(trial + ", point " + str(pointIndex+1))
+    if len(self.replayPoints) == 0:
+      self.error("No saved trials with recorded paths in " + path + ".")
+    self.updateUI()
+
+  def onReplayPlayButton(self):
+    if self.replaying:
+      self.stopReplay()
+      return()
+    path = self.loadSelectedReplayPath()
+    if path is not None:
+      self.startReplay(path)
+
+  def loadSelectedReplayPath(self):
+    # Path of the recording selected under Replay Path, None (and the error shown) if it cannot be loaded
+    trial, pointIndex = self.replayPoints[self.replayRecordingComboBox.currentIndex]
+    stream = self.replayStreamComboBox.currentText
+    try:
+      path = self.logic.loadReplayPath(self.replayStorePath, trial, pointIndex, stream)
+    except (IOError, KeyError, ValueError) as e:
+      self.error("Unable to load replay path: " + str(e))
+      return None
+    self.replaySource = {'path': self.replayStorePath, 'trial': trial, 'point': pointIndex, 'stream': stream}
+    return path
+
+  def startReplay(self, path):
+    # The sphere is moved at the start of every VR frame until the path is finished
+    self.replayPath = path
+    self.replayPath.reset()
+    self.showSphereCheckBox.setChecked(True)
+    self.sphereModelNode.GetDisplayNode().SetVisibility(True)
+    self.replayPlayButton.text = "Stop"
+    self.replayStartTime = self.poseRecorder.mark("replayStarted")
+    self.replaying = True
+    self.updateReplay()
+
+  def onReplayExportButton(self):
+    trial, pointIndex = self.replayPoints[self.replayRecordingComboBox.currentIndex]
+    stream = self.replayStreamComboBox.currentText
+    try:
+      sequenceNode = self.logic.loadRecordedSequence(self.replayStorePath, trial, pointIndex, stream)
+    except (IOError, KeyError, ValueError) as e:
+      self.error("Unable to load recorded trajectory: " + str(e))
+      return()
+    self.resultLabel.text = "Loaded " + str(sequenceNode.GetNumberOfDataNodes()) + " poses into " + sequenceNode.GetName() + "."
+
+  def updateReplay(self):
+    # Constant cost per frame: look up the precomputed position for the current time and move the sphere
+    previousIndex = self.replayPath.lastIndex
+    index = self.replayPath.frameIndex(self.poseRecorder.clock() - self.replayStartTime)
+    if index < 0:
+      self.stopReplay()
+      return()
+    if index != previousIndex:
+      position = self.replayPath.worldPositions[index]
+      updateMatrixFromTranslation(self.replayMatrix, position, self.replayArray)
+      self.sphereTransformNode.SetMatrixTransformToParent(self.replayMatrix)
+      self.publishTarget(position)
+
+  def stopReplay(self):
+    self.replaying = False
+    self.poseRecorder.mark("replayFinished")
+    self.replayPlayButton.text = "Play"
+    scheduled, actual = self.replayPath.presentationLog()
+    if len(scheduled) > 0:
+      lateness = 1000.0 * (actual - scheduled)
+      self.resultLabel.text = ("Replayed {0} of {1} frames, presented {2:.1f} ms (max {3:.1f} ms) after schedule.".format(
+        len(scheduled), self.replayPath.numberOfFrames(), lateness.mean(), lateness.max()))
+
+  def onWriterTimer(self):
+    for description, success, message in self.writer.pollCompleted():
+      if not success:
+        self.error("Unable to save " + description + ": " + message)
       else:
-        os.rename(filename, os.path.join(os.path.dirname(filename). file_root_no_ext + '_hmd.seq.mha'))
+        logging.info("Saved " + description)
+    if self.writer.pending() == 0:
+      self.writerTimer.stop()
+
+  def onSaveButton(self):
+    with self.frameMonitor.timed("onSaveButton"):
+      self.saveTrial()
+
+  def saveTrial(self):
+    frameStarts, frameDurations = self.frameMonitor.arrays()
+    columns = {'frameStarts': frameStarts, 'frameDurations': frameDurations}
+    attributes = {'frameStatistics': self.frameMonitor.trialStatistics()}
+    if self.replayPath is not None:
+      # Last replay presented during this trial
+      columns['replayScheduled'], columns['replayActual'] = self.replayPath.presentationLog()
+      attributes['replaySource'] = self.replaySource
+
+    # Saving happens between trials, wait so that the result can be reported
+    store, written = self.logic.session.saveTrial(columns, attributes)
+    if not written:
+      self.error("Trial is still being written to " + store.path + ".")
+      return()
+    self.onWriterTimer()
 
     self.updateUI()
-    self.resultLabel.text = "Files saved."
+    self.resultLabel.text = "Trial saved to " + store.path + "."
+    droppedFrames = attributes['frameStatistics']['droppedFrames']
+    if droppedFrames > 0:
+      self.resultLabel.text += " " + str(droppedFrames) + " frames were dropped during this trial."
+
+  def onAnalyzeButton(self):
+    paths = qt.QFileDialog.getOpenFileNames(slicer.util.mainWindow(), "Participant trial files", self.outputDirectoryPathLineEdit.currentPath, "Trial files (*" + TrialStore.EXTENSION + ")")
+    if len(paths) == 0:
+      return()
+    qt.QApplication.setOverrideCursor(qt.Qt.WaitCursor)
+    try:
+      merged, summary = self.logic.analyzeParticipants(paths)
+    finally:
+      qt.QApplication.restoreOverrideCursor()
+    if merged is None:
+      self.error("No saved trials found.")
+      return()
+    text = ""
+    for condition in sorted(summary.keys()):
+      metrics = summary[condition]
+      text += (condition + " (n=" + str(metrics['pointingError']['n']) + "): "
+        + "error {0:.1f} +/- {1:.1f} mm, ".format(metrics['pointingError']['mean'], metrics['pointingError']['std'])
+        + "path {0:.0f} mm, ".format(metrics['pathLength']['mean'])
+        + "peak velocity {0:.0f} mm/s, ".format(metrics['peakVelocity']['mean'])
+        + "onset {0:.3f} s, ".format(metrics['movementOnset']['mean'])
+        + "head motion {0:.1f} mm\n".format(metrics['headPathLength']['mean']))
+    self.resultLabel.text = text.strip()
 
   def onResetButton(self):
-    self.isStarted = False
-    self.capturedSequence = []
-    self.savedSequenceFiles = []
+    if self.replaying:
+      self.stopReplay()
+    self.conditionReplayPath = None
+    self.logic.session.resetTrial()
     self.showSphereCheckBox.setChecked(False)
     self.sphereModelNode.GetDisplayNode().SetVisibility(False)
     self.updateUI()
@@ -423,12 +810,19 @@ class VRVisionExperimentWidget(ScriptedLoadableModuleWidget):
     self.isInit = False
     self.facePosition = []
     self.floorHeight = 0.0
+    self.isStarted = False
 
     # Reset module without using developer mode
-    slicer.mrmlScene.Clear()
+    self.removePoseObservers()
+    self.removeFrameObservers()
+    if self.replaying:
+      self.stopReplay()
+    self.poseRecorder.stop()
+    self.logic.session.stopAutoCapture()
+    if self.clearSceneCheckBox.checked:
+      slicer.mrmlScene.Clear()
     self.currentReferenceSequence = []
     self.capturedSequence = []
-    self.savedSequenceFiles = []
     self.captureButton.text = "Go!"
 
     # Ensure VR module has been created
@@ -481,43 +875,15 @@ class VRVisionExperimentWidget(ScriptedLoadableModuleWidget):
     # Disable interactor
     self.vrView.renderWindow().SetInteractor(None)
 
-    # Set up sequence infrastructure for path recording
-    self.sequenceBrowserNode = slicer.vtkMRMLSequenceBrowserNode()
-    slicer.mrmlScene.AddNode(self.sequenceBrowserNode)
-    self.sequenceBrowserNode.SetName('VRVisionPathsBrowser')
-
-    self.toolSequenceNode = slicer.vtkMRMLSequenceNode()
-    slicer.mrmlScene.AddNode(self.toolSequenceNode)
-    self.toolSequenceNode.SetName('ControllerPathSequence')
-    self.toolSequenceNode.AddDefaultStorageNode()
-
-    self.hmdSequenceNode = slicer.vtkMRMLSequenceNode()
-    slicer.mrmlScene.AddNode(self.hmdSequenceNode)
-    self.hmdSequenceNode.SetName('HMDPathSequence')
-    self.hmdSequenceNode.AddDefaultStorageNode()
-
     # Give Slicer some time to update all the various things we just changed
     qt.QTimer.singleShot(5, self.onFinishInitButton)
 
   def onFinishInitButton(self):
-    # Create sphere and parent transform, hide for now
-    filename = os.path.join(os.path.dirname(slicer.modules.vrvisionexperiment.path), 'Resources/Models/sphere.stl')
-    success, self.sphereModelNode = slicer.util.loadModel(filename, True)
-    if not success:
-      self.error("Unable to load sphere model. Is module installed correctly?")
+    if not self.ensureRoomNodes():
       return()
+    self.showSphereCheckBox.setChecked(False)
     self.sphereModelNode.GetDisplayNode().SetVisibility(False)
-    self.sphereTransformNode = slicer.vtkMRMLLinearTransformNode()
-    slicer.mrmlScene.AddNode(self.sphereTransformNode)
-    self.sphereTransformNode.SetName("SpherePose")
-    self.sphereModelNode.SetAndObserveTransformNodeID(self.sphereTransformNode.GetID())
 
-    # Create needle model and parent transform
-    filename = os.path.join(os.path.dirname(slicer.modules.vrvisionexperiment.path), 'Resources/Models/needle.stl')
-    success, self.needleModelNode = slicer.util.loadModel(filename, True)
-    if not success:
-      self.error("Unable to load needle model. Is module installed correctly?")
-      return()
     controllerNode = self.vrView.mrmlVirtualRealityViewNode().GetRightControllerTransformNode()
     if controllerNode is None or controllerNode.GetAttribute("VirtualReality.ControllerActive") == '0':
       controllerNode = self.vrView.mrmlVirtualRealityViewNode().GetLeftControllerTransformNode()
@@ -527,31 +893,68 @@ class VRVisionExperimentWidget(ScriptedLoadableModuleWidget):
     self.needleModelNode.SetAndObserveTransformNodeID(controllerNode.GetID())
     self.showNeedleCheckBox.setChecked(True)
 
-    # Set sequence proxy nodes
-    l = slicer.modules.sequencebrowser.logic()
-    l.AddSynchronizedNode(self.toolSequenceNode, controllerNode, self.sequenceBrowserNode)
-    self.sequenceBrowserNode.SetRecording(self.toolSequenceNode, True)
-    l.AddSynchronizedNode(self.hmdSequenceNode, self.vrView.mrmlVirtualRealityViewNode().GetHMDTransformNode(), self.sequenceBrowserNode)
-    self.sequenceBrowserNode.SetRecording(self.hmdSequenceNode, True)
+    # Record controller and HMD poses while capturing
+    self.addPoseObservers(controllerNode, self.vrView.mrmlVirtualRealityViewNode().GetHMDTransformNode())
+    self.addFrameObservers(self.vrView.renderWindow())
+
+    # Just to sort of get things close, set the face position to the HMD position
+    hmdMat = vtk.vtkMatrix4x4()
+    self.vrView.mrmlVirtualRealityViewNode().GetHMDTransformNode().GetMatrixTransformToParent(hmdMat)
+    self.setFacePosition(positionFromMatrix(hmdMat).tolist())
+    self.updateRoomPosition()
+
+    # Reset clipping
+    self.vrView.renderWindow().GetRenderers().GetFirstRenderer().GetActiveCamera().SetClippingRange(0.1, 100000)
+
+    self.isInit = True
+    self.updateUI()
+    self.resultLabel.text = "Initialization finished."
+
+  def roomNodes(self):
+    nodes = [self.sphereModelNode, self.sphereTransformNode, self.needleModelNode, self.rootCubeTransformNode]
+    for name in ROOM_WALLS:
+      nodes.append(getattr(self, 'cubeModel' + name))
+      nodes.append(getattr(self, 'cubeTransform' + name))
+    return nodes
+
+  def roomNodesPresent(self):
+    return all([node is not None and slicer.mrmlScene.IsNodePresent(node) for node in self.roomNodes()])
+
+  def ensureRoomNodes(self):
+    # Reuse the sphere, needle and room of a previous initialization if they are all still in the scene
+    if self.roomNodesPresent():
+      return True
+    for node in self.roomNodes():
+      if node is not None and slicer.mrmlScene.IsNodePresent(node):
+        slicer.mrmlScene.RemoveNode(node)
+    return self.createRoomNodes()
+
+  def createRoomNodes(self):
+    # Create sphere and parent transform, hidden until a capture starts
+    self.sphereModelNode = self.logic.createModelNode('Resources/Models/sphere.stl', "sphere")
+    if self.sphereModelNode is None:
+      self.error("Unable to load sphere model. Is module installed correctly?")
+      return False
+    self.sphereTransformNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode", "SpherePose")
+    self.sphereModelNode.SetAndObserveTransformNodeID(self.sphereTransformNode.GetID())
+
+    # Create needle model, its parent is the controller transform
+    self.needleModelNode = self.logic.createModelNode('Resources/Models/needle.stl', "needle")
+    if self.needleModelNode is None:
+      self.error("Unable to load needle model. Is module installed correctly?")
+      return False
 
     # Create room
     # Create parent transform to easily translate the room to the user's current position
-    self.rootCubeTransformNode = slicer.vtkMRMLLinearTransformNode()
-    slicer.mrmlScene.AddNode(self.rootCubeTransformNode)
-    self.rootCubeTransformNode.SetName("CubeRoot")
-    for name in ['Back', 'Front', 'Left', 'Right', 'Roof', 'Floor']:
-      filename = os.path.join(os.path.dirname(slicer.modules.vrvisionexperiment.path), 'Resources/Models/CubeModel.vtk')
-      success, modelNode = slicer.util.loadModel(filename, True)
-      if not success:
+    self.rootCubeTransformNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode", "CubeRoot")
+    for name in ROOM_WALLS:
+      # All walls share the same cube mesh
+      modelNode = self.logic.createModelNode('Resources/Models/CubeModel.vtk', 'CubeModel' + name)
+      transformNode = self.logic.createTransformNode('Resources/Slicer/Scene/ScaleCube' + name + '.h5', 'ScaleCube' + name)
+      if modelNode is None or transformNode is None:
         self.error("Unable to load cube model, ensure module is correctly installed.")
-        return()
-      modelNode.SetName('CubeModel'+name)
+        return False
       setattr(self, 'cubeModel' + name, modelNode)
-      filename = os.path.join(os.path.dirname(slicer.modules.vrvisionexperiment.path), 'Resources/Slicer/Scene/ScaleCube'+name+'.h5')
-      success, transformNode = slicer.util.loadTransform(filename, True)
-      if not success:
-        self.error("Unable to load cube transform, ensure module is correctly installed.")
-        return()
       setattr(self, 'cubeTransform' + name, transformNode)
       modelNode.SetAndObserveTransformNodeID(transformNode.GetID())
       transformNode.SetAndObserveTransformNodeID(self.rootCubeTransformNode.GetID())
@@ -562,19 +965,7 @@ class VRVisionExperimentWidget(ScriptedLoadableModuleWidget):
     self.cubeModelRight.GetDisplayNode().SetColor(0.7, 0.7, 0.7) # medium grey
     self.cubeModelFront.GetDisplayNode().SetColor(0.7, 0.7, 0.7)  # medium grey
     self.cubeModelBack.GetDisplayNode().SetColor(0.7, 0.7, 0.7)  # medium grey
-
-    # Just to sort of get things close, set the face position to the HMD position
-    hmdMat = vtk.vtkMatrix4x4()
-    self.vrView.mrmlVirtualRealityViewNode().GetHMDTransformNode().GetMatrixTransformToParent(hmdMat)
-    self.facePosition = [hmdMat.GetElement(0, 3), hmdMat.GetElement(1, 3), hmdMat.GetElement(2, 3)]
-    self.updateRoomPosition()
-
-    # Reset clipping
-    self.vrView.renderWindow().GetRenderers().GetFirstRenderer().GetActiveCamera().SetClippingRange(0.1, 100000)
-
-    self.isInit = True
-    self.updateUI()
-    self.resultLabel.text = "Initialization finished."
+    return True
 
   def updateUI(self):
     isReady = len(self.motionSequence) > 0 and len(self.nomotionSequence) > 0 and len(self.replaySequence) > 0 and self.isInit
@@ -587,10 +978,13 @@ class VRVisionExperimentWidget(ScriptedLoadableModuleWidget):
     self.saveButton.enabled = len(self.capturedSequence) > 0
 
     self.showControllerCheckBox.enabled = self.vrView is not None and hasattr(self.vrView, "mrmlVirtualRealityViewNode") and isReady
-    self.showNeedleCheckBox = self.needleModelNode is not None
+    self.showNeedleCheckBox.enabled = self.needleModelNode is not None
 
     self.calibrateGroupBox.enabled = self.isInit
     self.inputsGroupBox.enabled = self.isInit
+    self.replayGroupBox.enabled = self.isInit
+    self.replayPlayButton.enabled = self.isInit and len(self.replayPoints) > 0
+    self.replayExportButton.enabled = self.isInit and len(self.replayPoints) > 0
 
   def error(self, text):
     logging.error(text)
@@ -600,17 +994,11 @@ class VRVisionExperimentWidget(ScriptedLoadableModuleWidget):
     filename = qt.QFileDialog.getOpenFileName()
     if filename == '':
       return []
-    with open(filename) as f:
-      content = f.readlines()
-    content = [x.strip() for x in content]
-    sequence = []
-    for line in content:
-      items = line.split(',')
-      if len(items) != 3:
-        self.error("Invalid line in sequence file: " + filename)
-        return []
-      sequence.append([float(items[0]), float(items[1]), float(items[2])])
-    return sequence
+    try:
+      return self.logic.loadTargetSequence(filename)
+    except (IOError, OSError, TargetSequenceError) as e:
+      self.error(str(e))
+      return []
 
   def onLoadMotionButton(self):
     self.motionSequence = []
@@ -629,7 +1017,7 @@ class VRVisionExperimentWidget(ScriptedLoadableModuleWidget):
       self.error("Unable to load sequence.")
       return()
     else:
-      self.resultLabel.text = "No-motion sequence loaded " + str(len(self.motionSequence)) + " points."
+      self.resultLabel.text = "No-motion sequence loaded " + str(len(self.nomotionSequence)) + " points."
     self.updateUI()
 
   def onLoadReplayButton(self):
@@ -639,14 +1027,123 @@ class VRVisionExperimentWidget(ScriptedLoadableModuleWidget):
       self.error("Unable to load sequence.")
       return()
     else:
-      self.resultLabel.text = "Replay sequence loaded " + str(len(self.motionSequence)) + " points."
+      self.resultLabel.text = "Replay sequence loaded " + str(len(self.replaySequence)) + " points."
     self.updateUI()
 
 # VRVisionExperimentLogic
 class VRVisionExperimentLogic(ScriptedLoadableModuleLogic):
+  def __init__(self, parent=None):
+    ScriptedLoadableModuleLogic.__init__(self, parent)
+    # Parsed target sequences, kept for the lifetime of the logic and as sidecars in the application cache
+    self.targetSequenceLoader = TargetSequenceLoader(os.path.join(slicer.app.cachePath, "VRVisionExperimentSequences"))
+    # Experiment state and flow, independent of the widget and of a headset
+    self.session = ExperimentSession()
+    self.targetMatrix = vtk.vtkMatrix4x4()
+    self.targetArray = np.eye(4)
+
   def run(self):
     return True
 
+  def resourcePath(self, relativePath):
+    return os.path.join(os.path.dirname(slicer.modules.vrvisionexperiment.path), relativePath)
+
+  def getModelPolyData(self, relativePath):
+    # Read once per process, the returned polydata is shared between models and must not be modified
+    key = ('model', relativePath)
+    if key not in assetCache:
+      storageNode = slicer.vtkMRMLModelStorageNode()
+      storageNode.SetFileName(self.resourcePath(relativePath))
+      modelNode = slicer.vtkMRMLModelNode()
+      if not storageNode.ReadData(modelNode):
+        logging.error("Unable to read model " + relativePath)
+        return None
+      assetCache[key] = modelNode.GetPolyData()
+    return assetCache[key]
+
+  def getTransformMatrix(self, relativePath):
+    # Read once per process, returns the transform to parent as a 4x4 array
+    key = ('transform', relativePath)
+    if key not in assetCache:
+      storageNode = slicer.vtkMRMLTransformStorageNode()
+      storageNode.SetFileName(self.resourcePath(relativePath))
+      transformNode = slicer.vtkMRMLLinearTransformNode()
+      if not storageNode.ReadData(transformNode):
+        logging.error("Unable to read transform " + relativePath)
+        return None
+      mat = vtk.vtkMatrix4x4()
+      transformNode.GetMatrixTransformToParent(mat)
+      assetCache[key] = arrayFromMatrix(mat)
+    return assetCache[key]
+
+  def createModelNode(self, relativePath, name):
+    polyData = self.getModelPolyData(relativePath)
+    if polyData is None:
+      return None
+    modelNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLModelNode", name)
+    modelNode.SetAndObservePolyData(polyData)
+    modelNode.CreateDefaultDisplayNodes()
+    return modelNode
+
+  def createTransformNode(self, relativePath, name):
+    matrix = self.getTransformMatrix(relativePath)
+    if matrix is None:
+      return None
+    transformNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode", name)
+    transformNode.SetMatrixTransformToParent(matrixFromArray(matrix))
+    return transformNode
+
+  def loadTargetSequence(self, filename):
+    # Returns a read-only N x 3 array, parsed again only if the file changed
+    return self.targetSequenceLoader.load(filename)
+
+  def replayPoints(self, storePath):
+    # (trial, point index) of every recorded point of the saved trials in a participant trial file
+    store = TrialStore(storePath)
+    return [(trial, pointIndex) for trial in store.trials() for pointIndex in store.points(trial)]
+
+  def loadReplayPath(self, storePath, trial, pointIndex, stream, rate=90.0):
+    # Trajectory of a recorded point, in the face frame it was recorded with and replayed in the current face frame
+    store = TrialStore(storePath)
+    timestamps, matrices = store.readPoint(trial, pointIndex)[stream]
+    recordedFaceToWorld = np.eye(4)
+    recordedFaceToWorld[0:3, 3] = store.readTrial(trial)['attributes']['facePosition']
+    path = ReplayPath.fromMatrices(timestamps, matrices, recordedFaceToWorld, rate)
+    path.setFaceToWorld(self.session.faceToWorld)
+    return path
+
+  def loadRecordedSequence(self, storePath, trial, pointIndex, stream):
+    # Recorded trajectory of a point as a sequence of linear transforms, indexed by the pose clock
+    timestamps, matrices = TrialStore(storePath).readPoint(trial, pointIndex)[stream]
+    return self.createSequenceNode(timestamps, matrices, trial + " point " + str(pointIndex+1) + " " + stream)
+
+  def targetToWorldMatrix(self, index):
+    # The same matrix is returned for every target, callers copy it (e.g. SetMatrixTransformToParent)
+    worldTargets = self.session.worldTargets
+    updateMatrixFromTranslation(self.targetMatrix, worldTargets[index], self.targetArray)
+    return self.targetMatrix
+
+  def runSimulation(self, outputDirectory=None, rate=90.0, numberOfTrials=10, pointsPerTrial=20):
+    # Runs the experiment flow with simulated controller and HMD poses, returns the benchmark results
+    return Simulation.benchmark(outputDirectory, rate, numberOfTrials, pointsPerTrial)
+
+  def analyzeParticipants(self, paths, maxWorkers=None, onsetSpeed=50.0):
+    # Participants are independent, analyze their trial files on a process pool
+    # Returns the per point metrics of all participants and their per condition summary
+    results = ProcessPool.starmap(analyzeParticipant, [(path, onsetSpeed) for path in paths], maxWorkers)
+    merged = mergeResults(results)
+    return merged, summarizeByCondition(merged)
+
+  def createSequenceNode(self, timestamps, matrices, name):
+    # Convert recorded poses to a sequence of linear transforms, only needed for display or export
+    sequenceNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSequenceNode", slicer.mrmlScene.GetUniqueNameByString(name))
+    transformNode = slicer.vtkMRMLLinearTransformNode()
+    mat = vtk.vtkMatrix4x4()
+    for i in range(0, len(timestamps)):
+      updateMatrixFromArray(mat, matrices[i])
+      transformNode.SetMatrixTransformToParent(mat)
+      sequenceNode.SetDataNodeAtValue(transformNode, "%.6f" % timestamps[i])
+    return sequenceNode
+
 # VRVisionExperimentTest
 class VRVisionExperimentTest(ScriptedLoadableModuleTest):
   def setUp(self):
@@ -655,7 +1152,336 @@ class VRVisionExperimentTest(ScriptedLoadableModuleTest):
   def runTest(self):
     self.setUp()
     self.test_VRVisionExperiment1()
+    self.test_TrialAnalysis()
+    self.test_TrialStore()
+    self.test_TargetSequenceLoader()
+    self.test_BackgroundWriter()
+    self.test_FrameMonitor()
+    self.test_DwellDetector()
+    self.test_ReplayPath()
+    self.test_Simulation()
+    self.test_PoseStreaming()
+    self.test_RoomReuse()
 
   def test_VRVisionExperiment1(self):
     self.delayDisplay("Starting the test")
     self.delayDisplay('Test passed!')
+
+  def test_TrialAnalysis(self):
+    self.delayDisplay("Starting the trial analysis test")
+    import tempfile
+    store = TrialStore(TrialStore.participantPath(tempfile.mkdtemp(), "test"))
+    for condition in ["Motion", "No motion"]:
+      trial = trialKey(1, condition)
+      # Controller moves 200 mm along x at 500 mm/s, starting 0.2 s after the capture started
+      timestamps = np.linspace(0.0, 1.0, 91)
+      matrices = np.tile(np.eye(4), (91, 1, 1))
+      matrices[:, 0, 3] = np.clip((timestamps - 0.2) * 500.0, 0.0, 200.0)
+      for point in range(0, 2):
+        store.appendPoint(trial, point, {'Controller': (timestamps, matrices), 'HMD': (timestamps, np.tile(np.eye(4), (91, 1, 1)))})
+      store.appendTrial(trial, {'captured': np.ones((2, 3)), 'reference': np.zeros((2, 3)), 'elapsed': np.ones(2)}, {'participant': "test", 'condition': condition})
+    merged, summary = VRVisionExperimentLogic().analyzeParticipants([store.path, store.path])
+    self.assertEqual(len(merged['point']), 8)
+    self.assertEqual(sorted(summary.keys()), ["Motion", "No motion"])
+    self.assertAlmostEqual(summary["Motion"]['pointingError']['mean'], np.sqrt(3.0))
+    self.assertAlmostEqual(summary["Motion"]['pathLength']['mean'], 200.0)
+    self.assertAlmostEqual(summary["Motion"]['headPathLength']['mean'], 0.0)
+    self.assertTrue(0.2 < summary["Motion"]['movementOnset']['mean'] < 0.25)
+    self.delayDisplay('Test passed!')
+
+  def test_TrialStore(self):
+    self.delayDisplay("Starting the trial store test")
+    import tempfile
+    store = TrialStore(TrialStore.participantPath(tempfile.mkdtemp(), "test"))
+    trial = trialKey(1, "Motion")
+    matrices = np.tile(np.eye(4), (3, 1, 1))
+    store.appendPoint(trial, 0, {'Controller': (np.arange(3.0), matrices)}, (np.array([0.5]), ["go"]))
+    self.assertEqual(store.trials(), [])
+    # Capturing the point again replaces it
+    store.appendPoint(trial, 0, {'Controller': (np.arange(3.0) + 1.0, matrices)})
+    store.appendTrial(trial, {'captured': np.ones((1, 3))}, {'condition': "Motion"})
+    self.assertEqual(store.trials(), [trial])
+    self.assertEqual(store.points(trial), [0])
+    # A record that was only partly written is dropped when the file is opened again
+    size = store.size()
+    with open(store.path, 'ab') as f:
+      f.write(b"VRT1\x05\x00")
+    store = TrialStore(store.path)
+    self.assertEqual(store.trials(), [trial])
+    self.assertEqual(store.points(trial), [0])
+    point = store.readPoint(trial, 0)
+    self.assertEqual(sorted(point.keys()), ['Controller'])
+    np.testing.assert_array_equal(point['Controller'][0], [1.0, 2.0, 3.0])
+    self.assertEqual(store.readTrial(trial)['attributes']['condition'], "Motion")
+    # The next append overwrites the torn tail
+    store.appendPoint(trial, 1, {'Controller': (np.arange(3.0), matrices)})
+    self.assertGreater(store.size(), size)
+    store = TrialStore(store.path)
+    self.assertEqual(store.points(trial), [0, 1])
+    trials = store.readAll()
+    self.assertEqual(sorted(trials[trial]['points'].keys()), [0, 1])
+    np.testing.assert_array_equal(trials[trial]['captured'], np.ones((1, 3)))
+    # All trials are in one file
+    # Replaced records are dropped once they take up more than half of the file
+    for i in range(0, 4):
+      store.appendPoint(trial, 0, {'Controller': (np.arange(3.0) + i, matrices)})
+    self.assertLess(store.size(), 4 * size)
+    np.testing.assert_array_equal(TrialStore(store.path).readPoint(trial, 0)['Controller'][0], [3.0, 4.0, 5.0])
+    # All trials are in one file
+    self.assertEqual(os.listdir(os.path.dirname(store.path)), [os.path.basename(store.path)])
+    self.delayDisplay('Test passed!')
+
+  def test_TargetSequenceLoader(self):
+    self.delayDisplay("Starting the target sequence loader test")
+    import tempfile
+    directory = tempfile.mkdtemp()
+    cacheDirectory = os.path.join(directory, "cache")
+    filename = os.path.join(directory, "sequence.txt")
+    # Every invalid line is reported, not only the first one
+    with open(filename, 'w') as f:
+      f.write("1, 2, 3\n1, 2\n\n4, x, 6\n7, 8, 9, 10\n")
+    with self.assertRaises(TargetSequenceError) as context:
+      TargetSequenceLoader(cacheDirectory).load(filename)
+    self.assertEqual([number for number, text in context.exception.badLines], [2, 4, 5])
+    self.assertFalse(os.path.exists(cacheDirectory) and os.listdir(cacheDirectory))
+
+    with open(filename, 'w') as f:
+      f.write("1, 2, 3\n4, 5, 6\n")
+    loader = TargetSequenceLoader(cacheDirectory)
+    np.testing.assert_array_equal(loader.load(filename), [[1, 2, 3], [4, 5, 6]])
+    # The sidecar is written to the cache directory, not next to the file, and reused by the next loader
+    self.assertEqual(sorted(os.listdir(directory)), ["cache", "sequence.txt"])
+    self.assertEqual(len(os.listdir(cacheDirectory)), 1)
+    reloader = TargetSequenceLoader(cacheDirectory)
+    reloader.parse = lambda filename: self.fail("Sequence parsed again instead of reading the sidecar")
+    np.testing.assert_array_equal(reloader.load(filename), [[1, 2, 3], [4, 5, 6]])
+
+    # Changing the file (size and modification time) invalidates the memory cache and the sidecar
+    with open(filename, 'w') as f:
+      f.write("1, 2, 3\n4, 5, 6\n7, 8, 9\n")
+    status = os.stat(filename)
+    os.utime(filename, (status.st_atime, status.st_mtime + 10.0))
+    np.testing.assert_array_equal(loader.load(filename)[-1], [7, 8, 9])
+    np.testing.assert_array_equal(TargetSequenceLoader(cacheDirectory).load(filename)[-1], [7, 8, 9])
+    # Same size, only the modification time changed
+    with open(filename, 'w') as f:
+      f.write("1, 2, 3\n4, 5, 6\n7, 8, 0\n")
+    os.utime(filename, (status.st_atime, status.st_mtime + 20.0))
+    np.testing.assert_array_equal(loader.load(filename)[-1], [7, 8, 0])
+    np.testing.assert_array_equal(TargetSequenceLoader(cacheDirectory).load(filename)[-1], [7, 8, 0])
+    self.delayDisplay('Test passed!')
+
+  def test_BackgroundWriter(self):
+    self.delayDisplay("Starting the background writer test")
+    import threading
+    import time
+    writer = BackgroundWriter()
+    written = []
+    release = threading.Event()
+    def slowJob(name):
+      release.wait(5.0)
+      written.append(name)
+    def failingJob():
+      raise IOError("disk full")
+    writer.submit("slow", slowJob, "slow")
+    writer.submit("failing", failingJob)
+    writer.submit("fast", written.append, "fast")
+    # flush blocks while a job is running
+    self.assertFalse(writer.flush(0.1))
+    self.assertEqual(writer.pending(), 3)
+    self.assertEqual(writer.pollCompleted(), [])
+    release.set()
+    self.assertTrue(writer.flush(5.0))
+    self.assertEqual(writer.pending(), 0)
+    # Jobs run in submission order, a failing job does not stop the next ones
+    self.assertEqual(written, ["slow", "fast"])
+    self.assertEqual(writer.pollCompleted(), [("slow", True, ""), ("failing", False, "disk full"), ("fast", True, "")])
+    self.assertEqual(writer.pollCompleted(), [])
+    # Shutdown writes the queued jobs before stopping the thread
+    for i in range(0, 3):
+      writer.submit("job " + str(i), lambda i=i: (time.sleep(0.05), written.append(i)))
+    writer.shutdown(5.0)
+    self.assertEqual(written[2:], [0, 1, 2])
+    self.assertFalse(writer.thread.is_alive())
+    self.delayDisplay('Test passed!')
+
+  def test_FrameMonitor(self):
+    self.delayDisplay("Starting the frame monitor test")
+    now = [0.0]
+    monitor = FrameMonitor(targetRate=10.0, window=3, capacity=2, clock=lambda: now[0])
+    # (start, render time) of each frame at 10 Hz: the second frame is late, the frame at 0.2 s is dropped
+    for start, duration in [(0.0, 0.02), (0.1, 0.12), (0.3, 0.05), (0.4, 0.05), (0.5, 0.05)]:
+      now[0] = start
+      monitor.frameStarted()
+      if start == 0.4:
+        with monitor.timed("updateReplay"):
+          now[0] += 0.01
+        with monitor.timed("updateReplay"):
+          now[0] += 0.03
+      now[0] = start + duration
+      monitor.frameEnded()
+    # An end without a start is ignored
+    monitor.frameEnded()
+    statistics = monitor.trialStatistics()
+    self.assertEqual(statistics['frames'], 5)
+    self.assertEqual(statistics['lateFrames'], 1)
+    self.assertEqual(statistics['droppedFrames'], 1)
+    self.assertAlmostEqual(statistics['frameRate'], 8.0)
+    self.assertAlmostEqual(statistics['maxRenderTime'], 0.12)
+    self.assertEqual(statistics['callbacks']['updateReplay']['count'], 2)
+    self.assertAlmostEqual(statistics['callbacks']['updateReplay']['mean'], 0.02)
+    self.assertAlmostEqual(statistics['callbacks']['updateReplay']['max'], 0.03)
+    # Only the last window frames
+    statistics = monitor.statistics()
+    self.assertEqual(statistics['frames'], 3)
+    self.assertEqual(statistics['lateFrames'], 0)
+    self.assertEqual(statistics['droppedFrames'], 0)
+    self.assertAlmostEqual(statistics['frameRate'], 10.0)
+    starts, durations = monitor.arrays()
+    np.testing.assert_allclose(starts, [0.0, 0.1, 0.3, 0.4, 0.5])
+    monitor.clear()
+    self.assertEqual(monitor.trialStatistics()['frames'], 0)
+    self.assertEqual(monitor.trialStatistics()['callbacks'], {})
+    self.delayDisplay('Test passed!')
+
+  def test_DwellDetector(self):
+    self.delayDisplay("Starting the dwell detector test")
+    # Controller sampled at 90 Hz, moves 200 mm at 400 mm/s starting at 0.5 s, then rests
+    timestamps = np.arange(0.0, 3.0, 1.0/90.0)
+    positions = np.zeros((len(timestamps), 3))
+    positions[:, 0] = np.clip((timestamps - 0.5) * 400.0, 0.0, 200.0)
+    detector = DwellDetector(dwellTime=0.5)
+    detector.arm()
+    events = []
+    for timestamp, position in zip(timestamps, positions):
+      event = detector.update(timestamp, position)
+      if event is not None:
+        events.append(event)
+    self.assertEqual(events, [DwellDetector.ONSET, DwellDetector.DWELL])
+    self.assertAlmostEqual(detector.onsetTime, 0.5, places=2)
+    self.assertAlmostEqual(detector.dwellStartTime, 1.0, places=2)
+    self.assertAlmostEqual(detector.dwellPosition[0], 200.0)
+    # A dwell only captures if the capture it was armed for is still recording
+    session = ExperimentSession()
+    session.startTrial(1, "Motion", [[0, 0, 0], [10, 0, 0]])
+    session.startAutoCapture()
+    capture = session.dwellCapture
+    self.assertTrue(session.dwellCaptureActive(capture))
+    session.startCapture()
+    self.assertFalse(session.dwellCaptureActive(capture))
+    session.startAutoCapture()
+    self.assertFalse(session.dwellCaptureActive(capture))
+    self.assertTrue(session.dwellCaptureActive(session.dwellCapture))
+    # Moving to another target drops the capture in progress and starts a new event log
+    session.setCurrentIndex(1)
+    self.assertFalse(session.capturing())
+    self.assertEqual(list(session.recorder.events.arrays()[1]), ["targetShown"])
+    session.writer.shutdown()
+    self.delayDisplay('Test passed!')
+
+  def test_ReplayPath(self):
+    self.delayDisplay("Starting the replay path test")
+    # 100 mm along x in one second, replayed at 10 Hz towards a target at [5, 5, 5]
+    timestamps = np.linspace(0.0, 1.0, 11)
+    path = ReplayPath(timestamps, np.column_stack([100.0 * timestamps, np.zeros(11), np.zeros(11)]), rate=10.0)
+    path.moveEndTo([5, 5, 5])
+    path.setFaceToWorld(np.eye(4))
+    np.testing.assert_allclose(path.worldPositions[[0, -1]], [[-95, 5, 5], [5, 5, 5]])
+    # Frames are looked up when a render starts and presented when it ends, frames 1 and 2 are skipped
+    for start, end in [(0.01, 0.02), (0.05, 0.06), (0.31, 0.33)]:
+      path.frameIndex(start)
+      path.framePresented(end)
+    self.assertEqual(path.frameIndex(1.2), -1)
+    scheduled, actual = path.presentationLog()
+    np.testing.assert_allclose(scheduled, [0.0, 0.3])
+    np.testing.assert_allclose(actual, [0.02, 0.33])
+    self.delayDisplay('Test passed!')
+
+  def test_Simulation(self):
+    self.delayDisplay("Starting the simulated session test")
+    import tempfile
+    outputDirectory = tempfile.mkdtemp()
+    logic = VRVisionExperimentLogic()
+    for rate in [90.0, 144.0]:
+      result = logic.runSimulation(os.path.join(outputDirectory, str(int(rate))), rate, numberOfTrials=3, pointsPerTrial=5)
+      logging.info("Simulated session at " + str(rate) + " Hz: " + str(result))
+      self.assertTrue(result['captureLatency']['max'] < 0.05)
+      self.assertTrue(result['saveLatency']['max'] < 5.0)
+      merged, summary = logic.analyzeParticipants([result['path']])
+      self.assertEqual(len(merged['point']), 15)
+      # Every point was captured on the dwell, at rest on the target
+      self.assertTrue(np.all(merged['pointingError'] < 5.0))
+    self.delayDisplay('Test passed!')
+
+  def test_PoseStreaming(self):
+    self.delayDisplay("Starting the pose streaming test")
+    import time
+    received = []
+    subscriber = PoseSubscriber(0, "127.0.0.1", callback=received.append)
+    publisher = PosePublisher("127.0.0.1", subscriber.port, rate=100.0)
+    try:
+      controller = np.eye(4)
+      controller[0:3, 3] = [10, 20, 30]
+      publisher.update('Controller', controller, 1.5)
+      publisher.updatePosition('Target', [1, 2, 3])
+      publisher.setState(2, 4)
+      publisher.start()
+      startTime = time.time()
+      while len(received) < 5 and time.time() - startTime < 5.0:
+        time.sleep(0.05)
+    finally:
+      publisher.stop()
+      subscriber.stop()
+    self.assertGreaterEqual(len(received), 5)
+    message = received[-1]
+    self.assertEqual((message.trial, message.index), (2, 4))
+    self.assertAlmostEqual(message.timestamp, 1.5)
+    np.testing.assert_allclose(message.poses['Controller'], controller)
+    np.testing.assert_allclose(message.poses['Target'][0:3, 3], [1, 2, 3])
+    self.assertIsNone(message.poses['HMD'])
+    # A host that cannot be resolved is reported when starting, no sender thread is started
+    publisher = PosePublisher("host.invalid", subscriber.port)
+    with self.assertRaises(socket.gaierror):
+      publisher.start()
+    self.assertFalse(publisher.running())
+    self.delayDisplay('Test passed!')
+
+  def test_RoomReuse(self):
+    self.delayDisplay("Starting the room reuse test")
+    widget = slicer.modules.vrvisionexperiment.widgetRepresentation().self()
+    # Initialization reuses the room unless the operator asks for a cleared scene
+    self.assertFalse(widget.clearSceneCheckBox.checked)
+    loadedPaths = []
+    resourcePath = widget.logic.resourcePath
+    def countingResourcePath(relativePath):
+      loadedPaths.append(relativePath)
+      return resourcePath(relativePath)
+    widget.logic.resourcePath = countingResourcePath
+    assetCache.clear()
+    try:
+      self.assertTrue(widget.ensureRoomNodes())
+      # Every mesh and transform file is read once, the walls share one cube mesh
+      self.assertEqual(sorted(loadedPaths), sorted(set(loadedPaths)))
+      self.assertEqual(loadedPaths.count('Resources/Models/CubeModel.vtk'), 1)
+      self.assertEqual(len(loadedPaths), 3 + len(ROOM_WALLS))
+      self.assertIs(widget.cubeModelBack.GetPolyData(), widget.cubeModelFront.GetPolyData())
+      nodes = widget.roomNodes()
+      numberOfModels = slicer.mrmlScene.GetNumberOfNodesByClass("vtkMRMLModelNode")
+      # A second initialization keeps the nodes and reads nothing
+      self.assertTrue(widget.ensureRoomNodes())
+      self.assertEqual(widget.roomNodes(), nodes)
+      self.assertEqual(slicer.mrmlScene.GetNumberOfNodesByClass("vtkMRMLModelNode"), numberOfModels)
+      self.assertEqual(len(loadedPaths), 3 + len(ROOM_WALLS))
+      # A room with a missing node is recreated from the cache, without leftovers
+      slicer.mrmlScene.RemoveNode(widget.cubeModelRoof)
+      self.assertTrue(widget.ensureRoomNodes())
+      self.assertTrue(widget.roomNodesPresent())
+      self.assertNotEqual(widget.roomNodes(), nodes)
+      self.assertEqual(slicer.mrmlScene.GetNumberOfNodesByClass("vtkMRMLModelNode"), numberOfModels)
+      self.assertEqual(len(loadedPaths), 3 + len(ROOM_WALLS))
+    finally:
+      del widget.logic.resourcePath
+      for node in widget.roomNodes():
+        if node is not None and slicer.mrmlScene.IsNodePresent(node):
+          slicer.mrmlScene.RemoveNode(node)
+    self.delayDisplay('Test passed!')
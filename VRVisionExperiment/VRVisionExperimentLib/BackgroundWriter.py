@@ -0,0 +1,61 @@
+import logging
+import queue
+import threading
+
+class BackgroundWriter(object):
+  """Runs file writing jobs one at a time on a background thread.
+
+  Jobs are plain callables. Their outcome is queued as (description, success, message)
+  and collected with pollCompleted(), which is meant to be called from the main thread
+  (e.g. from a QTimer) so that the UI is only touched there.
+  """
+  def __init__(self):
+    self.jobs = queue.Queue()
+    self.completed = queue.Queue()
+    self.condition = threading.Condition()
+    self.numberOfPendingJobs = 0
+    self.thread = threading.Thread(target=self.run, name="VRVisionExperimentWriter")
+    self.thread.daemon = True
+    self.thread.start()
+
+  def submit(self, description, function, *args):
+    with self.condition:
+      self.numberOfPendingJobs += 1
+    self.jobs.put((description, function, args))
+
+  def run(self):
+    while True:
+      job = self.jobs.get()
+      if job is None:
+        return
+      description, function, args = job
+      try:
+        function(*args)
+        self.completed.put((description, True, ""))
+      except Exception as e:
+        logging.error("Unable to write " + description + ": " + str(e))
+        self.completed.put((description, False, str(e)))
+      with self.condition:
+        self.numberOfPendingJobs -= 1
+        self.condition.notify_all()
+
+  def pending(self):
+    return self.numberOfPendingJobs
+
+  def pollCompleted(self):
+    results = []
+    while True:
+      try:
+        results.append(self.completed.get_nowait())
+      except queue.Empty:
+        return results
+
+  def flush(self, timeout=None):
+    """Waits until all submitted jobs are written, returns False on timeout."""
+    with self.condition:
+      return self.condition.wait_for(lambda: self.numberOfPendingJobs == 0, timeout)
+
+  def shutdown(self, timeout=None):
+    self.flush(timeout)
+    self.jobs.put(None)
+    self.thread.join(timeout)
@@ -0,0 +1,97 @@
+import numpy as np
+
+class DwellDetector(object):
+  """Detects movement onset and the following dwell (stillness) in a stream of timestamped positions.
+
+  Speed is estimated over a sliding window of the last windowSize samples, as the distance
+  between the newest and the oldest sample divided by their time difference. The window is
+  a ring buffer, so each update takes constant time. Positions are in mm, times in seconds.
+
+  After arm(), update() returns ONSET once the speed first exceeds onsetSpeed, then DWELL
+  once the speed stayed below dwellSpeed for dwellTime seconds. onsetTime and dwellStartTime
+  are the timestamps of the samples where the movement started and where the stillness began.
+  """
+  ONSET = "onset"
+  DWELL = "dwell"
+
+  IDLE = 0
+  WAITING_FOR_ONSET = 1
+  MOVING = 2
+
+  def __init__(self, windowSize=9, onsetSpeed=50.0, dwellSpeed=20.0, dwellTime=0.5):
+    self.windowSize = max(2, windowSize)
+    self.onsetSpeed = onsetSpeed
+    self.dwellSpeed = dwellSpeed
+    self.dwellTime = dwellTime
+    self.timestamps = np.zeros(self.windowSize)
+    self.positions = np.zeros((self.windowSize, 3))
+    self.state = self.IDLE
+    self.reset()
+
+  def reset(self):
+    self.count = 0
+    self.speed = 0.0
+    self.onsetTime = None
+    self.dwellStartTime = None
+    self.stillSince = None
+    self.dwellPosition = None
+
+  def arm(self):
+    self.reset()
+    self.state = self.WAITING_FOR_ONSET
+
+  def disarm(self):
+    self.state = self.IDLE
+
+  def armed(self):
+    return self.state != self.IDLE
+
+  def update(self, timestamp, position):
+    if self.state == self.IDLE:
+      return None
+    index = self.count % self.windowSize
+    self.timestamps[index] = timestamp
+    self.positions[index] = position
+    self.count += 1
+    if self.count < self.windowSize:
+      return None
+    # Oldest sample in the window is the one that will be overwritten next
+    oldest = self.count % self.windowSize
+    duration = timestamp - self.timestamps[oldest]
+    if duration <= 0.0:
+      return None
+    self.speed = np.linalg.norm(self.positions[index] - self.positions[oldest]) / duration
+
+    if self.state == self.WAITING_FOR_ONSET:
+      if self.speed > self.onsetSpeed:
+        # Movement started within the window, at the sample before the first fast step
+        timestamps, speeds = self.windowSpeeds(oldest)
+        fast = np.nonzero(speeds > self.onsetSpeed)[0]
+        self.onsetTime = timestamps[fast[0]] if len(fast) > 0 else timestamps[0]
+        self.state = self.MOVING
+        return self.ONSET
+      return None
+
+    if self.speed >= self.dwellSpeed:
+      self.stillSince = None
+      return None
+    if self.stillSince is None:
+      # Stillness started within the window, after the last step that was still too fast
+      timestamps, speeds = self.windowSpeeds(oldest)
+      fast = np.nonzero(speeds >= self.dwellSpeed)[0]
+      self.stillSince = timestamps[fast[-1] + 1] if len(fast) > 0 else timestamps[0]
+    if timestamp - self.stillSince >= self.dwellTime:
+      self.dwellStartTime = self.stillSince
+      self.dwellPosition = self.positions.mean(axis=0)
+      self.state = self.IDLE
+      return self.DWELL
+    return None
+
+  def windowSpeeds(self, oldest):
+    # Samples of the window in time order and the speed of each step between them, only used when an event is detected
+    order = (oldest + np.arange(self.windowSize)) % self.windowSize
+    timestamps = self.timestamps[order]
+    durations = np.diff(timestamps)
+    durations[durations <= 0.0] = np.inf
+    speeds = np.linalg.norm(np.diff(self.positions[order], axis=0), axis=1) / durations
+    return timestamps, speeds
@@ -0,0 +1,194 @@
+import time
+
+import numpy as np
+
+from .BackgroundWriter import BackgroundWriter
+from .DwellDetector import DwellDetector
+from .PoseRecorder import PoseRecorder
+from .TrialStore import TrialStore, trialKey
+
+class ExperimentSession(object):
+  """State and flow of an experiment: calibration, trials, captures and saving.
+
+  Has no Slicer dependency, the module widget and the simulation drive the same flow.
+  Positions are world coordinates in mm, times come from the recorder clock in seconds.
+  Captured points are stored as [face position, reference, elapsed (ms), onset (ms)],
+  points that were not captured yet as [0, 0, 0].
+  """
+  def __init__(self, outputDirectory="", participantId="", clock=time.perf_counter, writer=None):
+    self.outputDirectory = outputDirectory
+    self.participantId = participantId
+    self.recorder = PoseRecorder(('Controller', 'HMD'), clock=clock)
+    self.dwellDetector = DwellDetector()
+    self.writer = writer if writer is not None else BackgroundWriter()
+    self.store = None
+
+    self.floorHeight = 0.0
+    self.facePosition = []
+    self.faceToWorld = np.eye(4)
+    self.worldToFaceMatrix = np.eye(4)
+
+    self.trialNumber = 1
+    self.condition = ""
+    self.started = False
+    self.currentReferenceSequence = []
+    self.capturedSequence = []
+    self.currentIndex = 0
+    # Incremented for every capture, identifies the capture a dwell detection belongs to
+    self.captureNumber = 0
+    # Capture the dwell detector was armed for, None while it is not armed
+    self.dwellCapture = None
+    # Reference targets in face (N x 3) and world coordinates, updated when either the sequence or the face frame changes
+    self.referenceSequence = np.zeros((0, 3))
+    self.worldTargets = np.zeros((0, 3))
+
+  def calibrateFloor(self, controllerPosition):
+    self.floorHeight = controllerPosition[2]
+
+  def setFacePosition(self, facePosition, faceToWorldRotation=None):
+    self.facePosition = list(facePosition)
+    self.faceToWorld = np.eye(4)
+    if faceToWorldRotation is not None:
+      self.faceToWorld[0:3, 0:3] = faceToWorldRotation
+    self.faceToWorld[0:3, 3] = facePosition
+    self.worldToFaceMatrix = np.linalg.inv(self.faceToWorld)
+    self.updateWorldTargets()
+
+  def setReferenceSequence(self, sequence):
+    self.referenceSequence = np.array(sequence, dtype=np.float64).reshape(-1, 3)
+    self.updateWorldTargets()
+
+  def updateWorldTargets(self):
+    self.worldTargets = np.ascontiguousarray(self.referenceSequence.dot(self.faceToWorld[0:3, 0:3].T) + self.faceToWorld[0:3, 3])
+
+  def worldToFace(self, points):
+    # points: N x 3 (or a single point) in world coordinates, returns N x 3 in face coordinates
+    points = np.array(points, dtype=np.float64).reshape(-1, 3)
+    return points.dot(self.worldToFaceMatrix[0:3, 0:3].T) + self.worldToFaceMatrix[0:3, 3]
+
+  def trialStore(self):
+    # The store keeps its index in memory, reuse it as long as the participant file does not change
+    path = TrialStore.participantPath(self.outputDirectory, self.participantId)
+    if self.store is None or self.store.path != path:
+      self.store = TrialStore(path)
+    return self.store
+
+  def currentTrialKey(self):
+    return trialKey(self.trialNumber, self.condition)
+
+  def startTrial(self, trialNumber, condition, referenceSequence):
+    self.trialNumber = trialNumber
+    self.condition = condition
+    self.currentReferenceSequence = referenceSequence
+    self.setReferenceSequence(referenceSequence)
+    self.capturedSequence = [[0, 0, 0] for i in range(0, len(referenceSequence))]
+    self.started = True
+    self.setCurrentIndex(0)
+
+  def resetTrial(self):
+    self.started = False
+    self.capturedSequence = []
+    self.stopAutoCapture()
+
+  def setCurrentIndex(self, index):
+    # A capture in progress belongs to the previous target, it is dropped rather than stored for the new one
+    self.cancelCapture()
+    self.currentIndex = min(max(index, 0), len(self.currentReferenceSequence) - 1)
+    # Events of a point are logged from the moment its target is shown
+    self.recorder.events.clear()
+    self.recorder.mark("targetShown")
+
+  def capturing(self):
+    return self.recorder.recording
+
+  def cancelCapture(self):
+    self.stopAutoCapture()
+    if self.capturing():
+      self.recorder.stop()
+
+  def startCapture(self):
+    self.stopAutoCapture()
+    self.captureNumber += 1
+    self.recorder.start()
+    self.recorder.events.add(self.recorder.startTime, "go")
+
+  def startAutoCapture(self):
+    # Recording starts when the target is shown, the capture is triggered by the dwell detector
+    if self.capturing():
+      self.recorder.stop()
+    self.startCapture()
+    self.dwellDetector.arm()
+    self.dwellCapture = self.captureNumber
+
+  def stopAutoCapture(self):
+    self.dwellDetector.disarm()
+    self.dwellCapture = None
+
+  def dwellCaptureActive(self, capture):
+    """True if capture (the dwellCapture at the time of a dwell detection) is still being recorded and armed."""
+    return capture is not None and capture == self.dwellCapture and self.capturing()
+
+  def finishCapture(self, pointWorld, timeElapsed=None, onset=np.nan):
+    """Stores the captured point and submits the recorded paths for writing.
+
+    timeElapsed and onset are in ms from the start of the capture, timeElapsed defaults to now.
+    """
+    if timeElapsed is None:
+      timeElapsed = 1000.0 * (self.recorder.mark("capture") - self.recorder.startTime)
+    self.stopAutoCapture()
+    self.recorder.stop()
+
+    # Only the recorded arrays are copied here, the file is written by the background writer
+    # All times are stored in seconds relative to the start of the capture
+    streams = {}
+    for name, stream in self.recorder.streams.items():
+      timestamps, matrices = stream.arrays()
+      streams[name] = (timestamps - self.recorder.startTime, matrices)
+    eventTimes, eventNames = self.recorder.events.arrays()
+    events = (eventTimes - self.recorder.startTime, eventNames)
+    self.writer.submit("paths of point " + str(self.currentIndex+1), self.trialStore().appendPoint, self.currentTrialKey(), self.currentIndex, streams, events)
+
+    pointFace = self.worldToFace(pointWorld)[0]
+    self.capturedSequence[self.currentIndex] = [ pointFace.tolist(), self.currentReferenceSequence[self.currentIndex], timeElapsed, onset ]
+
+  def updateDwell(self, timestamp, controllerPosition):
+    """Feeds the dwell detector, returns DwellDetector.DWELL when a capture should be made with captureAtDwell()."""
+    return self.dwellDetector.update(timestamp, controllerPosition)
+
+  def captureAtDwell(self):
+    # Use the times at which the movement started and the controller came to rest, not the time of detection
+    startTime = self.recorder.startTime
+    self.recorder.events.add(self.dwellDetector.onsetTime, "onset")
+    self.recorder.events.add(self.dwellDetector.dwellStartTime, "dwell")
+    self.recorder.mark("capture")
+    timeElapsed = 1000.0 * (self.dwellDetector.dwellStartTime - startTime)
+    onset = 1000.0 * (self.dwellDetector.onsetTime - startTime)
+    self.finishCapture(self.dwellDetector.dwellPosition, timeElapsed, onset)
+
+  def saveTrial(self, columns=None, attributes=None, timeout=30.0):
+    """Submits the trial columns and attributes, extended with the given ones, and waits until written.
+
+    Returns the trial store and False if writing did not finish within timeout.
+    """
+    # Store the captured and reference points of all indices as columns, uncaptured points are NaN
+    numberOfPoints = len(self.capturedSequence)
+    captured = np.full((numberOfPoints, 3), np.nan)
+    reference = np.asarray(self.currentReferenceSequence, dtype=np.float64).reshape(-1, 3)
+    elapsed = np.full(numberOfPoints, np.nan)
+    onset = np.full(numberOfPoints, np.nan)
+    for i, cap in enumerate(self.capturedSequence):
+      if len(cap) >= 3 and isinstance(cap[0], list):
+        captured[i] = cap[0]
+        elapsed[i] = cap[2]
+        onset[i] = cap[3]
+    trialColumns = {'captured': captured, 'reference': reference, 'referenceWorld': self.worldTargets.copy(), 'elapsed': elapsed, 'onset': onset}
+    trialColumns.update(columns or {})
+    trialAttributes = {'participant': self.participantId,
+                       'trial': self.trialNumber,
+                       'condition': self.condition,
+                       'facePosition': list(self.facePosition),
+                       'floorHeight': self.floorHeight}
+    trialAttributes.update(attributes or {})
+    store = self.trialStore()
+    self.writer.submit("trial " + self.currentTrialKey(), store.appendTrial, self.currentTrialKey(), trialColumns, trialAttributes)
+    return store, self.writer.flush(timeout)
@@ -0,0 +1,81 @@
+import contextlib
+import time
+
+import numpy as np
+
+class FrameMonitor(object):
+  """Render time, late and dropped frames of a render window, and time spent in module callbacks.
+
+  frameStarted() and frameEnded() are meant to be called from the render window StartEvent
+  and EndEvent observers. A frame is late when rendering took longer than the frame interval
+  of targetRate, frames are counted as dropped when the time between two frame starts spans
+  more than one interval. Every frame since the last clear() is kept for saving with a trial,
+  statistics() only looks at the last window frames. Times are in seconds.
+  """
+  def __init__(self, targetRate=90.0, window=600, capacity=65536, clock=time.perf_counter):
+    self.clock = clock
+    self.interval = 1.0 / targetRate
+    self.window = window
+    self.starts = np.zeros(capacity)
+    self.durations = np.zeros(capacity)
+    self.count = 0
+    self.currentStart = None
+    self.callbackTimes = {}
+
+  def frameStarted(self):
+    self.currentStart = self.clock()
+
+  def frameEnded(self):
+    if self.currentStart is None:
+      return
+    if self.count >= len(self.starts):
+      self.starts = np.concatenate([self.starts, np.zeros(len(self.starts))])
+      self.durations = np.concatenate([self.durations, np.zeros(len(self.durations))])
+    self.starts[self.count] = self.currentStart
+    self.durations[self.count] = self.clock() - self.currentStart
+    self.count += 1
+    self.currentStart = None
+
+  @contextlib.contextmanager
+  def timed(self, name):
+    start = self.clock()
+    try:
+      yield
+    finally:
+      self.callbackTimes.setdefault(name, []).append(self.clock() - start)
+
+  def clear(self):
+    self.count = 0
+    self.currentStart = None
+    self.callbackTimes = {}
+
+  def arrays(self):
+    """Returns copies of the start time and render time of every frame since clear()."""
+    return self.starts[:self.count].copy(), self.durations[:self.count].copy()
+
+  def frameStatistics(self, starts, durations):
+    if len(starts) == 0:
+      return {'frames': 0, 'frameRate': 0.0, 'meanRenderTime': 0.0, 'p95RenderTime': 0.0, 'maxRenderTime': 0.0,
+              'lateFrames': 0, 'droppedFrames': 0}
+    intervals = np.diff(starts)
+    dropped = np.maximum(np.round(intervals / self.interval) - 1, 0)
+    frameRate = (len(starts) - 1) / (starts[-1] - starts[0]) if starts[-1] > starts[0] else 0.0
+    return {'frames': len(starts),
+            'frameRate': float(frameRate),
+            'meanRenderTime': float(durations.mean()),
+            'p95RenderTime': float(np.percentile(durations, 95)),
+            'maxRenderTime': float(durations.max()),
+            'lateFrames': int(np.count_nonzero(durations > self.interval)),
+            'droppedFrames': int(dropped.sum())}
+
+  def statistics(self):
+    """Statistics of the last window frames."""
+    first = max(0, self.count - self.window)
+    return self.frameStatistics(self.starts[first:self.count], self.durations[first:self.count])
+
+  def trialStatistics(self):
+    """Statistics of all frames since clear(), with the count, mean and maximum time of each callback."""
+    statistics = self.frameStatistics(self.starts[:self.count], self.durations[:self.count])
+    statistics['callbacks'] = dict((name, {'count': len(times), 'mean': float(np.mean(times)), 'max': float(np.max(times))})
+                                   for name, times in self.callbackTimes.items())
+    return statistics
@@ -0,0 +1,120 @@
+import time
+
+import numpy as np
+
+class PoseStream(object):
+  """Timestamped 4x4 poses stored in preallocated arrays.
+
+  clear() keeps the allocated memory, and the arrays only grow (by doubling) when a
+  recording is longer than any previous one, so memory stays flat over a session.
+  """
+  def __init__(self, capacity=4096):
+    self.timestamps = np.zeros(capacity)
+    self.matrices = np.zeros((capacity, 4, 4))
+    self.count = 0
+
+  def capacity(self):
+    return self.timestamps.shape[0]
+
+  def grow(self):
+    capacity = 2 * self.capacity()
+    timestamps = np.zeros(capacity)
+    timestamps[:self.count] = self.timestamps[:self.count]
+    matrices = np.zeros((capacity, 4, 4))
+    matrices[:self.count] = self.matrices[:self.count]
+    self.timestamps = timestamps
+    self.matrices = matrices
+
+  def reserve(self, timestamp):
+    """Adds a sample and returns its 16 element matrix storage (row-major) to be filled in place."""
+    if self.count >= self.capacity():
+      self.grow()
+    self.timestamps[self.count] = timestamp
+    slot = self.matrices[self.count].ravel()
+    self.count += 1
+    return slot
+
+  def append(self, timestamp, matrix):
+    self.reserve(timestamp)[:] = np.ravel(matrix)
+
+  def clear(self):
+    self.count = 0
+
+  def arrays(self):
+    """Returns copies of the recorded timestamps (N) and matrices (N x 4 x 4)."""
+    return self.timestamps[:self.count].copy(), self.matrices[:self.count].copy()
+
+  def positions(self):
+    return self.matrices[:self.count, 0:3, 3]
+
+class EventLog(object):
+  """Named events (target shown, go, capture, ...) with their timestamps, in preallocated arrays."""
+  def __init__(self, capacity=64):
+    self.timestamps = np.zeros(capacity)
+    self.codes = np.zeros(capacity, dtype=np.int32)
+    self.names = []
+    self.nameCodes = {}
+    self.count = 0
+
+  def add(self, timestamp, name):
+    code = self.nameCodes.get(name)
+    if code is None:
+      code = len(self.names)
+      self.names.append(name)
+      self.nameCodes[name] = code
+    if self.count >= len(self.timestamps):
+      self.timestamps = np.concatenate([self.timestamps, np.zeros(len(self.timestamps))])
+      self.codes = np.concatenate([self.codes, np.zeros(len(self.codes), dtype=np.int32)])
+    self.timestamps[self.count] = timestamp
+    self.codes[self.count] = code
+    self.count += 1
+
+  def clear(self):
+    self.count = 0
+
+  def arrays(self):
+    """Returns the event timestamps and names, sorted by time."""
+    order = np.argsort(self.timestamps[:self.count], kind='stable')
+    names = np.array([self.names[code] for code in self.codes[:self.count][order]], dtype=str)
+    return self.timestamps[:self.count][order], names
+
+class PoseRecorder(object):
+  """Records several named pose streams (e.g. controller and HMD) between start() and stop().
+
+  Events marked with mark() use the same clock and are kept until events.clear(), so they
+  can also be logged before a recording starts.
+  """
+  def __init__(self, names=('Controller', 'HMD'), capacity=4096, clock=time.perf_counter):
+    self.clock = clock
+    self.streams = dict((name, PoseStream(capacity)) for name in names)
+    self.events = EventLog()
+    self.recording = False
+    self.startTime = 0.0
+    self.stopTime = 0.0
+
+  def start(self):
+    for stream in self.streams.values():
+      stream.clear()
+    self.startTime = self.clock()
+    self.recording = True
+
+  def stop(self):
+    self.stopTime = self.clock()
+    self.recording = False
+
+  def reserve(self, name):
+    """Storage for a new sample of the named stream, None when not recording."""
+    if not self.recording:
+      return None
+    return self.streams[name].reserve(self.clock())
+
+  def mark(self, name):
+    """Logs an event at the current time and returns that time."""
+    timestamp = self.clock()
+    self.events.add(timestamp, name)
+    return timestamp
+
+  def append(self, name, matrix, timestamp=None):
+    if not self.recording:
+      return
+    self.streams[name].append(self.clock() if timestamp is None else timestamp, matrix)
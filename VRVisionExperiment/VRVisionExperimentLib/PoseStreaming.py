@@ -0,0 +1,225 @@
+"""Live streaming of controller, HMD and target poses to a monitoring workstation over UDP.
+
+Every message is one datagram with a fixed little endian layout:
+
+  magic 'VRPS' (4 bytes), version (uint16), valid stream flags (uint16, bit i set when
+  STREAMS[i] has a pose), sequence number (uint32), timestamp (float64, s, clock of the
+  experiment session), trial number (int32), target index (int32), followed by the top
+  3 rows of the 4 x 4 matrix of each stream in STREAMS order (3 x 3 x 4 float32, mm).
+
+Poses of the monitoring side can be printed with e.g.:
+
+  python -m VRVisionExperimentLib.PoseStreaming --port 18950
+"""
+import argparse
+import logging
+import socket
+import struct
+import threading
+import time
+
+import numpy as np
+
+MAGIC = b'VRPS'
+VERSION = 1
+STREAMS = ('Controller', 'HMD', 'Target')
+HEADER = struct.Struct('<4sHHIdii')
+MESSAGE_SIZE = HEADER.size + len(STREAMS) * 3 * 4 * 4
+DEFAULT_PORT = 18950
+
+class PoseMessage(object):
+  """A decoded message, poses maps the stream names to 4 x 4 matrices (None when not valid)."""
+  def __init__(self, sequence, timestamp, trial, index, poses):
+    self.sequence = sequence
+    self.timestamp = timestamp
+    self.trial = trial
+    self.index = index
+    self.poses = poses
+
+def decodeMessage(data):
+  """Returns the PoseMessage of a datagram, raises ValueError if it is not a valid message."""
+  if len(data) != MESSAGE_SIZE:
+    raise ValueError("Pose message has " + str(len(data)) + " bytes instead of " + str(MESSAGE_SIZE))
+  magic, version, flags, sequence, timestamp, trial, index = HEADER.unpack_from(data, 0)
+  if magic != MAGIC or version != VERSION:
+    raise ValueError("Not a version " + str(VERSION) + " pose message")
+  rows = np.frombuffer(data, dtype='<f4', offset=HEADER.size).reshape(len(STREAMS), 3, 4)
+  poses = {}
+  for i, name in enumerate(STREAMS):
+    if flags & (1 << i):
+      matrix = np.eye(4)
+      matrix[0:3, :] = rows[i]
+      poses[name] = matrix
+    else:
+      poses[name] = None
+  return PoseMessage(sequence, timestamp, trial, index, poses)
+
+class PosePublisher(object):
+  """Sends the latest poses at a fixed rate from a background thread.
+
+  update() only copies the pose into the publisher under a lock, so calling it from
+  every transform observer costs a few microseconds. The sender thread encodes the
+  latest poses into a preallocated buffer and sends one datagram per period, UDP never
+  blocks the experiment on a slow or missing receiver.
+  """
+  def __init__(self, host="127.0.0.1", port=DEFAULT_PORT, rate=60.0):
+    self.host = host
+    self.port = port
+    # Resolved by start()
+    self.address = None
+    self.interval = 1.0 / rate
+    self.lock = threading.Lock()
+    self.poses = np.tile(np.eye(4), (len(STREAMS), 1, 1))
+    self.flags = 0
+    self.timestamp = 0.0
+    self.trial = 0
+    self.index = -1
+    self.sequence = 0
+    self.buffer = bytearray(MESSAGE_SIZE)
+    self.rows = np.frombuffer(self.buffer, dtype='<f4', offset=HEADER.size).reshape(len(STREAMS), 3, 4)
+    self.socket = None
+    self.thread = None
+    self.stopEvent = threading.Event()
+
+  def update(self, name, matrix, timestamp=None):
+    i = STREAMS.index(name)
+    with self.lock:
+      self.poses[i] = matrix
+      self.flags |= 1 << i
+      if timestamp is not None:
+        self.timestamp = timestamp
+
+  def updatePosition(self, name, position, timestamp=None):
+    i = STREAMS.index(name)
+    with self.lock:
+      self.poses[i, 0:3, 3] = position
+      self.flags |= 1 << i
+      if timestamp is not None:
+        self.timestamp = timestamp
+
+  def setState(self, trial, index):
+    with self.lock:
+      self.trial = trial
+      self.index = index
+
+  def encode(self):
+    with self.lock:
+      HEADER.pack_into(self.buffer, 0, MAGIC, VERSION, self.flags, self.sequence, self.timestamp, self.trial, self.index)
+      self.rows[:] = self.poses[:, 0:3, :]
+    self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+    return self.buffer
+
+  def start(self):
+    """Resolves the receiver address and starts sending, raises OSError (socket.gaierror) if the host cannot be resolved."""
+    if self.running():
+      return
+    family, socketType, protocol, canonicalName, self.address = socket.getaddrinfo(self.host, self.port, 0, socket.SOCK_DGRAM)[0]
+    self.socket = socket.socket(family, socket.SOCK_DGRAM)
+    self.stopEvent.clear()
+    self.thread = threading.Thread(target=self.run, name="VRVisionExperimentPosePublisher")
+    self.thread.daemon = True
+    self.thread.start()
+
+  def running(self):
+    return self.thread is not None and self.thread.is_alive()
+
+  def run(self):
+    nextTime = time.perf_counter()
+    failing = False
+    while not self.stopEvent.is_set():
+      if self.flags:
+        try:
+          self.socket.sendto(self.encode(), self.address)
+          failing = False
+        except (OSError, socket.error) as e:
+          # Reported once until sending works again, not every period
+          if not failing:
+            logging.warning("Unable to send pose messages to " + str(self.host) + ": " + str(e))
+          failing = True
+      # Scheduled from the previous deadline so that the rate does not drift, skip periods that were missed
+      nextTime += self.interval
+      now = time.perf_counter()
+      if nextTime < now:
+        nextTime = now
+      self.stopEvent.wait(nextTime - now)
+
+  def stop(self, timeout=1.0):
+    self.stopEvent.set()
+    if self.thread is not None:
+      self.thread.join(timeout)
+      self.thread = None
+    if self.socket is not None:
+      self.socket.close()
+      self.socket = None
+
+class PoseSubscriber(object):
+  """Receives pose messages on a background thread.
+
+  The last message is kept in latest, callback(message) is called from the receiving
+  thread for every message. Messages that arrive out of order are dropped, gaps in the
+  sequence numbers are counted as lost.
+  """
+  def __init__(self, port=DEFAULT_PORT, host="0.0.0.0", callback=None):
+    self.callback = callback
+    self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self.socket.bind((host, port))
+    # Actual port, when port 0 was given the system picks a free one
+    self.port = self.socket.getsockname()[1]
+    self.socket.settimeout(0.2)
+    self.latest = None
+    self.received = 0
+    self.lost = 0
+    self.invalid = 0
+    self.stopEvent = threading.Event()
+    self.thread = threading.Thread(target=self.run, name="VRVisionExperimentPoseSubscriber")
+    self.thread.daemon = True
+    self.thread.start()
+
+  def run(self):
+    while not self.stopEvent.is_set():
+      try:
+        data = self.socket.recv(MESSAGE_SIZE + 1)
+      except socket.timeout:
+        continue
+      except (OSError, socket.error):
+        return
+      try:
+        message = decodeMessage(data)
+      except ValueError:
+        self.invalid += 1
+        continue
+      if self.latest is not None:
+        gap = (message.sequence - self.latest.sequence) & 0xFFFFFFFF
+        if gap == 0 or gap >= 0x80000000:
+          continue
+        self.lost += gap - 1
+      self.latest = message
+      self.received += 1
+      if self.callback is not None:
+        self.callback(message)
+
+  def stop(self, timeout=1.0):
+    self.stopEvent.set()
+    self.thread.join(timeout)
+    self.socket.close()
+
+def main():
+  parser = argparse.ArgumentParser(description="Print the poses streamed by the VR vision experiment.")
+  parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="UDP port to listen on")
+  parser.add_argument("--interval", type=float, default=0.5, help="seconds between printed messages")
+  args = parser.parse_args()
+  subscriber = PoseSubscriber(args.port)
+  try:
+    while True:
+      time.sleep(args.interval)
+      message = subscriber.latest
+      if message is None:
+        continue
+      positions = ", ".join([name + " " + (np.array2string(pose[0:3, 3], precision=1) if pose is not None else "-") for name, pose in message.poses.items()])
+      print("trial " + str(message.trial) + " target " + str(message.index + 1) + " t=" + "{0:.3f}".format(message.timestamp) + ": " + positions
+            + " (" + str(subscriber.received) + " received, " + str(subscriber.lost) + " lost)")
+  except KeyboardInterrupt:
+    subscriber.stop()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,68 @@
+import numpy as np
+
+class ReplayPath(object):
+  """A recorded trajectory resampled at a fixed rate, for replaying it with the original timing.
+
+  The recorded positions (in face coordinates) are linearly interpolated once at every
+  1/rate seconds, and transformed to world coordinates with setFaceToWorld(). During the
+  replay frameIndex() is called when a render starts and is a constant time lookup into
+  the precomputed arrays, framePresented() is called when the render ended. The scheduled
+  time of every frame and the end of its render are logged into preallocated arrays.
+  """
+  def __init__(self, timestamps, positions, rate=90.0):
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+    if len(timestamps) < 2:
+      raise ValueError("A replay path needs at least two samples")
+    self.rate = rate
+    self.duration = timestamps[-1] - timestamps[0]
+    self.times = np.arange(0, int(np.floor(self.duration * rate)) + 1) / rate
+    self.facePositions = np.empty((len(self.times), 3))
+    for axis in range(0, 3):
+      self.facePositions[:, axis] = np.interp(self.times + timestamps[0], timestamps, positions[:, axis])
+    self.worldPositions = self.facePositions.copy()
+    self.scheduled = np.full(len(self.times), np.nan)
+    self.actual = np.full(len(self.times), np.nan)
+    self.lastIndex = -1
+
+  @staticmethod
+  def fromMatrices(timestamps, matrices, faceToWorld, rate=90.0):
+    """Creates a path from recorded world poses (N x 4 x 4) and the face to world matrix they were recorded with."""
+    worldToFace = np.linalg.inv(faceToWorld)
+    positions = np.asarray(matrices)[:, 0:3, 3]
+    return ReplayPath(timestamps, positions.dot(worldToFace[0:3, 0:3].T) + worldToFace[0:3, 3], rate)
+
+  def moveEndTo(self, facePosition):
+    """Translates the path so that it ends at facePosition (face coordinates), call setFaceToWorld() afterwards."""
+    self.facePositions += np.asarray(facePosition, dtype=np.float64) - self.facePositions[-1]
+
+  def setFaceToWorld(self, faceToWorld):
+    self.worldPositions = np.ascontiguousarray(self.facePositions.dot(faceToWorld[0:3, 0:3].T) + faceToWorld[0:3, 3])
+
+  def numberOfFrames(self):
+    return len(self.times)
+
+  def reset(self):
+    self.scheduled[:] = np.nan
+    self.actual[:] = np.nan
+    self.lastIndex = -1
+
+  def frameIndex(self, elapsed):
+    """Index of the frame to render elapsed seconds after the start, -1 once the path is finished."""
+    index = int(elapsed * self.rate)
+    if index >= len(self.times):
+      return -1
+    if index != self.lastIndex:
+      self.scheduled[index] = self.times[index]
+      self.lastIndex = index
+    return index
+
+  def framePresented(self, elapsed):
+    """Logs elapsed (seconds after the start, at the end of a render) as the presentation time of the last frame, if it has none yet."""
+    if self.lastIndex >= 0 and np.isnan(self.actual[self.lastIndex]):
+      self.actual[self.lastIndex] = elapsed
+
+  def presentationLog(self):
+    """Scheduled and actual presentation times of the presented frames, skipped frames are left out."""
+    presented = np.isfinite(self.actual)
+    return self.scheduled[presented], self.actual[presented]
@@ -0,0 +1,181 @@
+"""Headless simulation of experiment sessions, for testing and benchmarking without a headset.
+
+Only needs NumPy, run from the module directory with e.g.:
+
+  python -m VRVisionExperimentLib.Simulation --rate 144 --hours 2
+"""
+import argparse
+import json
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from .DwellDetector import DwellDetector
+from .ExperimentSession import ExperimentSession
+
+class SimulatedClock(object):
+  """Clock of the simulated session, advanced by the simulation instead of real time."""
+  def __init__(self):
+    self.time = 0.0
+
+  def __call__(self):
+    return self.time
+
+class SimulatedPoseSource(object):
+  """Synthesizes controller and HMD poses of a participant reaching for targets, sampled at rate (Hz).
+
+  Each reach waits reactionTime, moves along a minimum jerk profile for movementTime and
+  rests on the target for restTime. Positions get Gaussian noise of noise mm, the head
+  sways slowly around facePosition.
+  """
+  def __init__(self, rate=90.0, facePosition=(0.0, 0.0, 1600.0), reactionTime=0.3, movementTime=0.8, restTime=0.8, noise=0.2, seed=0):
+    self.rate = rate
+    self.facePosition = np.asarray(facePosition, dtype=np.float64)
+    self.reactionTime = reactionTime
+    self.movementTime = movementTime
+    self.restTime = restTime
+    self.noise = noise
+    self.random = np.random.RandomState(seed)
+
+  def restPosition(self):
+    # Hand resting in front of and below the face
+    return self.facePosition + np.array([0.0, 300.0, -400.0])
+
+  def reach(self, start, target):
+    """Returns relative timestamps (N) and controller and HMD poses (N x 4 x 4) of one reach from start to target."""
+    timestamps = np.arange(0.0, self.reactionTime + self.movementTime + self.restTime, 1.0 / self.rate)
+    s = np.clip((timestamps - self.reactionTime) / self.movementTime, 0.0, 1.0)
+    profile = 10.0 * s**3 - 15.0 * s**4 + 6.0 * s**5
+    controller = np.tile(np.eye(4), (len(timestamps), 1, 1))
+    controller[:, 0:3, 3] = start + np.outer(profile, np.asarray(target) - start) + self.random.normal(0.0, self.noise, (len(timestamps), 3))
+    hmd = np.tile(np.eye(4), (len(timestamps), 1, 1))
+    sway = 5.0 * np.sin(2.0 * np.pi * 0.3 * (timestamps + self.random.uniform(0.0, 10.0)))
+    hmd[:, 0:3, 3] = self.facePosition + np.outer(sway, [1.0, 0.5, 0.0])
+    return timestamps, controller, hmd
+
+def randomTargets(numberOfPoints, seed=0):
+  # Targets in face coordinates, within reach in front of the participant
+  random = np.random.RandomState(seed)
+  return np.column_stack([random.uniform(-300.0, 300.0, numberOfPoints), random.uniform(250.0, 550.0, numberOfPoints), random.uniform(-300.0, 200.0, numberOfPoints)])
+
+def runSession(session, source, clock, referenceSequence, numberOfTrials, conditions=("Motion", "No motion", "Replay"), traceMemory=False):
+  """Runs complete trials with automatic (dwell) capture on a session that uses clock.
+
+  Returns the number of pose samples and the wall clock capture and save latencies (s), and
+  the traced memory after each trial (bytes) when traceMemory is set. Raises IOError if a
+  trial is not completely written when its save returns.
+  """
+  captureLatencies = []
+  saveLatencies = []
+  memory = []
+  numberOfSamples = 0
+  # Speed is estimated over 0.1 s whatever the rate
+  session.dwellDetector = DwellDetector(windowSize=int(round(0.1 * source.rate)))
+  session.calibrateFloor([0.0, 0.0, 0.0])
+  session.setFacePosition(source.facePosition)
+  position = source.restPosition()
+  for trial in range(0, numberOfTrials):
+    session.startTrial(trial + 1, conditions[trial % len(conditions)], referenceSequence)
+    for index in range(0, len(referenceSequence)):
+      session.setCurrentIndex(index)
+      session.startAutoCapture()
+      timestamps, controller, hmd = source.reach(position, session.worldTargets[index])
+      startTime = clock.time
+      captured = False
+      for i in range(0, len(timestamps)):
+        clock.time = startTime + timestamps[i]
+        session.recorder.append('HMD', hmd[i], clock.time)
+        session.recorder.append('Controller', controller[i], clock.time)
+        if session.updateDwell(clock.time, controller[i, 0:3, 3]) == DwellDetector.DWELL:
+          captureStart = time.perf_counter()
+          session.captureAtDwell()
+          captureLatencies.append(time.perf_counter() - captureStart)
+          captured = True
+          break
+      if not captured:
+        session.finishCapture(controller[i, 0:3, 3])
+      numberOfSamples += 2 * (i + 1)
+      position = controller[i, 0:3, 3]
+      clock.time += 1.0 / source.rate
+    saveStart = time.perf_counter()
+    store, written = session.saveTrial()
+    saveLatencies.append(time.perf_counter() - saveStart)
+    if not written:
+      raise IOError("Trial " + session.currentTrialKey() + " is still being written to " + store.path)
+    for description, success, message in session.writer.pollCompleted():
+      if not success:
+        raise IOError("Unable to write " + description + ": " + message)
+    if traceMemory:
+      memory.append(tracemalloc.get_traced_memory()[0])
+  return numberOfSamples, np.array(captureLatencies), np.array(saveLatencies), np.array(memory)
+
+def latencyStatistics(latencies):
+  if len(latencies) == 0:
+    return {'mean': np.nan, 'p95': np.nan, 'max': np.nan}
+  return {'mean': float(latencies.mean()), 'p95': float(np.percentile(latencies, 95)), 'max': float(latencies.max())}
+
+def benchmark(outputDirectory=None, rate=90.0, numberOfTrials=10, pointsPerTrial=20, traceMemory=True, seed=0):
+  """Simulates a session and reports its cost: capture and save latencies (s), pose samples
+  processed per second of wall time, and memory growth per trial (bytes, from tracemalloc).
+
+  The participant trial file is written to outputDirectory, or to a temporary directory that
+  is removed afterwards.
+  """
+  removeOutput = outputDirectory is None
+  if removeOutput:
+    outputDirectory = tempfile.mkdtemp()
+  clock = SimulatedClock()
+  session = ExperimentSession(outputDirectory, "simulated", clock=clock)
+  source = SimulatedPoseSource(rate, seed=seed)
+  startedTracing = traceMemory and not tracemalloc.is_tracing()
+  if startedTracing:
+    tracemalloc.start()
+  try:
+    wallStart = time.perf_counter()
+    numberOfSamples, captureLatencies, saveLatencies, memory = runSession(session, source, clock, randomTargets(pointsPerTrial, seed), numberOfTrials, traceMemory=traceMemory)
+    session.writer.shutdown()
+    wallTime = time.perf_counter() - wallStart
+  finally:
+    if startedTracing:
+      tracemalloc.stop()
+  store = session.trialStore()
+  result = {'rate': rate,
+            'trials': numberOfTrials,
+            'points': numberOfTrials * pointsPerTrial,
+            'simulatedTime': clock.time,
+            'wallTime': wallTime,
+            'samples': numberOfSamples,
+            'samplesPerSecond': numberOfSamples / wallTime if wallTime > 0 else np.nan,
+            'captureLatency': latencyStatistics(captureLatencies),
+            'saveLatency': latencyStatistics(saveLatencies),
+            # Slope of the memory in use after each trial, ignoring the first trial (allocations that are reused)
+            'memoryGrowthPerTrial': float(np.polyfit(np.arange(len(memory) - 1), memory[1:], 1)[0]) if len(memory) > 2 else np.nan,
+            'fileSize': store.size(),
+            'path': store.path}
+  if removeOutput:
+    shutil.rmtree(outputDirectory, ignore_errors=True)
+    result['path'] = ""
+  return result
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmark the VR vision experiment flow with simulated poses.")
+  parser.add_argument("--rate", type=float, default=90.0, help="pose rate in Hz (headsets run at 90-144 Hz)")
+  parser.add_argument("--trials", type=int, default=10, help="number of trials")
+  parser.add_argument("--points", type=int, default=20, help="targets per trial")
+  parser.add_argument("--hours", type=float, default=None, help="simulated session length, overrides --trials")
+  parser.add_argument("--output", default=None, help="directory of the participant trial file (temporary if not set)")
+  parser.add_argument("--no-memory", action="store_true", help="do not trace memory, tracing slows down the simulation")
+  args = parser.parse_args()
+  numberOfTrials = args.trials
+  if args.hours is not None:
+    source = SimulatedPoseSource(args.rate)
+    pointTime = source.reactionTime + source.movementTime + source.restTime
+    numberOfTrials = max(1, int(np.ceil(args.hours * 3600.0 / (pointTime * args.points))))
+  result = benchmark(args.output, args.rate, numberOfTrials, args.points, not args.no_memory)
+  print(json.dumps(result, indent=2))
+
+if __name__ == '__main__':
+  main()
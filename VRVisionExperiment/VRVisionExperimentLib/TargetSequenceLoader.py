@@ -0,0 +1,119 @@
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+class TargetSequenceError(ValueError):
+  """Raised when a target sequence file has invalid lines, badLines lists all of them as (line number, text)."""
+  def __init__(self, filename, badLines):
+    self.filename = filename
+    self.badLines = badLines
+    details = ", ".join(["line " + str(number) + ": '" + text + "'" for number, text in badLines[:10]])
+    if len(badLines) > 10:
+      details += ", ..."
+    ValueError.__init__(self, str(len(badLines)) + " invalid line(s) in sequence file " + filename + " (" + details + ")")
+
+class TargetSequenceLoader(object):
+  """Loads target sequence files (one "x, y, z" line per target) into N x 3 arrays.
+
+  Parsed sequences are cached in memory by path, modification time and size. If a
+  cacheDirectory is given, a binary sidecar keyed by the same is written there so that
+  later sessions load the array directly instead of parsing the text again. Sidecars of
+  files that changed are not read again, they are only left behind in the cache directory.
+  """
+  SIDECAR_EXTENSION = ".npz"
+
+  def __init__(self, cacheDirectory=None):
+    self.cacheDirectory = cacheDirectory
+    self.cache = {}
+
+  @staticmethod
+  def signature(filename):
+    status = os.stat(filename)
+    return (status.st_mtime, status.st_size)
+
+  def load(self, filename):
+    filename = os.path.abspath(filename)
+    signature = self.signature(filename)
+    cached = self.cache.get(filename)
+    if cached is not None and cached[0] == signature:
+      return cached[1]
+    points = None
+    if self.cacheDirectory:
+      points = self.readSidecar(filename, signature)
+    if points is None:
+      points = self.parse(filename)
+      if self.cacheDirectory:
+        self.writeSidecar(filename, signature, points)
+    # Cached arrays are shared, make sure nobody modifies them in place
+    points.setflags(write=False)
+    self.cache[filename] = (signature, points)
+    return points
+
+  @staticmethod
+  def parse(filename):
+    with open(filename) as f:
+      lines = np.array(f.read().splitlines(), dtype=str)
+    lineNumbers = np.arange(1, len(lines) + 1)
+    lines = np.char.strip(lines)
+    # Blank lines are ignored
+    nonEmpty = np.char.str_len(lines) > 0
+    lines = lines[nonEmpty]
+    lineNumbers = lineNumbers[nonEmpty]
+    if len(lines) == 0:
+      return np.zeros((0, 3))
+
+    # Every line must have exactly three comma separated values
+    badColumns = np.char.count(lines, ',') != 2
+    badLines = [(int(number), str(text)) for number, text in zip(lineNumbers[badColumns], lines[badColumns])]
+    lines = lines[~badColumns]
+    lineNumbers = lineNumbers[~badColumns]
+
+    fields = np.char.strip(np.array(",".join(lines).split(","), dtype=str)) if len(lines) > 0 else np.zeros(0, dtype=str)
+    try:
+      values = fields.astype(np.float64)
+    except ValueError:
+      # Find every field that is not a number, only done when the file is invalid
+      values = np.full(len(fields), np.nan)
+      badFields = np.zeros(len(fields), dtype=bool)
+      for index, field in enumerate(fields):
+        try:
+          values[index] = float(field)
+        except ValueError:
+          badFields[index] = True
+      badNumbers = badFields.reshape(-1, 3).any(axis=1)
+      badLines.extend([(int(number), str(text)) for number, text in zip(lineNumbers[badNumbers], lines[badNumbers])])
+
+    if len(badLines) > 0:
+      raise TargetSequenceError(filename, sorted(badLines))
+    return values.reshape(-1, 3)
+
+  def sidecarFilename(self, filename, signature):
+    key = hashlib.sha1((filename + "|" + repr(signature[0]) + "|" + str(signature[1])).encode('utf-8')).hexdigest()
+    return os.path.join(self.cacheDirectory, key + self.SIDECAR_EXTENSION)
+
+  def readSidecar(self, filename, signature):
+    sidecar = self.sidecarFilename(filename, signature)
+    if not os.path.exists(sidecar):
+      return None
+    try:
+      with np.load(sidecar, allow_pickle=False) as data:
+        return np.array(data['points'])
+    except (IOError, KeyError, ValueError):
+      return None
+
+  def writeSidecar(self, filename, signature, points):
+    # Written to a temporary file that is renamed into place, a sidecar is never read half written
+    temporaryPath = None
+    try:
+      if not os.path.isdir(self.cacheDirectory):
+        os.makedirs(self.cacheDirectory)
+      handle, temporaryPath = tempfile.mkstemp(suffix=".tmp", dir=self.cacheDirectory)
+      with os.fdopen(handle, 'wb') as f:
+        np.savez(f, points=points)
+      os.replace(temporaryPath, self.sidecarFilename(filename, signature))
+    except (IOError, OSError):
+      # Cache directory not writable, the sequence is still cached in memory
+      if temporaryPath is not None and os.path.exists(temporaryPath):
+        os.remove(temporaryPath)
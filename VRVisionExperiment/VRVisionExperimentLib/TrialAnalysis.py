@@ -0,0 +1,137 @@
+import numpy as np
+
+from .TrialStore import TrialStore
+
+# Per point metrics computed by analyzeParticipant, in output order
+METRICS = ['pointingError', 'elapsed', 'pathLength', 'peakVelocity', 'movementOnset', 'headPathLength', 'headMaxDisplacement']
+
+def concatenateSegments(segments):
+  """Concatenates (timestamps, positions) segments, returns timestamps, positions, segment start indices and lengths."""
+  lengths = np.array([len(timestamps) for timestamps, positions in segments], dtype=np.int64)
+  starts = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+  if lengths.sum() == 0:
+    return np.zeros(0), np.zeros((0, 3)), starts, lengths
+  timestamps = np.concatenate([timestamps for timestamps, positions in segments])
+  positions = np.concatenate([np.reshape(positions, (-1, 3)) for timestamps, positions in segments])
+  return timestamps, positions, starts, lengths
+
+def segmentMetrics(timestamps, positions, starts, lengths, onsetSpeed):
+  """Path length, peak speed, movement onset time and maximum displacement of every segment.
+
+  All segments are processed at once: per sample step lengths and speeds are computed
+  over the concatenated arrays, steps across segment boundaries are zeroed, and the
+  per segment values are obtained with reduceat. Segments with fewer than two samples
+  get NaN.
+  """
+  numberOfSegments = len(lengths)
+  pathLength = np.full(numberOfSegments, np.nan)
+  peakSpeed = np.full(numberOfSegments, np.nan)
+  onset = np.full(numberOfSegments, np.nan)
+  maxDisplacement = np.full(numberOfSegments, np.nan)
+  valid = lengths >= 2
+  if not np.any(valid):
+    return pathLength, peakSpeed, onset, maxDisplacement
+
+  steps = np.zeros(len(timestamps))
+  steps[1:] = np.linalg.norm(np.diff(positions, axis=0), axis=1)
+  durations = np.ones(len(timestamps))
+  durations[1:] = np.diff(timestamps)
+  durations[durations <= 0] = np.inf
+  # First sample of a segment has no preceding step
+  steps[starts[lengths > 0]] = 0.0
+  speeds = steps / durations
+
+  # Reduce over every non-empty segment, then keep the ones with at least two samples
+  nonEmpty = lengths > 0
+  segmentStarts = starts[nonEmpty]
+  keep = valid[nonEmpty]
+  pathLength[valid] = np.add.reduceat(steps, segmentStarts)[keep]
+  peakSpeed[valid] = np.maximum.reduceat(speeds, segmentStarts)[keep]
+
+  # Onset is the first sample above onsetSpeed, relative to the first sample of the segment
+  sampleIndices = np.arange(len(timestamps), dtype=np.float64)
+  candidates = np.where(speeds > onsetSpeed, sampleIndices, np.inf)
+  firstAbove = np.minimum.reduceat(candidates, segmentStarts)[keep]
+  moved = np.isfinite(firstAbove)
+  onsetValues = np.full(len(firstAbove), np.nan)
+  onsetValues[moved] = timestamps[firstAbove[moved].astype(np.int64)] - timestamps[starts[valid][moved]]
+  onset[valid] = onsetValues
+
+  # Largest distance from the position at the start of the segment
+  segmentIndex = np.repeat(np.arange(numberOfSegments), lengths)
+  displacement = np.linalg.norm(positions - positions[starts[segmentIndex]], axis=1)
+  maxDisplacement[valid] = np.maximum.reduceat(displacement, segmentStarts)[keep]
+  return pathLength, peakSpeed, onset, maxDisplacement
+
+def analyzeParticipant(path, onsetSpeed=50.0):
+  """Computes the per point metrics of every saved trial in a participant trial file.
+
+  Positions are in mm and times in seconds, onsetSpeed is in mm/s. Returns a dict of
+  equally long columns: participant, trial, condition, point and the METRICS.
+  """
+  trials = TrialStore(path).readAll()
+  participants, trialKeys, conditions, points, errors, elapsed = [], [], [], [], [], []
+  controllerSegments, hmdSegments = [], []
+  empty = (np.zeros(0), np.zeros((0, 3)))
+  for key in sorted(trials.keys()):
+    trial = trials[key]
+    if 'attributes' not in trial or 'captured' not in trial:
+      # Trial was never saved
+      continue
+    captured = trial['captured']
+    reference = trial['reference']
+    numberOfPoints = len(captured)
+    participants.extend([trial['attributes']['participant']] * numberOfPoints)
+    trialKeys.extend([key] * numberOfPoints)
+    conditions.extend([trial['attributes']['condition']] * numberOfPoints)
+    points.append(np.arange(numberOfPoints))
+    errors.append(np.linalg.norm(captured - reference, axis=1))
+    elapsed.append(trial['elapsed'])
+    for index in range(0, numberOfPoints):
+      streams = trial['points'].get(index, {})
+      for name, segments in [('Controller', controllerSegments), ('HMD', hmdSegments)]:
+        if name in streams:
+          timestamps, matrices = streams[name]
+          segments.append((timestamps, matrices[:, 0:3, 3]))
+        else:
+          segments.append(empty)
+
+  result = {'participant': np.array(participants), 'trial': np.array(trialKeys), 'condition': np.array(conditions)}
+  if len(points) == 0:
+    result['point'] = np.zeros(0, dtype=np.int64)
+    for metric in METRICS:
+      result[metric] = np.zeros(0)
+    return result
+  result['point'] = np.concatenate(points)
+  result['pointingError'] = np.concatenate(errors)
+  result['elapsed'] = np.concatenate(elapsed)
+  timestamps, positions, starts, lengths = concatenateSegments(controllerSegments)
+  result['pathLength'], result['peakVelocity'], result['movementOnset'], unused = segmentMetrics(timestamps, positions, starts, lengths, onsetSpeed)
+  timestamps, positions, starts, lengths = concatenateSegments(hmdSegments)
+  result['headPathLength'], unused, unused, result['headMaxDisplacement'] = segmentMetrics(timestamps, positions, starts, lengths, onsetSpeed)
+  return result
+
+def mergeResults(results):
+  """Concatenates the columns returned by analyzeParticipant for several participants."""
+  results = [result for result in results if len(result['point']) > 0]
+  if len(results) == 0:
+    return None
+  return dict((column, np.concatenate([result[column] for result in results])) for column in results[0].keys())
+
+def summarizeByCondition(merged):
+  """Returns {condition: {metric: {'mean', 'std', 'median', 'n'}}}, ignoring NaN values."""
+  summary = {}
+  if merged is None:
+    return summary
+  for condition in np.unique(merged['condition']):
+    selected = merged['condition'] == condition
+    condition = str(condition)
+    summary[condition] = {}
+    for metric in METRICS:
+      values = merged[metric][selected]
+      values = values[np.isfinite(values)]
+      if len(values) == 0:
+        summary[condition][metric] = {'mean': np.nan, 'std': np.nan, 'median': np.nan, 'n': 0}
+      else:
+        summary[condition][metric] = {'mean': float(values.mean()), 'std': float(values.std()), 'median': float(np.median(values)), 'n': len(values)}
+  return summary
@@ -0,0 +1,207 @@
+import io
+import json
+import os
+import struct
+import zlib
+
+import numpy as np
+
+MAGIC = b"VRT1"
+# Record header: magic, name length, payload length, CRC-32 of the payload
+HEADER = struct.Struct("<4sHQI")
+
+def trialKey(trialNumber, condition):
+  return "trial" + str(trialNumber).zfill(4) + "_" + condition.replace(" ", "_")
+
+def pointName(trial, pointIndex):
+  return trial + "/point" + str(pointIndex).zfill(4)
+
+def columnsName(trial):
+  return trial + "/columns"
+
+class TrialStore(object):
+  """All trials of one participant in one append-only file of compressed, columnar chunks.
+
+  The file is a sequence of records, each a header (name, payload length, CRC-32) followed by
+  one chunk, a compressed npz payload:
+
+    <trial>/point<NNNN>   <stream>_timestamps, <stream>_matrices, events, eventNames
+    <trial>/columns       per trial columns (captured, reference, elapsed, ...) and the attributes as JSON
+
+  An append writes one record at the end of the file, its cost does not depend on what is
+  already stored. The record headers form the index, it is read once, by skipping from header
+  to header, and then kept in memory and extended by every append. A later record with the same
+  name replaces the earlier one (capturing a point again), the file is compacted once replaced
+  records take up more than half of it. A record that was only partly written when the
+  application stopped (torn tail) is ignored on open and overwritten by the next append.
+  Appends are not synchronized, they must all come from a single thread and a single instance.
+  """
+  EXTENSION = ".vrtrials"
+
+  def __init__(self, path):
+    self.path = path
+    # Record name -> (payload offset, payload length, CRC-32), read on first use
+    self.index = None
+    self.endOffset = 0
+    self.replacedBytes = 0
+
+  @staticmethod
+  def participantPath(directory, participantId):
+    return os.path.join(directory, "participant" + participantId + TrialStore.EXTENSION)
+
+  def records(self):
+    if self.index is None:
+      self.readIndex()
+    return self.index
+
+  def readIndex(self):
+    self.index = {}
+    self.endOffset = 0
+    self.replacedBytes = 0
+    if not os.path.exists(self.path):
+      return
+    fileSize = os.path.getsize(self.path)
+    with open(self.path, 'rb') as f:
+      offset = 0
+      while offset + HEADER.size <= fileSize:
+        magic, nameLength, payloadLength, crc = HEADER.unpack(f.read(HEADER.size))
+        payloadOffset = offset + HEADER.size + nameLength
+        if magic != MAGIC or payloadOffset + payloadLength > fileSize:
+          break
+        name = f.read(nameLength).decode('utf-8')
+        recordEnd = payloadOffset + payloadLength
+        if recordEnd == fileSize:
+          # Only the last record can be torn with its length already written
+          if zlib.crc32(f.read(payloadLength)) & 0xffffffff != crc:
+            break
+        else:
+          f.seek(payloadLength, io.SEEK_CUR)
+        self.addRecord(name, payloadOffset, payloadLength, crc)
+        offset = recordEnd
+    self.endOffset = offset
+
+  def addRecord(self, name, payloadOffset, payloadLength, crc):
+    if name in self.index:
+      self.replacedBytes += self.index[name][1]
+    self.index[name] = (payloadOffset, payloadLength, crc)
+
+  def appendRecord(self, name, arrays):
+    self.records()
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **arrays)
+    payload = buffer.getvalue()
+    encodedName = name.encode('utf-8')
+    crc = zlib.crc32(payload) & 0xffffffff
+    directory = os.path.dirname(self.path)
+    if directory and not os.path.isdir(directory):
+      os.makedirs(directory)
+    with open(self.path, 'r+b' if os.path.exists(self.path) else 'wb') as f:
+      # Overwrite a torn tail
+      f.seek(self.endOffset)
+      f.truncate()
+      f.write(HEADER.pack(MAGIC, len(encodedName), len(payload), crc) + encodedName + payload)
+      f.flush()
+      os.fsync(f.fileno())
+    self.addRecord(name, self.endOffset + HEADER.size + len(encodedName), len(payload), crc)
+    self.endOffset += HEADER.size + len(encodedName) + len(payload)
+    if self.replacedBytes > self.endOffset / 2:
+      self.compact()
+
+  def compact(self):
+    """Rewrites the file without replaced records, through a temporary file that is renamed into place."""
+    records = self.records()
+    temporaryPath = self.path + ".tmp"
+    with open(self.path, 'rb') as source, open(temporaryPath, 'wb') as f:
+      for name, (payloadOffset, payloadLength, crc) in records.items():
+        source.seek(payloadOffset)
+        encodedName = name.encode('utf-8')
+        f.write(HEADER.pack(MAGIC, len(encodedName), payloadLength, crc) + encodedName + source.read(payloadLength))
+      f.flush()
+      os.fsync(f.fileno())
+    os.replace(temporaryPath, self.path)
+    self.readIndex()
+
+  def appendPoint(self, trial, pointIndex, streams, events=None):
+    """Stores the pose streams ({name: (timestamps, matrices)}) and events ((timestamps, names)) recorded for one point of a trial."""
+    arrays = {}
+    for name, (timestamps, matrices) in streams.items():
+      arrays[name + "_timestamps"] = np.asarray(timestamps)
+      arrays[name + "_matrices"] = np.asarray(matrices)
+    if events is not None:
+      arrays['events'] = np.asarray(events[0])
+      arrays['eventNames'] = np.asarray(events[1], dtype=str)
+    self.appendRecord(pointName(trial, pointIndex), arrays)
+
+  def appendTrial(self, trial, columns, attributes):
+    """Stores the per point columns ({name: array}) and attributes (JSON serializable dict) of a trial."""
+    arrays = dict((name, np.asarray(array)) for name, array in columns.items())
+    arrays['attributes'] = np.asarray(json.dumps(attributes))
+    self.appendRecord(columnsName(trial), arrays)
+
+  def trials(self):
+    """Keys of the trials that have been saved (have columns and attributes)."""
+    return sorted(name[:-len("/columns")] for name in self.records().keys() if name.endswith("/columns"))
+
+  def points(self, trial):
+    prefix = trial + "/point"
+    return sorted(int(name[len(prefix):]) for name in self.records().keys() if name.startswith(prefix))
+
+  def size(self):
+    """Bytes of the file."""
+    return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+  def readRecord(self, name, data=None):
+    # data is the content of the whole file, if it has been read already
+    payloadOffset, payloadLength, crc = self.records()[name]
+    if data is None:
+      with open(self.path, 'rb') as f:
+        f.seek(payloadOffset)
+        payload = f.read(payloadLength)
+    else:
+      payload = data[payloadOffset:payloadOffset+payloadLength]
+    if zlib.crc32(payload) & 0xffffffff != crc:
+      raise IOError("Record " + name + " of " + self.path + " is corrupted")
+    with np.load(io.BytesIO(payload), allow_pickle=False) as arrays:
+      return dict((key, arrays[key]) for key in arrays.files)
+
+  def readTrialRecord(self, trial, data=None):
+    result = self.readRecord(columnsName(trial), data)
+    result['attributes'] = json.loads(str(result['attributes']))
+    return result
+
+  def readPointRecord(self, trial, pointIndex, data=None):
+    arrays = self.readRecord(pointName(trial, pointIndex), data)
+    streams = {}
+    for name in arrays.keys():
+      if name.endswith("_timestamps"):
+        stream = name[:-len("_timestamps")]
+        streams[stream] = (arrays[name], arrays[stream + "_matrices"])
+    if 'events' in arrays:
+      streams['events'] = (arrays['events'], arrays['eventNames'])
+    return streams
+
+  def readTrial(self, trial):
+    """Returns the trial columns as a dict of arrays, with the attributes under 'attributes'."""
+    return self.readTrialRecord(trial)
+
+  def readPoint(self, trial, pointIndex):
+    """Returns {stream name: (timestamps, matrices)} for one point of a trial, events are under 'events'."""
+    return self.readPointRecord(trial, pointIndex)
+
+  def readAll(self):
+    """Reads every trial with one read of the file: {trial: {column: array, 'attributes': dict, 'points': {index: streams}}}.
+
+    Trials whose points were written but not the trial itself only have 'points'.
+    """
+    records = self.records()
+    if not records:
+      return {}
+    with open(self.path, 'rb') as f:
+      data = f.read(self.endOffset)
+    trials = {}
+    for name in records.keys():
+      trial = name.split("/")[0]
+      if trial not in trials:
+        trials[trial] = self.readTrialRecord(trial, data) if columnsName(trial) in records else {}
+        trials[trial]['points'] = dict((pointIndex, self.readPointRecord(trial, pointIndex, data)) for pointIndex in self.points(trial))
+    return trials
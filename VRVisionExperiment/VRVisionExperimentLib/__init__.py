@@ -0,0 +1,9 @@
+from .BackgroundWriter import BackgroundWriter
+from .DwellDetector import DwellDetector
+from .ExperimentSession import ExperimentSession
+from .FrameMonitor import FrameMonitor
+from .PoseRecorder import EventLog, PoseRecorder, PoseStream
+from .PoseStreaming import PosePublisher, PoseSubscriber
+from .ReplayPath import ReplayPath
+from .TargetSequenceLoader import TargetSequenceError, TargetSequenceLoader
+from .TrialStore import TrialStore, trialKey